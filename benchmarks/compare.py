@@ -0,0 +1,79 @@
+"""
+Diffs two benchmark result files (`benchmarks.inference --out ...`) stage by stage:
+    python -m benchmarks.compare bench_base.json bench_new.json --threshold 0.1 --fail
+Exits with 1 with `--fail` when a stage regressed by more than `--threshold`.
+"""
+import sys
+import json
+import argparse
+
+def compare_results(base, new, metric="p50_ms", threshold=0.1):
+    """
+    Args:
+        base (dict): loaded results of the baseline run
+        new (dict): loaded results of the new run
+        metric (str): statistic to compare (`p50_ms` is the most robust against outliers)
+        threshold (float): relative slowdown above which a stage counts as a regression
+    Returns:
+        list of dicts with `stage`, `base`, `new`, `ratio` (new / base) and `status`
+            (`regression`, `improvement`, `ok`, `added` or `removed`)
+    """
+    base_results, new_results = base["results"], new["results"]
+    rows = []
+    for stage in sorted(set(base_results) | set(new_results)):
+        if stage not in new_results:
+            rows.append({"stage": stage, "base": base_results[stage][metric], "new": None, "ratio": None,
+                         "status": "removed"})
+            continue
+        if stage not in base_results:
+            rows.append({"stage": stage, "base": None, "new": new_results[stage][metric], "ratio": None,
+                         "status": "added"})
+            continue
+        base_value, new_value = base_results[stage][metric], new_results[stage][metric]
+        ratio = new_value / max(base_value, 1e-9)
+        if ratio > 1 + threshold:
+            status = "regression"
+        elif ratio < 1 / (1 + threshold):
+            status = "improvement"
+        else:
+            status = "ok"
+        rows.append({"stage": stage, "base": base_value, "new": new_value, "ratio": ratio, "status": status})
+    return rows
+
+def _format(value, fmt):
+    return "-" if value is None else fmt.format(value)
+
+def print_comparison(rows, base_env=None, new_env=None):
+    if base_env is not None and new_env is not None:
+        print("base: {0} ({1})  new: {2} ({3})".format(base_env.get("commit"), base_env.get("timestamp"),
+                                                        new_env.get("commit"), new_env.get("timestamp")))
+    print("{0:<32} {1:>12} {2:>12} {3:>8}  {4}".format("stage", "base ms", "new ms", "ratio", "status"))
+    for row in rows:
+        print("{0:<32} {1:>12} {2:>12} {3:>8}  {4}".format(row["stage"], _format(row["base"], "{0:.2f}"),
+                                                          _format(row["new"], "{0:.2f}"),
+                                                          _format(row["ratio"], "{0:.2f}x"), row["status"]))
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Compares two benchmark result files.")
+    parser.add_argument("base", help="baseline results .json")
+    parser.add_argument("new", help="new results .json")
+    parser.add_argument("--metric", default="p50_ms")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown that counts as a regression")
+    parser.add_argument("--fail", action="store_true", help="exit with 1 if there are regressions")
+    return parser
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    with open(args.base, "r") as fp:
+        base = json.load(fp)
+    with open(args.new, "r") as fp:
+        new = json.load(fp)
+    if base.get("config") != new.get("config"):
+        print("WARNING. The runs have different configs: {0} vs. {1}".format(base.get("config"), new.get("config")))
+    rows = compare_results(base, new, metric=args.metric, threshold=args.threshold)
+    print_comparison(rows, base.get("environment"), new.get("environment"))
+    n_regressions = sum(row["status"] == "regression" for row in rows)
+    if n_regressions:
+        print("{0} stage(s) regressed by more than {1:.0%}.".format(n_regressions, args.threshold))
+        if args.fail:
+            sys.exit(1)
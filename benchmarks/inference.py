@@ -0,0 +1,214 @@
+"""
+Times each stage of the segmentation inference pipeline on a synthetic test set (see `benchmarks.synthetic`)
+with small random-weight models, so that it runs anywhere without data or trained weights:
+    python -m benchmarks.inference --data_dir /tmp/bench_data --out bench_$(git rev-parse --short HEAD).json
+    python -m benchmarks.compare bench_old.json bench_new.json
+The stages are the ones of `inference.segmentation_only.SegmentationOnlyInference`: decode, load_input
+(decode + resize), preprocess, predict (with and without TTA), postprocess (resize + threshold + zero out),
+encode (mask2rle per mask kind), decode rles (rle2mask), the csv writes and the ensembling of submissions
+(`inference.ensemble_df.ensemble_segmentation_from_sub`). The output of the timed functions (progress bars,
+prints) is silenced.
+"""
+import os
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+import cv2
+
+from functools import partial
+from pathlib import Path
+from PIL import Image
+
+from benchmarks.synthetic import MASK_KINDS, write_synthetic_dataset
+from benchmarks.timing import BenchmarkSuite, silenced
+
+def build_random_model(model_name="unet", img_size=256, channels=3, seed=0):
+    """
+    Segmentation model with random weights (only the speed is benchmarked).
+    Args:
+        model_name (str): `unet` (small 2D U-Net) or `uefficientnet-b0` ... `uefficientnet-b7`
+        img_size (int): height and width of the inputs
+        channels (int): number of input channels
+        seed (int): weight initialization seed
+    Returns:
+        tf.keras.models.Model with a sigmoid output
+    """
+    import tensorflow as tf
+    tf.random.set_seed(seed)
+    if model_name == "unet":
+        from pneumothorax_seg.models.unet.models import UNet
+        return UNet(input_shape=(img_size, img_size, channels), n_pools=4, starting_filters=8,
+                    max_filters=128).build_model(include_top=True, out_act="sigmoid")
+    elif model_name.startswith("uefficientnet"):
+        from pneumothorax_seg.models.uefficientnet.models import UEfficientNet
+        encoder = model_name.replace("uefficientnet", "efficientnet")
+        return UEfficientNet(input_shape=(img_size, img_size, 3), encoder_weights=None, encoder=encoder)
+    raise ValueError("`model_name` must be `unet` or `uefficientnet-b{0-7}`.")
+
+def postprocess(preds, threshold=0.5, min_area=1024*2):
+    """
+    Same post-processing as `SegmentationOnlyInference`: resizing to 1024x1024 -> thresholding -> zeroing out
+    small predictions -> transposing and converting to uint8 (0/255).
+    """
+    from pneumothorax_seg.inference.segmentation import zero_out_thresholded_single
+    masks = []
+    for pred in preds:
+        arr = cv2.resize(pred, (1024, 1024)) if pred.shape != (1024, 1024) else pred.copy()
+        arr[arr >= threshold] = 1
+        arr[arr < threshold] = 0
+        arr = zero_out_thresholded_single(arr, min_area=min_area)
+        masks.append((arr.T * 255).astype(np.uint8))
+    return masks
+
+def synthetic_submissions(image_ids, rles, n_submissions=3, drop_fraction=0.2, seed=0):
+    """
+    Submission DataFrames that disagree on some images: each one predicts an empty mask ("-1") for a random
+    `drop_fraction` of the images.
+    Args:
+        image_ids (list): of ImageIds
+        rles (list): of run-length encodings (mask2rle) of each image; "" for empty masks
+        n_submissions (int): number of submissions
+        drop_fraction (float): fraction of the images that each submission predicts as empty
+        seed (int): random seed
+    Returns:
+        list of pd.DataFrames with the columns `ImageId` and `EncodedPixels`
+    """
+    rs = np.random.RandomState(seed)
+    submissions = []
+    for _ in range(n_submissions):
+        dropped = rs.uniform(size=len(rles)) < drop_fraction
+        values = ["-1" if (drop or not rle) else rle for rle, drop in zip(rles, dropped)]
+        submissions.append(pd.DataFrame({"ImageId": image_ids, "EncodedPixels": values}))
+    return submissions
+
+def run_benchmarks(data_dir, n_images=16, img_size=256, model_name="unet", batch_size=8, n_warmup=2,
+                   n_repeats=10, n_encode_repeats=3, mask_mix=(0.7, 0.2, 0.1), seed=0, stages=None):
+    """
+    Runs the stage benchmarks.
+    Args:
+        data_dir (str): directory of the synthetic test set (generated if it doesn't exist)
+        n_images (int): number of 1024x1024 test images
+        img_size (int): model input size
+        model_name (str): see `build_random_model`
+        batch_size (int): prediction batch size
+        n_warmup (int): number of untimed runs per stage
+        n_repeats (int): number of timed runs per stage
+        n_encode_repeats (int): number of timed runs of the (slow) run-length encoding and ensembling stages
+        mask_mix (tuple): fractions of `empty`, `single` and `multi` masks
+        seed (int): random seed of the data and the model weights
+        stages (list): names (or prefixes) of the stages to run. Defaults to None (all of them).
+    Returns:
+        BenchmarkSuite
+    """
+    from pneumothorax_seg.inference.mask_functions import mask2rle, rle2mask
+    from pneumothorax_seg.inference.utils import load_input
+    from pneumothorax_seg.io.utils import preprocess_input
+    from pneumothorax_seg.inference.submission import SubmissionShardWriter, merge_shards, write_submission
+    from pneumothorax_seg.inference.ensemble_df import ensemble_segmentation_from_sub
+
+    config = {"n_images": n_images, "img_size": img_size, "model_name": model_name, "batch_size": batch_size,
+              "mask_mix": list(mask_mix), "seed": seed}
+    suite = BenchmarkSuite(config, n_warmup=n_warmup, n_repeats=n_repeats)
+    def enabled(stage):
+        return stages is None or any(stage.startswith(prefix) for prefix in stages)
+
+    print("Generating/loading the synthetic test set in {0}...".format(data_dir))
+    dataset = write_synthetic_dataset(data_dir, n_images=n_images, mask_mix=mask_mix, seed=seed)
+    fpaths, kinds = dataset["images"], dataset["kinds"]
+    test_ids = [Path(fpath).stem for fpath in fpaths]
+
+    # input
+    if enabled("decode"):
+        suite.time("decode", lambda: [np.array(Image.open(fpath)) for fpath in fpaths], n_items=n_images)
+    if enabled("load_input"):
+        suite.time("load_input", lambda: [load_input(fpath, img_size, channels=3) for fpath in fpaths],
+                   n_items=n_images)
+    x_test = np.asarray([load_input(fpath, img_size, channels=3) for fpath in fpaths])
+    preprocess_fn = partial(preprocess_input, model_name=None)
+    if enabled("preprocess"):
+        suite.time("preprocess", lambda: preprocess_fn(x_test), n_items=n_images)
+    x_test = preprocess_fn(x_test)
+
+    # model
+    preds = np.random.RandomState(seed).uniform(size=x_test.shape[:3]).astype(np.float32)
+    if enabled("predict"):
+        from pneumothorax_seg.inference.segmentation import run_seg_prediction
+        model = build_random_model(model_name, img_size=img_size, seed=seed)
+        suite.config["n_params"] = int(model.count_params())
+        for tta in (False, True):
+            stage = "predict_tta" if tta else "predict"
+            if enabled(stage):
+                suite.time(stage, lambda: run_seg_prediction(x_test, model, batch_size=batch_size, tta=tta),
+                           n_items=n_images)
+        with silenced():
+            preds = run_seg_prediction(x_test, model, batch_size=batch_size, tta=False)
+        preds = preds.reshape((n_images,) + preds.shape[-2:]).astype(np.float32)
+
+    # output
+    if enabled("postprocess"):
+        suite.time("postprocess", lambda: postprocess(preds), n_items=n_images)
+    masks = [np.array(Image.open(fpath)) for fpath in dataset["masks"]]
+    rles = [mask2rle(mask.T, 1024, 1024) for mask in masks]
+    for kind in MASK_KINDS:
+        kind_masks = [mask.T for mask, kind_ in zip(masks, kinds) if kind_ == kind]
+        if kind_masks and enabled("encode_" + kind):
+            suite.time("encode_" + kind, lambda: [mask2rle(mask, 1024, 1024) for mask in kind_masks],
+                       n_items=len(kind_masks), n_repeats=n_encode_repeats)
+    nonempty_rles = [rle for rle in rles if rle]
+    if nonempty_rles and enabled("rle2mask"):
+        suite.time("rle2mask", lambda: [rle2mask(rle, 1024, 1024) for rle in nonempty_rles],
+                   n_items=len(nonempty_rles))
+
+    tmp_dir = tempfile.mkdtemp(prefix="bench_csv_")
+    save_path = os.path.join(tmp_dir, "submission.csv")
+    def write_and_merge():
+        shard_dir = os.path.join(tmp_dir, "shards")
+        # two workers, like `SegmentationOnlyInference(..., n_workers=2)`
+        for worker_id, (start, end) in enumerate([(0, n_images // 2), (n_images // 2, n_images)]):
+            with SubmissionShardWriter(shard_dir, order=test_ids, worker_id=worker_id, n_workers=2) as writer:
+                writer.write_rows(test_ids[start:end], rles[start:end])
+        merge_shards(shard_dir, save_path, remove_shards=True, n_workers=2)
+    if enabled("csv_write"):
+        suite.time("csv_write", lambda: write_submission(save_path, test_ids, rles), n_items=n_images)
+    if enabled("csv_shards_merge"):
+        suite.time("csv_shards_merge", write_and_merge, n_items=n_images)
+    if enabled("ensemble"):
+        submissions = synthetic_submissions(test_ids, rles, n_submissions=3, seed=seed)
+        # ensemble_segmentation_from_sub saves `average_submission.csv` to the working directory
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            suite.time("ensemble", lambda: ensemble_segmentation_from_sub(submissions, min_solutions=2),
+                       n_items=n_images, n_repeats=n_encode_repeats)
+        finally:
+            os.chdir(cwd)
+    shutil.rmtree(tmp_dir)
+    return suite
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmarks the inference stages on synthetic data.")
+    parser.add_argument("--data_dir", default=os.path.join(tempfile.gettempdir(), "pneumothorax_bench_data"),
+                        help="synthetic test set (reused between runs)")
+    parser.add_argument("--out", default="benchmark_results.json", help="path to the .json results")
+    parser.add_argument("--n_images", type=int, default=16)
+    parser.add_argument("--img_size", type=int, default=256)
+    parser.add_argument("--model_name", default="unet", help="`unet` or `uefficientnet-b0` ... `-b7`")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--n_warmup", type=int, default=2)
+    parser.add_argument("--n_repeats", type=int, default=10)
+    parser.add_argument("--n_encode_repeats", type=int, default=3)
+    parser.add_argument("--mask_mix", nargs=3, type=float, default=[0.7, 0.2, 0.1],
+                        help="fractions of empty, single and multi blob masks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", nargs="+", default=None, help="only run the stages with these prefixes")
+    return parser
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    suite = run_benchmarks(args.data_dir, n_images=args.n_images, img_size=args.img_size,
+                           model_name=args.model_name, batch_size=args.batch_size, n_warmup=args.n_warmup,
+                           n_repeats=args.n_repeats, n_encode_repeats=args.n_encode_repeats,
+                           mask_mix=args.mask_mix, seed=args.seed, stages=args.stages)
+    suite.save(args.out)
@@ -0,0 +1,97 @@
+import os
+import cv2
+import numpy as np
+
+from PIL import Image
+
+MASK_KINDS = ("empty", "single", "multi")
+
+def synthetic_radiograph(size=1024, rs=None):
+    """
+    Chest radiograph-like uint8 image: dark padding, a brighter body with rib-like stripes and two darker,
+    textured lung fields. Only meant to give the decoders/encoders realistic image statistics.
+    Args:
+        size (int): height and width
+        rs (np.random.RandomState):
+    Returns:
+        np.ndarray (size, size) uint8
+    """
+    rs = np.random.RandomState(0) if rs is None else rs
+    yy, xx = np.mgrid[:size, :size].astype(np.float32) / size
+    pad = rs.uniform(0, 0.08)
+    img = np.zeros((size, size), dtype=np.float32)
+    body = (yy > pad) & (yy < 1 - pad / 2) & (xx > pad) & (xx < 1 - pad)
+    img[body] = 170
+    # ribs
+    img += 12 * np.sin(yy * rs.uniform(40, 60)) * body
+    for cx in (0.5 - rs.uniform(0.17, 0.22), 0.5 + rs.uniform(0.17, 0.22)):
+        lung = ((yy - 0.45) / 0.33) ** 2 + ((xx - cx) / 0.15) ** 2 < 1
+        img[lung] = 70
+    noise = cv2.GaussianBlur(rs.normal(0, 25, (size, size)).astype(np.float32), (0, 0), size / 256.)
+    img = cv2.GaussianBlur(img, (0, 0), size / 512.) + noise * body
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+def _crescent(size, rs):
+    # pneumothoraces are mostly thin crescents along the lung apex/periphery
+    mask = np.zeros((size, size), dtype=np.uint8)
+    center = (int(rs.uniform(0.25, 0.75) * size), int(rs.uniform(0.2, 0.5) * size))
+    axes = (int(rs.uniform(0.05, 0.15) * size), int(rs.uniform(0.1, 0.25) * size))
+    angle = rs.uniform(-30, 30)
+    cv2.ellipse(mask, center, axes, angle, 0, 360, 255, -1)
+    shift = (int(center[0] + rs.choice([-1, 1]) * rs.uniform(0.2, 0.6) * axes[0]), center[1])
+    cv2.ellipse(mask, shift, axes, angle, 0, 360, 0, -1)
+    return mask
+
+def synthetic_mask(size=1024, kind="single", rs=None):
+    """
+    Pneumothorax-like uint8 (0/255) mask.
+    Args:
+        size (int): height and width
+        kind (str): `empty`, `single` (one crescent) or `multi` (2-4 crescents/blobs)
+        rs (np.random.RandomState):
+    Returns:
+        np.ndarray (size, size) uint8
+    """
+    rs = np.random.RandomState(0) if rs is None else rs
+    if kind == "empty":
+        return np.zeros((size, size), dtype=np.uint8)
+    elif kind == "single":
+        return _crescent(size, rs)
+    elif kind == "multi":
+        mask = np.zeros((size, size), dtype=np.uint8)
+        for _ in range(rs.randint(2, 5)):
+            mask |= _crescent(size, rs)
+        return mask
+    raise ValueError("`kind` must be one of {0}".format(MASK_KINDS))
+
+def write_synthetic_dataset(out_dir, n_images=32, size=1024, mask_mix=(0.7, 0.2, 0.1), seed=0):
+    """
+    Writes a synthetic test set of .png images and masks in the layout of the repacked data:
+        out_dir/test/{ImageId}.png, out_dir/masks/{ImageId}.png
+    Existing files are reused, so repeated benchmark runs don't pay for the generation.
+    Args:
+        out_dir (str): output directory
+        n_images (int): number of images
+        size (int): height and width
+        mask_mix (tuple): fractions of `empty`, `single` and `multi` masks
+        seed (int): random seed
+    Returns:
+        dict with the lists `images`, `masks` (filepaths) and `kinds` (mask kind of each image)
+    """
+    rs = np.random.RandomState(seed)
+    kinds = rs.choice(MASK_KINDS, size=n_images, p=np.asarray(mask_mix) / np.sum(mask_mix)).tolist()
+    dataset = {"images": [], "masks": [], "kinds": kinds}
+    for sub_dir in ("test", "masks"):
+        if not os.path.exists(os.path.join(out_dir, sub_dir)):
+            os.makedirs(os.path.join(out_dir, sub_dir))
+    for idx, kind in enumerate(kinds):
+        image_id = "synthetic_{0}_{1:05d}".format(size, idx)
+        image_path = os.path.join(out_dir, "test", image_id + ".png")
+        mask_path = os.path.join(out_dir, "masks", image_id + ".png")
+        if not (os.path.exists(image_path) and os.path.exists(mask_path)):
+            item_rs = np.random.RandomState(seed * 100003 + idx)
+            Image.fromarray(synthetic_radiograph(size, item_rs)).save(image_path)
+            Image.fromarray(synthetic_mask(size, kind, item_rs)).save(mask_path)
+        dataset["images"].append(image_path)
+        dataset["masks"].append(mask_path)
+    return dataset
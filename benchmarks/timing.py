@@ -0,0 +1,107 @@
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import contextlib
+import numpy as np
+
+PERCENTILES = (50, 90, 99)
+
+@contextlib.contextmanager
+def silenced():
+    """
+    Sends stdout and stderr (Keras progress bars, tqdm, `print`s) to os.devnull, so that the timings don't
+    depend on the terminal.
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), \
+            contextlib.redirect_stderr(devnull):
+        yield
+
+def time_fn(fn, n_warmup=2, n_repeats=10, setup=None, quiet=True):
+    """
+    Times a function with warmup runs.
+    Args:
+        fn (function): called without arguments (or with the output of `setup`)
+        n_warmup (int): number of untimed runs (graph tracing, caches, lazy imports)
+        n_repeats (int): number of timed runs
+        setup (function): called before every run, outside of the timing; its output is passed to `fn`
+            (i.e. to copy an input that `fn` modifies in place)
+        quiet (bool): whether or not to silence the output of `fn` (see `silenced`)
+    Returns:
+        dict with `n_repeats`, `mean_ms`, `std_ms`, `min_ms`, `max_ms` and `p{50, 90, 99}_ms`
+    """
+    def run():
+        if setup is None:
+            start = time.perf_counter()
+            fn()
+        else:
+            args = setup()
+            start = time.perf_counter()
+            fn(args)
+        return (time.perf_counter() - start) * 1000
+    with silenced() if quiet else contextlib.ExitStack():
+        for _ in range(n_warmup):
+            run()
+        times = np.array([run() for _ in range(n_repeats)])
+    stats = {"n_repeats": n_repeats, "mean_ms": float(times.mean()), "std_ms": float(times.std()),
+             "min_ms": float(times.min()), "max_ms": float(times.max())}
+    for q in PERCENTILES:
+        stats["p{0}_ms".format(q)] = float(np.percentile(times, q))
+    return stats
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment_info():
+    """
+    Where the results come from: commit, versions and machine.
+    """
+    info = {"commit": _git_commit(), "python": platform.python_version(), "numpy": np.__version__,
+            "platform": platform.platform(), "cpu_count": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    if "tensorflow" in sys.modules:
+        info["tensorflow"] = sys.modules["tensorflow"].__version__
+    return info
+
+class BenchmarkSuite(object):
+    """
+    Collects the stage timings of a benchmark run and writes them as JSON:
+        {"environment": {...}, "config": {...}, "results": {stage: {"mean_ms", "p50_ms", ..., "per_item_ms"}}}
+    Attributes:
+        config (dict): parameters of the run (recorded with the results)
+        n_warmup (int): see `time_fn`
+        n_repeats (int): see `time_fn`
+    """
+    def __init__(self, config=None, n_warmup=2, n_repeats=10):
+        self.config = {} if config is None else dict(config)
+        self.n_warmup = n_warmup
+        self.n_repeats = n_repeats
+        self.results = {}
+
+    def time(self, stage, fn, n_items=1, setup=None, n_repeats=None, quiet=True):
+        """
+        Times one stage. `n_items` (i.e. the number of images) adds the per item time to the results.
+        """
+        n_repeats = self.n_repeats if n_repeats is None else n_repeats
+        stats = time_fn(fn, n_warmup=self.n_warmup, n_repeats=n_repeats, setup=setup, quiet=quiet)
+        stats["n_items"] = n_items
+        stats["per_item_ms"] = stats["p50_ms"] / n_items
+        self.results[stage] = stats
+        print("{0:<32} p50 {1:>10.2f} ms  p90 {2:>10.2f} ms  ({3:.2f} ms/item)".format(
+            stage, stats["p50_ms"], stats["p90_ms"], stats["per_item_ms"]))
+        return stats
+
+    def to_dict(self):
+        return {"environment": environment_info(), "config": self.config, "results": self.results}
+
+    def save(self, fpath):
+        with open(fpath, "w") as fp:
+            json.dump(self.to_dict(), fp, indent=2, sort_keys=True)
+        print("Saved the results to {0}".format(fpath))
+        return fpath
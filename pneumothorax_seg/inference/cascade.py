@@ -8,7 +8,7 @@ from .utils import *
 def create_submission(classification_model, seg_model, test_fpaths=None, classification_channels=3,
                       seg_channels=3, classification_img_size=256, seg_img_size=256, batch_size=32, tta=True,
                       classification_thresh=0.5, seg_thresh=0.5, seg_preprocess_fn=None, seg_preprocess_kwargs={},
-                      classify_csv_fpath=None,):
+                      classify_csv_fpath=None, seg_min_area=1024*2):
     """
     Performs the cascade. All non-pneumothorax predictions are "-1". All pneumothorax patients
     are then passed to the segmentation model to generate the predicted mask, which is then
@@ -28,5 +28,6 @@ def create_submission(classification_model, seg_model, test_fpaths=None, classif
         sub_df = pd.read_csv(classify_csv_fpath)
     # Stage 2: Segmentation
     _ = Stage2(seg_model, sub_df, test_fpaths, channels=seg_channels, img_size=seg_img_size,
-               batch_size=batch_size, tta=tta, threshold=seg_thresh, preprocess_fn=seg_preprocess_fn,
+               batch_size=batch_size, tta=tta, threshold=seg_thresh, min_area=seg_min_area,
+               preprocess_fn=seg_preprocess_fn,
                **seg_preprocess_kwargs)
@@ -9,6 +9,7 @@ from functools import partial
 from pneumothorax_seg.io.data_aug import data_augmentation
 from pneumothorax_seg.inference.utils import load_input, batch_test_fpaths
 from pneumothorax_seg.io.utils import preprocess_input
+from pneumothorax_seg.inference.submission import write_submission
 
 def Stage1(classification_model, test_fpaths, channels=3, img_size=256, batch_size=32,
            fpaths_batch_size=320, tta=True, n_tta_iter_per_image=4, tta_then_preprocess=True,
@@ -83,7 +84,8 @@ def Stage1(classification_model, test_fpaths, channels=3, img_size=256, batch_si
     print("Stage 1 Completed.")
     return sub_df
 
-def create_thresholded_classification_csv(pred_arr, test_ids, threshold=0.5):
+def create_thresholded_classification_csv(pred_arr, test_ids, threshold=0.5,
+                                          save_path="submission_classification.csv"):
     """
     Creates the thresholded version of the classification predictions data frame (csv).
     Args:
@@ -91,8 +93,9 @@ def create_thresholded_classification_csv(pred_arr, test_ids, threshold=0.5):
             corresponding to each test_id.
         test_ids (list): dicom ids corresponding to each predicted probability
         threshold (float): threshold
+        save_path (str): path to the .csv
     Returns:
-        None
+        sub_df (pd.DataFrame): the classification submission data frame (input to `Stage2`)
     """
     # thresholding
     pred_arr[pred_arr >= threshold] = 1
@@ -101,9 +104,7 @@ def create_thresholded_classification_csv(pred_arr, test_ids, threshold=0.5):
     preds_classify = [int(pred) for pred in pred_arr.tolist()]
     # creating first df
     sub_df = pd.DataFrame({"ImageId": test_ids, "EncodedPixels": preds_classify})
-    save_path = os.path.join(os.getcwd(), "submission_classification.csv")
-    sub_df.to_csv(save_path, index=False)
-    print("Classification csv saved at {0}.".format(save_path))
+    write_submission(save_path, test_ids, preds_classify)
     return sub_df
 
 def run_classification_prediction(x_test, classification_model, batch_size=32, tta=True,
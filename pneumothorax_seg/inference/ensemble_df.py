@@ -5,6 +5,7 @@ import skimage
 
 from tqdm import tqdm
 from pneumothorax_seg.inference.mask_functions import *
+from pneumothorax_seg.inference.submission import write_submission
 
 def ensemble_segmentation_from_sub(df_sub_list, min_solutions=3):
     """
@@ -84,18 +85,15 @@ def ensemble_classification_from_df(df_path_list, threshold=0.5):
     print("Ensembled classification predictions saved at {0}".format(ensemble_csv_path))
     return ensembled_df
 
-def create_classification_p_df(pred_act, test_ids):
+def create_classification_p_df(pred_act, test_ids, save_path="classification_probabilities.csv"):
     """
     Saves predicted classification probabilities as a csv
     Args:
         pred_arr (np.ndarray): 1D numpy array of predicted probabilities for each image
             corresponding to each test_id.
         test_ids (list): dicom ids corresponding to each predicted probability
+        save_path (str): path to the .csv
     Returns:
         None
     """
-    pred_act = pred_act.tolist()
-    # creating probability df
-    sub_df = pd.DataFrame({"ImageId": test_ids, "EncodedPixels": pred_act})
-    sub_df.to_csv("classification_probabilities.csv", index=False)
-    print("Classification probabilities saved at {0}".format(os.path.join(os.getcwd(), "classification_probabilities.csv")))
+    write_submission(save_path, test_ids, pred_act.tolist())
@@ -0,0 +1,201 @@
+import numpy as np
+import pandas as pd
+import cv2
+
+from PIL import Image
+from tqdm import tqdm
+from functools import partial
+
+from pneumothorax_seg.inference.utils import load_input, batch_test_fpaths
+from pneumothorax_seg.io.utils import preprocess_input
+
+def per_image_counts(y_true, y_pred):
+    """
+    Per-image pixel counts for a stack of binary masks.
+    Args:
+        y_true (np.ndarray): ground truth masks with shape (N, H, W); anything > 0 is positive
+        y_pred (np.ndarray): thresholded predictions with shape (N, H, W); anything > 0 is positive
+    Returns:
+        tuple (true, pred, intersection) of int64 arrays with shape (N,)
+    """
+    n = y_true.shape[0]
+    t = np.reshape(y_true, (n, -1)) > 0
+    p = np.reshape(y_pred, (n, -1)) > 0
+    true = np.count_nonzero(t, axis=1)
+    pred = np.count_nonzero(p, axis=1)
+    intersection = np.count_nonzero(t & p, axis=1)
+    return (true, pred, intersection)
+
+def dice_from_counts(true, pred, intersection):
+    """
+    Competition Dice from pixel counts (broadcastable arrays). Empty ground truth and empty prediction
+    is a perfect score.
+    """
+    denom = np.asarray(true + pred, dtype=np.float64)
+    dice = 2. * intersection / np.maximum(denom, 1)
+    return np.where(denom == 0, 1., dice)
+
+def per_image_dice(y_true, y_pred):
+    """
+    Per-image Dice (the Kaggle metric before averaging) for a stack of binary masks.
+    Args:
+        y_true (np.ndarray): ground truth masks with shape (N, H, W)
+        y_pred (np.ndarray): thresholded predictions with shape (N, H, W)
+    Returns:
+        dice (np.ndarray): shape (N,)
+    """
+    return dice_from_counts(*per_image_counts(y_true, y_pred))
+
+def kaggle_dice(y_true, y_pred):
+    """
+    Mean per-image Dice (the competition metric).
+    """
+    return per_image_dice(y_true, y_pred).mean()
+
+def threshold_pixel_counts(probs, masks, thresholds):
+    """
+    Counts the predicted positive pixels and the true positive pixels for every image at every threshold
+    in one pass. Each pixel is binned once against the sorted thresholds (pixels >= threshold are positive,
+    like in `inference.segmentation`) and the per-image histograms are reverse cumulatively summed.
+    Args:
+        probs (np.ndarray): probability maps with shape (N, H, W)
+        masks (np.ndarray): ground truth masks with shape (N, H, W); anything > 0 is positive
+        thresholds (np.ndarray): sorted 1D array of thresholds with shape (T,)
+    Returns:
+        tuple (true, pred, intersection) where true has shape (N,) and the other two have shape (N, T)
+    """
+    n, n_thresh = probs.shape[0], len(thresholds)
+    flat_p = np.reshape(probs, (n, -1))
+    flat_t = np.reshape(masks, (n, -1)) > 0
+    # bin b means the pixel is >= thresholds[:b]
+    bins = np.searchsorted(thresholds, flat_p, side="right")
+    bins += np.arange(n)[:, None] * (n_thresh+1)
+    hist_all = np.bincount(bins.ravel(), minlength=n*(n_thresh+1)).reshape(n, n_thresh+1)
+    hist_pos = np.bincount(bins[flat_t], minlength=n*(n_thresh+1)).reshape(n, n_thresh+1)
+    # number of pixels >= thresholds[k] is the number of pixels in bins > k
+    pred = np.cumsum(hist_all[:, ::-1], axis=1)[:, ::-1][:, 1:]
+    intersection = np.cumsum(hist_pos[:, ::-1], axis=1)[:, ::-1][:, 1:]
+    true = hist_pos.sum(axis=1)
+    return (true, pred, intersection)
+
+def grid_dice_from_counts(true, pred, intersection, min_areas):
+    """
+    Per-image Dice for every (threshold, min_area) pair. Predictions with less than `min_area` pixels are
+    zeroed out, like `inference.segmentation.zero_out_thresholded_single`.
+    Args:
+        true (np.ndarray): shape (N,)
+        pred (np.ndarray): shape (N, T)
+        intersection (np.ndarray): shape (N, T)
+        min_areas (np.ndarray): shape (A,)
+    Returns:
+        dice (np.ndarray): shape (N, T, A)
+    """
+    dice_kept = dice_from_counts(true[:, None], pred, intersection)
+    # zeroed out predictions are only correct for empty ground truths
+    dice_zeroed = (true == 0).astype(np.float64)
+    keep = pred[:, :, None] >= np.asarray(min_areas)[None, None, :]
+    return np.where(keep, dice_kept[:, :, None], dice_zeroed[:, None, None])
+
+def sweep_postprocessing(probs, masks, thresholds=None, min_areas=(0,), chunk_size=64):
+    """
+    Evaluates the mean per-image Dice over a (threshold x min_area) grid without re-thresholding the
+    probability maps for each setting. Works on memory-mapped arrays by processing `chunk_size` images
+    at a time.
+    Args:
+        probs (np.ndarray): probability maps with shape (N, H, W)
+        masks (np.ndarray): ground truth masks with shape (N, H, W), same resolution as `probs`
+        thresholds (list/np.ndarray): thresholds to evaluate. Defaults to 0.05 to 0.95 in steps of 0.05.
+        min_areas (list/np.ndarray): minimum number of predicted pixels (at the resolution of `probs`)
+        chunk_size (int): number of images to process at a time
+    Returns:
+        pd.DataFrame with the columns `threshold`, `min_area` and `dice`, sorted from best to worst
+    """
+    if thresholds is None:
+        thresholds = np.arange(0.05, 1., 0.05)
+    thresholds = np.sort(np.asarray(thresholds, dtype=np.float32))
+    min_areas = np.asarray(min_areas)
+    assert probs.shape[0] == masks.shape[0], "The number of probability maps and masks must match."
+    dice_sum = np.zeros((len(thresholds), len(min_areas)))
+    for start in tqdm(range(0, probs.shape[0], chunk_size)):
+        counts = threshold_pixel_counts(np.asarray(probs[start:start+chunk_size]),
+                                        np.asarray(masks[start:start+chunk_size]), thresholds)
+        dice_sum += grid_dice_from_counts(*counts, min_areas).sum(axis=0)
+    dice = dice_sum / probs.shape[0]
+    thresh_grid, area_grid = np.meshgrid(thresholds, min_areas, indexing="ij")
+    results_df = pd.DataFrame({"threshold": thresh_grid.ravel(), "min_area": area_grid.ravel(),
+                               "dice": dice.ravel()})
+    return results_df.sort_values("dice", ascending=False).reset_index(drop=True)
+
+def load_probability_maps(fpath):
+    """
+    Memory-maps saved probability maps (i.e. `predicted_probability_masks.npy` from `Stage2` or
+    the output of `cache_probability_maps`) so that nothing is loaded until it is used.
+    """
+    return np.load(fpath, mmap_mode="r")
+
+def load_masks(mask_fpaths, img_size=None):
+    """
+    Loads ground truth .png masks into a (N, H, W) boolean array.
+    Args:
+        mask_fpaths (list): of file paths to the masks; must be in the same order as the probability maps
+        img_size (int): size to resize the masks to (nearest neighbor). Defaults to None (no resizing).
+    Returns:
+        masks (np.ndarray): shape (N, H, W)
+    """
+    masks = []
+    for fpath in mask_fpaths:
+        mask = np.array(Image.open(fpath))
+        if img_size is not None and mask.shape[:2] != (img_size, img_size):
+            mask = cv2.resize(mask, (img_size, img_size), interpolation=cv2.INTER_NEAREST)
+        masks.append(mask > 0)
+    return np.stack(masks)
+
+def cache_probability_maps(seg_model, fpaths, save_path, channels=3, img_size=256, batch_size=32,
+                           fpaths_batch_size=320, tta=True, preprocess_fn=None, **kwargs):
+    """
+    Runs inference once and writes the float16 probability maps to a .npy file, so that thresholds
+    and minimum areas can be tuned offline with `sweep_postprocessing`.
+    Args:
+        seg_model (a single tf.keras.model.Model or a list of them): see `run_seg_prediction`
+        fpaths (list): of file paths to the (validation) images
+        save_path (str): path to the .npy file to create
+        channels (int): The number of input channels. Defaults to 3.
+        img_size (int): The size of each square input image. Defaults to 256.
+        batch_size (int): model prediction batch size
+        fpaths_batch_size (int): number of images to load into memory at a time.
+        tta (boolean): whether or not to apply test-time augmentation.
+        preprocess_fn (function): function to preprocess the arrays with. Specify the other arguments
+            with **kwargs.
+    Returns:
+        probs (np.memmap): shape (N, img_size, img_size)
+    """
+    from pneumothorax_seg.inference.segmentation import run_seg_prediction
+    preprocess_fn = partial(preprocess_input, model_name=None) if preprocess_fn is None else preprocess_fn
+    probs = np.lib.format.open_memmap(save_path, mode="w+", dtype=np.float16,
+                                      shape=(len(fpaths), img_size, img_size))
+    idx = 0
+    for fpaths_batch in batch_test_fpaths(fpaths, batch_size=fpaths_batch_size):
+        x = np.asarray([load_input(fpath, img_size, channels=channels) for fpath in fpaths_batch])
+        x = preprocess_fn(x, **kwargs)
+        preds = run_seg_prediction(x, seg_model, batch_size=batch_size, tta=tta)
+        preds = np.reshape(preds, (len(fpaths_batch), img_size, img_size))
+        probs[idx:idx+len(fpaths_batch)] = preds
+        idx += len(fpaths_batch)
+    probs.flush()
+    print("Saved the probability maps at {0}".format(save_path))
+    return probs
+
+def evaluate_fold(probs_path, mask_fpaths, thresholds=None, min_areas=(0,), chunk_size=64):
+    """
+    Offline evaluation of the Kaggle metric on a validation fold from saved probability maps.
+    Args:
+        probs_path (str): path to the saved probability maps (.npy) with shape (N, H, W)
+        mask_fpaths (list): of file paths to the ground truth masks (same order as the maps)
+        thresholds, min_areas, chunk_size: see `sweep_postprocessing`
+    Returns:
+        pd.DataFrame: see `sweep_postprocessing`
+    """
+    probs = load_probability_maps(probs_path)
+    masks = load_masks(mask_fpaths, img_size=probs.shape[1])
+    return sweep_postprocessing(probs, masks, thresholds=thresholds, min_areas=min_areas,
+                                chunk_size=chunk_size)
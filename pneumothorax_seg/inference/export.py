@@ -0,0 +1,288 @@
+import os
+import json
+import time
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras.backend as K
+
+from tensorflow.keras.layers import Conv2D, Conv2DTranspose, DepthwiseConv2D, BatchNormalization, Dropout, \
+                                    SpatialDropout2D, GaussianNoise, GaussianDropout, Activation, Lambda
+from tensorflow.keras.models import Model, clone_model
+
+# layers that are the identity at inference time
+TRAINING_ONLY_LAYERS = (Dropout, SpatialDropout2D, GaussianNoise, GaussianDropout)
+
+def _is_training_only(layer):
+    # DropConnect (efficientnet.layers) is duck-typed so that other drop path layers are stripped too
+    return isinstance(layer, TRAINING_ONLY_LAYERS) or hasattr(layer, "drop_connect_rate")
+
+def _inbound_layer(layer):
+    history = layer.input._keras_history
+    return history[0]
+
+def find_foldable_pairs(model):
+    """
+    Finds the BatchNormalization layers that directly follow a Conv2D/Conv2DTranspose/DepthwiseConv2D whose output
+    isn't used anywhere else, so that the BN can be folded into the convolution's kernel and bias.
+    BNs after activations/additions (i.e. in `uefficientnet.model_utils.residual_block`) can't be folded
+    into the preceding convolution and are kept (they run as a fused inference-mode affine transform).
+    Returns:
+        dict of {conv layer name: bn layer name}
+    """
+    pairs = {}
+    for layer in model.layers:
+        if not isinstance(layer, BatchNormalization) or len(layer._inbound_nodes) != 1:
+            continue
+        if layer.axis not in (-1, [-1], [3], 3):
+            continue
+        conv = _inbound_layer(layer)
+        if not isinstance(conv, (Conv2D, DepthwiseConv2D)) or conv.activation not in (None, tf.keras.activations.linear):
+            continue
+        if len(conv._inbound_nodes) == 1 and len(conv._outbound_nodes) == 1:
+            pairs[conv.name] = layer.name
+    return pairs
+
+def fold_batchnorm_weights(conv, bn):
+    """
+    Folds an inference-mode BatchNormalization into the weights of the preceding convolution:
+        W' = W * gamma / sqrt(var + eps)
+        b' = (b - mean) * gamma / sqrt(var + eps) + beta
+    Args:
+        conv (Conv2D, Conv2DTranspose or DepthwiseConv2D):
+        bn (BatchNormalization):
+    Returns:
+        list [kernel, bias] of float32 np.ndarrays
+    """
+    kernel = K.get_value(conv.depthwise_kernel if isinstance(conv, DepthwiseConv2D) else conv.kernel)
+    n_out = K.get_value(bn.moving_mean).shape[0]
+    bias = K.get_value(conv.bias) if conv.use_bias else np.zeros(n_out, dtype=np.float32)
+    gamma = K.get_value(bn.gamma) if bn.scale else np.ones(n_out, dtype=np.float32)
+    beta = K.get_value(bn.beta) if bn.center else np.zeros(n_out, dtype=np.float32)
+    scale = gamma / np.sqrt(K.get_value(bn.moving_variance) + bn.epsilon)
+    if isinstance(conv, DepthwiseConv2D):
+        # (kh, kw, in_channels, depth_multiplier); output channel = in_channel * depth_multiplier + m
+        folded_kernel = kernel * scale.reshape(kernel.shape[2], kernel.shape[3])
+    elif isinstance(conv, Conv2DTranspose):
+        # (kh, kw, out_channels, in_channels); Conv2DTranspose subclasses Conv2D, so it's checked first
+        folded_kernel = kernel * scale[:, None]
+    else:
+        folded_kernel = kernel * scale
+    folded_bias = (bias - K.get_value(bn.moving_mean)) * scale + beta
+    return [folded_kernel.astype(np.float32), folded_bias.astype(np.float32)]
+
+def fold_model(model):
+    """
+    Creates an inference-only copy of a functional model (i.e. UEfficientNet, UEfficientNetpp, the
+    classification models) with:
+        * every foldable BatchNormalization folded into the preceding Conv2D/Conv2DTranspose/DepthwiseConv2D (see
+          `find_foldable_pairs`)
+        * Dropout, DropConnect and noise layers removed
+    The folded BNs and the training-only layers are replaced with identity (`linear`) activations, which are
+    pruned when the graph is frozen (`freeze_model`). Nested models are folded recursively.
+    Args:
+        model (tf.keras.models.Model): model with the trained weights
+    Returns:
+        folded (tf.keras.models.Model): computes the same outputs as `model` in inference mode
+    """
+    pairs = find_foldable_pairs(model)
+    folded_bns = set(pairs.values())
+    nested = {}
+
+    def clone_layer(layer):
+        if layer.name in folded_bns or _is_training_only(layer):
+            return Activation("linear", name=layer.name)
+        if isinstance(layer, Model):
+            nested[layer.name] = fold_model(layer)
+            return nested[layer.name]
+        if isinstance(layer, Lambda):
+            # reuses the python function instead of (de)serializing its bytecode
+            return Lambda(layer.function, arguments=layer.arguments, name=layer.name)
+        config = layer.get_config()
+        if layer.name in pairs:
+            config["use_bias"] = True
+        return layer.__class__.from_config(config)
+
+    folded = clone_model(model, clone_function=clone_layer)
+    for layer in model.layers:
+        if layer.name in nested or layer.name in folded_bns or _is_training_only(layer) or not layer.weights:
+            continue
+        new_layer = folded.get_layer(layer.name)
+        if layer.name in pairs:
+            new_layer.set_weights(fold_batchnorm_weights(layer, model.get_layer(pairs[layer.name])))
+        else:
+            new_layer.set_weights(layer.get_weights())
+    print("Folded {0} BatchNormalization layers into convolutions.".format(len(pairs)))
+    return folded
+
+def freeze_model(model):
+    """
+    Converts the variables of `model` to constants and strips the training/identity nodes from the graph.
+    Returns:
+        tuple (graph_def, input_name, output_name)
+    """
+    if tf.executing_eagerly():
+        from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+        input_spec = tf.TensorSpec(model.inputs[0].shape, model.inputs[0].dtype)
+        concrete_fn = tf.function(lambda x: model(x, training=False)).get_concrete_function(input_spec)
+        frozen_fn = convert_variables_to_constants_v2(concrete_fn)
+        graph_def = frozen_fn.graph.as_graph_def()
+        input_name, output_name = frozen_fn.inputs[0].name, frozen_fn.outputs[0].name
+    else:
+        sess = K.get_session()
+        output_node = model.outputs[0].op.name
+        graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(),
+                                                                           [output_node])
+        input_name, output_name = model.inputs[0].name, model.outputs[0].name
+    graph_def = tf.compat.v1.graph_util.remove_training_nodes(graph_def, protected_nodes=[output_name.split(":")[0]])
+    return (graph_def, input_name, output_name)
+
+def export_model(model, export_dir, weights_path=None, save_saved_model=True):
+    """
+    Exports a trained model for inference:
+        export_dir/frozen_graph.pb: frozen (constant) GraphDef with the BatchNormalization layers folded into the
+            convolutions and without Dropout/DropConnect
+        export_dir/export_info.json: the input/output tensor names, input shape and dtype of the frozen graph
+        export_dir/saved_model/: SavedModel of the folded model (if `save_saved_model`)
+    Load the frozen graph with `load_frozen_model`.
+    Args:
+        model (tf.keras.models.Model or function): model or a function that builds it, i.e.
+            functools.partial(UEfficientNetpp, input_shape=(256, 256, 3))
+        export_dir (str): directory to export to (created if it doesn't exist)
+        weights_path (str): path to the weights to load into `model`. Defaults to None (use the current weights).
+        save_saved_model (bool): whether or not to also write a SavedModel
+    Returns:
+        folded (tf.keras.models.Model): the folded model
+    """
+    if not isinstance(model, Model):
+        if not tf.executing_eagerly():
+            # bakes the inference-mode branches into the graph
+            K.set_learning_phase(0)
+        model = model()
+    if weights_path is not None:
+        model.load_weights(weights_path)
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+    folded = fold_model(model)
+    graph_def, input_name, output_name = freeze_model(folded)
+    tf.io.write_graph(graph_def, export_dir, "frozen_graph.pb", as_text=False)
+    export_info = {"input_name": input_name, "output_name": output_name,
+                   "input_shape": list(K.int_shape(folded.inputs[0])),
+                   "input_dtype": tf.as_dtype(folded.inputs[0].dtype).name}
+    with open(os.path.join(export_dir, "export_info.json"), "w") as fp:
+        json.dump(export_info, fp)
+    if save_saved_model:
+        saved_model_dir = os.path.join(export_dir, "saved_model")
+        if tf.executing_eagerly():
+            tf.saved_model.save(folded, saved_model_dir)
+        else:
+            tf.compat.v1.saved_model.simple_save(K.get_session(), saved_model_dir,
+                                                 inputs={"input": folded.inputs[0]},
+                                                 outputs={"output": folded.outputs[0]})
+    print("Exported the model to {0} ({1} nodes in the frozen graph).".format(export_dir, len(graph_def.node)))
+    return folded
+
+class FrozenGraphModel(object):
+    """
+    Runs an exported frozen graph with the `predict`/`predict_on_batch` interface of a tf.keras model,
+    so it can be passed as `seg_model` to `inference.segmentation.run_seg_prediction`.
+    Args:
+        graph_def (tf.compat.v1.GraphDef): the frozen graph
+        input_name (str): name of the input tensor
+        output_name (str): name of the output tensor
+    """
+    def __init__(self, graph_def, input_name, output_name):
+        if tf.executing_eagerly():
+            import_fn = tf.compat.v1.wrap_function(lambda: tf.compat.v1.import_graph_def(graph_def, name=""), [])
+            input_tensor = import_fn.graph.get_tensor_by_name(input_name)
+            self._fn = import_fn.prune(input_tensor, import_fn.graph.get_tensor_by_name(output_name))
+            self._run = lambda x: self._fn(tf.constant(x)).numpy()
+        else:
+            self.graph = tf.Graph()
+            with self.graph.as_default():
+                tf.compat.v1.import_graph_def(graph_def, name="")
+            self.sess = tf.compat.v1.Session(graph=self.graph)
+            input_tensor = self.graph.get_tensor_by_name(input_name)
+            output_tensor = self.graph.get_tensor_by_name(output_name)
+            self._run = lambda x: self.sess.run(output_tensor, feed_dict={input_tensor: x})
+        self.inputs = [input_tensor]
+
+    def predict_on_batch(self, x):
+        return self._run(np.asarray(x, dtype=self.inputs[0].dtype.as_numpy_dtype))
+
+    def predict(self, x, batch_size=32, **kwargs):
+        return np.concatenate([self.predict_on_batch(x[start:start+batch_size])
+                               for start in range(0, len(x), batch_size)])
+
+def load_frozen_model(export_dir):
+    """
+    Loads a graph exported with `export_model`.
+    Returns:
+        FrozenGraphModel
+    """
+    with open(os.path.join(export_dir, "export_info.json"), "r") as fp:
+        export_info = json.load(fp)
+    graph_def = tf.compat.v1.GraphDef()
+    with tf.io.gfile.GFile(os.path.join(export_dir, "frozen_graph.pb"), "rb") as fp:
+        graph_def.ParseFromString(fp.read())
+    return FrozenGraphModel(graph_def, export_info["input_name"], export_info["output_name"])
+
+def benchmark_latency(predict_fns, x, n_warmup=3, n_runs=20):
+    """
+    Measures the latency of prediction functions on the same batch.
+    Args:
+        predict_fns (dict): of {name: function that takes a batch}
+        x (np.ndarray): input batch
+        n_warmup (int): number of untimed runs
+        n_runs (int): number of timed runs
+    Returns:
+        dict of {name: {`mean_ms`, `median_ms`, `p90_ms`}}
+    """
+    results = {}
+    for name, predict_fn in predict_fns.items():
+        for _ in range(n_warmup):
+            predict_fn(x)
+        times = []
+        for _ in range(n_runs):
+            start = time.perf_counter()
+            predict_fn(x)
+            times.append((time.perf_counter() - start) * 1000)
+        results[name] = {"mean_ms": float(np.mean(times)), "median_ms": float(np.median(times)),
+                         "p90_ms": float(np.percentile(times, 90))}
+        print("{0}: {1:.2f} ms (median), {2:.2f} ms (p90)".format(name, results[name]["median_ms"],
+                                                                 results[name]["p90_ms"]))
+    return results
+
+def benchmark_export(model, exported, input_shape, batch_size=1, n_runs=20, seed=0):
+    """
+    CPU latency of the original model vs. the exported one (`FrozenGraphModel` or the folded model),
+    along with the largest output difference between the two.
+    Args:
+        model (tf.keras.models.Model): the original model
+        exported: the exported model (anything with `predict_on_batch`)
+        input_shape (tuple): (h, w, n_channels)
+        batch_size (int): batch size to time
+        n_runs (int): number of timed runs
+        seed (int): random seed for the inputs
+    Returns:
+        dict with the latencies (see `benchmark_latency`), `speedup` and `max_abs_diff`
+    """
+    x = np.random.RandomState(seed).uniform(0, 1, size=(batch_size,) + tuple(input_shape)).astype(np.float32)
+    with tf.device("/cpu:0"):
+        max_abs_diff = float(np.abs(model.predict_on_batch(x) - exported.predict_on_batch(x)).max())
+        results = benchmark_latency({"original": model.predict_on_batch, "exported": exported.predict_on_batch},
+                                    x, n_runs=n_runs)
+    results["speedup"] = results["original"]["median_ms"] / results["exported"]["median_ms"]
+    results["max_abs_diff"] = max_abs_diff
+    print("Speedup: {0:.2f}x (max abs. difference: {1:.2e})".format(results["speedup"], max_abs_diff))
+    return results
+
+if __name__ == "__main__":
+    import tempfile
+    from pneumothorax_seg.models.efficientnet.models import EfficientNetB0
+    from tensorflow.keras.layers import Dense
+
+    base = EfficientNetB0(include_top=False, weights=None, input_shape=(128, 128, 3), pooling="avg")
+    model = Model(base.input, Dense(1, activation="sigmoid")(base.output))
+    export_dir = tempfile.mkdtemp()
+    export_model(model, export_dir)
+    benchmark_export(model, load_frozen_model(export_dir), (128, 128, 3), batch_size=4)
@@ -0,0 +1,215 @@
+import os
+import time
+import queue
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras.backend as K
+
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from pneumothorax_seg.io.utils import preprocess_input
+from pneumothorax_seg.inference.segmentation import run_seg_prediction
+from pneumothorax_seg.inference.evaluation import per_image_dice
+
+def representative_dataset(generator, n_samples=200, preprocess_fn=None, **kwargs):
+    """
+    Creates the calibration data for post-training quantization from a `SegmentationGenerator` (or any
+    keras Sequence of (x, y) batches). The inputs are preprocessed like at inference time.
+    Args:
+        generator (keras.utils.Sequence): i.e. SegmentationGenerator(train_dir, masks_dir, batch_size,
+            augmentations=None, shuffle=True)
+        n_samples (int): number of images to calibrate with
+        preprocess_fn (function): function to preprocess the arrays with. Defaults to the inference default
+            (int -> float). Specify the other arguments with **kwargs.
+    Returns:
+        function that yields [x] with shape (1, h, w, n_channels), the format of
+        `tf.lite.TFLiteConverter.representative_dataset`
+    """
+    preprocess_fn = partial(preprocess_input, model_name=None) if preprocess_fn is None else preprocess_fn
+    def gen():
+        n_yielded = 0
+        for i in range(len(generator)):
+            x = preprocess_fn(np.asarray(generator[i][0]), **kwargs).astype(np.float32)
+            for sample in x:
+                if n_yielded >= n_samples:
+                    return
+                yield [sample[None]]
+                n_yielded += 1
+    return gen
+
+def quantize_model(model, generator, save_path, input_shape=None, n_samples=200, int8_io=False,
+                   preprocess_fn=None, **kwargs):
+    """
+    Full integer (int8 weights and activations) post-training quantization to a .tflite model.
+    Args:
+        model (tf.keras.models.Model): trained float model
+        generator (keras.utils.Sequence): calibration data (see `representative_dataset`)
+        save_path (str): path to the .tflite file to write
+        input_shape (tuple): (h, w, n_channels) to fix the input to. Required when the model's spatial
+            dimensions are None (i.e. the UEfficientNet defaults). Defaults to None (use the model's).
+        n_samples (int): number of calibration images
+        int8_io (bool): whether or not the model inputs/outputs are int8 too. Defaults to False (float32 inputs
+            and outputs with (de)quantization in the graph), which is a drop-in for the float model.
+        preprocess_fn (function): see `representative_dataset`
+    Returns:
+        tflite_model (bytes)
+    """
+    input_shape = tuple(input_shape) if input_shape is not None else tuple(K.int_shape(model.inputs[0])[1:])
+    if None in input_shape:
+        raise ValueError("Specify a fixed `input_shape`; the model input shape is {0}".format(input_shape))
+    if tf.executing_eagerly():
+        concrete_fn = tf.function(lambda x: model(x, training=False)).get_concrete_function(
+            tf.TensorSpec((1,) + input_shape, tf.float32))
+        try:
+            converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete_fn], model)
+        except TypeError:
+            # tf < 2.7
+            converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete_fn])
+    else:
+        # graph mode; the input shape must be fixed when building the model
+        converter = tf.compat.v1.lite.TFLiteConverter.from_session(K.get_session(), model.inputs, model.outputs)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset(generator, n_samples=n_samples,
+                                                               preprocess_fn=preprocess_fn, **kwargs)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    if int8_io:
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+    tflite_model = converter.convert()
+    with open(save_path, "wb") as fp:
+        fp.write(tflite_model)
+    print("Saved the int8 model at {0} ({1:.1f} MB)".format(save_path, len(tflite_model) / 1e6))
+    return tflite_model
+
+class TFLiteInterpreterPool(object):
+    """
+    Pool of TFLite interpreters for multithreaded CPU inference. `invoke` releases the GIL, so the images
+    of a batch are split over `n_interpreters` threads, each with its own interpreter.
+    Has the `predict`/`predict_on_batch` interface of a tf.keras model, so it can be passed as `seg_model`
+    to `inference.segmentation.run_seg_prediction` (see `run_tflite_seg_prediction`).
+    Args:
+        model_path (str): path to the .tflite model
+        n_interpreters (int): number of interpreters (threads). Defaults to None (os.cpu_count()).
+        num_threads (int): intra-op threads per interpreter. Defaults to 1 (the pool parallelizes over images).
+    """
+    def __init__(self, model_path, n_interpreters=None, num_threads=1):
+        self.model_path = model_path
+        self.n_interpreters = os.cpu_count() if n_interpreters is None else n_interpreters
+        self.interpreters = queue.Queue()
+        for _ in range(self.n_interpreters):
+            try:
+                interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+            except TypeError:
+                # tf < 2.3
+                interpreter = tf.lite.Interpreter(model_path=model_path)
+            interpreter.allocate_tensors()
+            self.interpreters.put(interpreter)
+        interpreter = self.interpreters.queue[0]
+        self.input_details = interpreter.get_input_details()[0]
+        self.output_details = interpreter.get_output_details()[0]
+        # float32 inputs for `models.mixed_precision.cast_inputs`; int8 inputs are quantized in `_invoke`
+        self.inputs = [tf.TensorSpec(self.input_details["shape"], tf.float32)]
+        self.executor = ThreadPoolExecutor(max_workers=self.n_interpreters)
+
+    def _invoke(self, x):
+        """
+        Runs the images in x one at a time on an interpreter from the pool.
+        """
+        interpreter = self.interpreters.get()
+        try:
+            in_scale, in_zero_point = self.input_details["quantization"]
+            out_scale, out_zero_point = self.output_details["quantization"]
+            preds = []
+            for sample in x:
+                sample = sample[None]
+                if self.input_details["dtype"] == np.int8:
+                    sample = np.clip(np.round(sample / in_scale + in_zero_point), -128, 127)
+                interpreter.set_tensor(self.input_details["index"], sample.astype(self.input_details["dtype"]))
+                interpreter.invoke()
+                pred = interpreter.get_tensor(self.output_details["index"])
+                if self.output_details["dtype"] == np.int8:
+                    pred = (pred.astype(np.float32) - out_zero_point) * out_scale
+                preds.append(pred[0])
+            return np.stack(preds)
+        finally:
+            self.interpreters.put(interpreter)
+
+    def predict_on_batch(self, x):
+        chunks = np.array_split(np.asarray(x, dtype=np.float32), min(self.n_interpreters, len(x)))
+        return np.concatenate(list(self.executor.map(self._invoke, chunks)))
+
+    def predict(self, x, batch_size=32, **kwargs):
+        return np.concatenate([self.predict_on_batch(x[start:start+batch_size])
+                               for start in range(0, len(x), batch_size)])
+
+def run_tflite_seg_prediction(x_test, seg_model, batch_size=32, tta=True, n_interpreters=None):
+    """
+    Drop-in replacement for `inference.segmentation.run_seg_prediction` for quantized .tflite models.
+    Args:
+        x_test (np.ndarray): shape (n, x, y, n_channels)
+        seg_model (str, TFLiteInterpreterPool or a list of them): the .tflite model(s). Lists are ensembled.
+        batch_size (int): number of images to split over the interpreters at a time
+        tta (boolean): whether or not to apply test-time augmentation.
+        n_interpreters (int): see `TFLiteInterpreterPool`; only used for paths.
+    Returns:
+        preds_seg (np.ndarray): shape (n, x, y)
+    """
+    to_pool = lambda m: TFLiteInterpreterPool(m, n_interpreters=n_interpreters) if isinstance(m, str) else m
+    if isinstance(seg_model, (list, tuple)):
+        seg_model = [to_pool(m) for m in seg_model]
+    else:
+        seg_model = to_pool(seg_model)
+    return run_seg_prediction(x_test, seg_model, batch_size=batch_size, tta=tta)
+
+def evaluate_quantization(model, tflite_model, val_generator, threshold=0.5, tta=False, batch_size=32,
+                          preprocess_fn=None, **kwargs):
+    """
+    Dice drift and throughput of a quantized model against the float model on a validation fold.
+    Args:
+        model (tf.keras.models.Model): the float model
+        tflite_model (str or TFLiteInterpreterPool): the quantized model
+        val_generator (keras.utils.Sequence): (x, y) batches of the validation fold without augmentations,
+            i.e. SegmentationGenerator(val_dir, masks_dir, batch_size, augmentations=None, shuffle=False)
+        threshold (float): threshold for the predicted probabilities
+        tta (boolean): whether or not to apply test-time augmentation.
+        batch_size (int): model prediction batch size
+        preprocess_fn (function): see `representative_dataset`
+    Returns:
+        dict with the keys
+            `dice_float`, `dice_int8`: mean per-image Dice of each model (no post-processing)
+            `dice_drift`: dice_int8 - dice_float
+            `mask_agreement`: mean per-image Dice between the float and int8 thresholded predictions
+            `float_images_per_s`, `int8_images_per_s`: throughput (including TTA)
+    """
+    preprocess_fn = partial(preprocess_input, model_name=None) if preprocess_fn is None else preprocess_fn
+    if isinstance(tflite_model, str):
+        tflite_model = TFLiteInterpreterPool(tflite_model)
+    dice_float, dice_int8, agreement = [], [], []
+    time_float, time_int8, n_images = 0., 0., 0
+    for i in range(len(val_generator)):
+        x, y = val_generator[i]
+        x = preprocess_fn(np.asarray(x), **kwargs)
+        y = np.reshape(y, y.shape[:3]) > 0.5
+        start = time.perf_counter()
+        preds_float = run_seg_prediction(x, model, batch_size=batch_size, tta=tta).reshape(y.shape)
+        time_float += time.perf_counter() - start
+        start = time.perf_counter()
+        preds_int8 = run_seg_prediction(x, tflite_model, batch_size=batch_size, tta=tta).reshape(y.shape)
+        time_int8 += time.perf_counter() - start
+        mask_float, mask_int8 = preds_float >= threshold, preds_int8 >= threshold
+        dice_float.append(per_image_dice(y, mask_float))
+        dice_int8.append(per_image_dice(y, mask_int8))
+        agreement.append(per_image_dice(mask_float, mask_int8))
+        n_images += len(x)
+    results = {"dice_float": float(np.concatenate(dice_float).mean()),
+               "dice_int8": float(np.concatenate(dice_int8).mean()),
+               "mask_agreement": float(np.concatenate(agreement).mean()),
+               "float_images_per_s": n_images / time_float,
+               "int8_images_per_s": n_images / time_int8}
+    results["dice_drift"] = results["dice_int8"] - results["dice_float"]
+    print("Dice: {0:.4f} (float) vs. {1:.4f} (int8), drift: {2:+.4f}, mask agreement: {3:.4f}".format(
+          results["dice_float"], results["dice_int8"], results["dice_drift"], results["mask_agreement"]))
+    print("Throughput: {0:.1f} images/s (float) vs. {1:.1f} images/s (int8)".format(
+          results["float_images_per_s"], results["int8_images_per_s"]))
+    return results
@@ -6,10 +6,13 @@ from pathlib import Path
 from pneumothorax_seg.inference.mask_functions import *
 from pneumothorax_seg.inference.utils import load_input
 from pneumothorax_seg.io.utils import preprocess_input
+from pneumothorax_seg.models.mixed_precision import cast_inputs
+from pneumothorax_seg.inference.submission import write_submission
 from functools import partial
 
 def Stage2(seg_model, sub_df, test_fpaths, channels=3, img_size=256, batch_size=32, tta=True,
-           threshold=0.5, save_pred_arr_p=True, zero_out_small_pred=True, preprocess_fn=None, **kwargs):
+           threshold=0.5, save_pred_arr_p=True, zero_out_small_pred=True, min_area=1024*2, preprocess_fn=None,
+           save_path="submission_final.csv", **kwargs):
     """
     For the second (segmentation) stage of the classification/segmentation cascade. It assumes that the
     seg_model was trained on pos-only examples.
@@ -29,10 +32,13 @@ def Stage2(seg_model, sub_df, test_fpaths, channels=3, img_size=256, batch_size=
             the predicted masks will be saved as a numpy array in the current working
             directory.
         zero_out_small_pred (bool): whether or not to zero out the smaller predicted ROIs.
+        min_area (int): predictions with fewer positive pixels (at 1024x1024) than this are zeroed out.
+            Tune it with `inference.tuning.tune_postprocessing`. Defaults to 1024*2.
         preprocess_fn (function): function to preprocess the test arrays with. Specify the other arguments
             with **kwargs.
+        save_path (str): path to the final submission .csv
     Returns:
-        None
+        save_path (str)
     """
     # default just converts the input from int -> flaot
     preprocess_fn = partial(preprocess_input, model_name=None) if preprocess_fn is None else preprocess_fn
@@ -65,7 +71,7 @@ def Stage2(seg_model, sub_df, test_fpaths, channels=3, img_size=256, batch_size=
             resized[resized >= threshold] = 1
             resized[resized < threshold] = 0
             if zero_out_small_pred:
-                resized = zero_out_thresholded_single(resized)
+                resized = zero_out_thresholded_single(resized, min_area=min_area)
             # converting to rgb (int, 0-255)
             resized_all.append((resized.T*255).astype(np.uint8))
         preds_seg = np.stack(resized_all)
@@ -75,13 +81,17 @@ def Stage2(seg_model, sub_df, test_fpaths, channels=3, img_size=256, batch_size=
         preds_seg[preds_seg < threshold] = 0
         # zero out smaller regions
         if zero_out_small_pred:
-            preds_seg = zero_out_thresholded_all(preds_seg)
+            preds_seg = zero_out_thresholded_all(preds_seg, min_area=min_area)
         preds_seg = (preds_seg.T*255).astype(np.uint8)
 
-    sub_df = edit_classification_df(sub_df, preds_seg, seg_ids)
-    sub_df.to_csv("submission_final.csv", index=False)
+    # streaming the classification rows with the rles of the positive ids edited in
+    print("Writing the predicted rle's...")
+    rles = {id_: mask2rle(pred, 1024, 1024) for id_, pred in zip(seg_ids, tqdm(preds_seg))}
+    values = [rles.get(id_, value) for id_, value in zip(sub_df["ImageId"], sub_df["EncodedPixels"])]
+    write_submission(save_path, sub_df["ImageId"], values)
 
     print("Stage 2 Completed.")
+    return save_path
 
 def TTA_Segmentation_All(model, test_arrays, batch_size=32):
     """
@@ -117,6 +127,8 @@ def run_seg_prediction(x_test, seg_model, batch_size=32, tta=True):
     Returns:
         preds_seg (np.ndarray): shape (n, x, y); assumes prediction channel is 1, which is squeezed.
     """
+    # float16 inputs for mixed_float16 models, float32 otherwise
+    x_test = cast_inputs(x_test, seg_model)
     # squeezes are for removing the output classes dimension (1, because binary and sigmoid)
     if tta:
         # ensembling with TTA
@@ -157,19 +169,22 @@ def edit_classification_df(df, preds_seg, p_ids):
     df.loc[df.EncodedPixels=="", "EncodedPixels"] = "-1"
     return df
 
-def zero_out_thresholded_all(thresholded):
+def zero_out_thresholded_all(thresholded, min_area=1024*2):
     """
     Zeros out small predicted ROIs in thresholded stacked images with shape: (n, x, y)
     """
     for idx, arr in enumerate(thresholded):
-        thresholded[idx] = zero_out_thresholded_single(arr)
+        thresholded[idx] = zero_out_thresholded_single(arr, min_area=min_area)
     return thresholded
 
-def zero_out_thresholded_single(thresholded):
+def zero_out_thresholded_single(thresholded, min_area=1024*2):
     """
     Zeros out small ROIs in thresholded single images with shape: (x, y)
+    Args:
+        thresholded (np.ndarray): binary (0/1) prediction
+        min_area (int): images with fewer positive pixels than this are zeroed out
     """
     # single images (x, y)
-    if thresholded.sum() < 1024*2:
+    if thresholded.sum() < min_area:
         thresholded[:] = 0
     return thresholded
@@ -1,5 +1,4 @@
 import numpy as np
-import pandas as pd
 import cv2
 import os
 from tqdm import tqdm
@@ -10,12 +9,18 @@ from pneumothorax_seg.inference.mask_functions import mask2rle
 from pneumothorax_seg.inference.utils import load_input, batch_test_fpaths
 from pneumothorax_seg.io.utils import preprocess_input
 from pneumothorax_seg.inference.segmentation import TTA_Segmentation_All, run_seg_prediction, zero_out_thresholded_single
+from pneumothorax_seg.inference.submission import SubmissionShardWriter, merge_shards, write_submission
 
 def SegmentationOnlyInference(seg_model, test_fpaths, channels=3, img_size=256, batch_size=32,
                               fpaths_batch_size=320, tta=True, threshold=0.5, zero_out_small_pred=True,
-                              preprocess_fn=None, **kwargs):
+                              min_area=1024*2, preprocess_fn=None, save_path="submission_final.csv",
+                              shard_dir=None, worker_id=0, n_workers=1, tiler=None, **kwargs):
     """
-    For segmentation-only pipelines.
+    For segmentation-only pipelines. The run-length encodings are streamed to a shard file as they are
+    computed (see `inference.submission`). To split the test set over several processes/machines, run each
+    worker with the same `test_fpaths`, `shard_dir` and `n_workers` and its own `worker_id`; each predicts
+    its contiguous slice of `test_fpaths`. Then merge the shards with
+    `merge_shards(shard_dir, save_path, n_workers=n_workers)`.
 
     Args:
         seg_model (a single tf.keras.model.Model or keras.model.Model or a list of them): assumes
@@ -31,10 +36,20 @@ def SegmentationOnlyInference(seg_model, test_fpaths, channels=3, img_size=256,
         tta (boolean): whether or not to apply test-time augmentation.
         threshold (float): Value to threshold the predicted probabilities at
         zero_out_small_pred (bool): whether or not to zero out the smaller predicted ROIs.
+        min_area (int): predictions with fewer positive pixels (at 1024x1024) than this are zeroed out.
+            `threshold` and `min_area` can be tuned on a validation fold with `inference.tuning.tune_postprocessing`
+            and passed in with `**load_postprocessing_params(...)`. Defaults to 1024*2.
         preprocess_fn (function): function to preprocess the test arrays with. Specify the other arguments
             with **kwargs.
+        save_path (str): path to the submission .csv
+        shard_dir (str): directory for the per-worker shards. Defaults to None (`save_path` + ".shards").
+        worker_id (int): index of this worker
+        n_workers (int): number of workers. With one worker, the shard is merged into `save_path` right away.
+        tiler (inference.tiling.TiledPredictor): predicts tile by tile at the loaded resolution instead of
+            with `run_seg_prediction` (`seg_model` and `tta` are then taken from the tiler). Use it with
+            img_size=1024 to segment at native resolution.
     Returns:
-        sub_df (pd.DataFrame): submission dataframe
+        save_path (str) with one worker, otherwise the path to this worker's shard
     """
     # default just converts the input from int -> flaot
     preprocess_fn = partial(preprocess_input, model_name=None) if preprocess_fn is None else preprocess_fn
@@ -42,51 +57,60 @@ def SegmentationOnlyInference(seg_model, test_fpaths, channels=3, img_size=256,
     print("Commencing the Segmentation of All Test Patients...")
     # assuming full dataset cannot fit into memory
     ## batching test_fpaths; # preserves order
-    test_fpaths_batched = batch_test_fpaths(test_fpaths, batch_size=fpaths_batch_size)
-    rles = []
+    # creating list of str ids (fname without the .dicom or .png) in submission order
+    test_ids = [Path(fpath).stem for fpath in test_fpaths]
+    shard_dir = save_path + ".shards" if shard_dir is None else shard_dir
+    writer = SubmissionShardWriter(shard_dir, order=test_ids, worker_id=worker_id, n_workers=n_workers)
+    start, end = [int(i) for i in np.linspace(0, len(test_fpaths), n_workers + 1)[worker_id:worker_id+2]]
+    test_fpaths_batched = batch_test_fpaths(test_fpaths[start:end], batch_size=fpaths_batch_size)
     for fpaths_batch in test_fpaths_batched:
         x_test = np.asarray([load_input(fpath, img_size, channels=channels)
                              for fpath in fpaths_batch])
         x_test = preprocess_fn(x_test, **kwargs)
 
-        preds_seg = run_seg_prediction(x_test, seg_model, batch_size=batch_size, tta=tta)
+        if tiler is not None:
+            preds_seg = tiler.predict(x_test)
+        else:
+            preds_seg = run_seg_prediction(x_test, seg_model, batch_size=batch_size, tta=tta)
+            # the squeeze in run_seg_prediction also drops the batch axis of single-image batches
+            preds_seg = preds_seg.reshape((len(fpaths_batch),) + preds_seg.shape[-2:])
         # resizing -> threhold -> zero out small roi -> transpose + set 1s to 255 + type convert
-        print("Converting predictions to the submission data frame...")
-        for pred in tqdm(preds_seg):
+        print("Converting predictions to run-length encodings...")
+        for fpath, pred in zip(fpaths_batch, tqdm(preds_seg)):
             # resizing probability maps
             h_w = (pred.shape[0], pred.shape[1])
             if h_w != (1024, 1024):
                 # resizing predictions if necessary
                 arr = cv2.resize(pred, (1024, 1024))
+            else:
+                arr = pred.copy()
             # thresholding to do zeroing out
             arr[arr >= threshold] = 1
             arr[arr < threshold] = 0
             if zero_out_small_pred:
-                arr = zero_out_thresholded_single(arr)
+                arr = zero_out_thresholded_single(arr, min_area=min_area)
             # converting to rgb (int, 0-255) and transposing
             arr = (arr.T*255).astype(np.uint8)
-            rles.append(mask2rle(arr, 1024, 1024))
-    # creating list of str ids (fname without the .dicom or .png)
-    test_ids = [Path(fpath).stem for fpath in test_fpaths]
-    sub_df = create_sub_from_rles(rles, test_ids)
-    sub_df.to_csv("submission_final.csv", index=False)
+            writer.write(Path(fpath).stem, mask2rle(arr, 1024, 1024))
+    shard_path = writer.close()
+    if n_workers > 1:
+        print("Worker {0} done; merge the shards with `merge_shards({1!r}, {2!r}, n_workers={3})`"
+              .format(worker_id, shard_dir, save_path, n_workers))
+        return shard_path
+    merge_shards(shard_dir, save_path, remove_shards=True, n_workers=1)
+    if not os.listdir(shard_dir):
+        os.rmdir(shard_dir)
     print("Done!")
-    return sub_df
+    return save_path
 
-def create_sub_from_rles(rles, test_ids):
+def create_sub_from_rles(rles, test_ids, save_path="submission_segmentation_only.csv"):
     """
     Creates the submission file from rles.
     Args:
         rles (list): of run-length encodings from mask2rle
         test_ids (list): dicom ids corresponding to each predicted mask
+        save_path (str): path to the submission .csv
     Returns:
-        None
+        save_path (str)
     """
-    # creating segmentation rle df
-    sub_df = pd.DataFrame({"ImageId": test_ids, "EncodedPixels": rles})
-    # handling empty masks
-    sub_df.loc[sub_df.EncodedPixels=="", "EncodedPixels"] = "-1"
-    save_path = os.path.join(os.getcwd(), "submission_segmentation_only.csv")
-    sub_df.to_csv(save_path, index=False)
-    print("Segmentation-only csv saved at {0}".format(save_path))
-    return sub_df
+    return write_submission(save_path, test_ids, rles)
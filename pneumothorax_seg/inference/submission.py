@@ -0,0 +1,160 @@
+import os
+import csv
+import glob
+import heapq
+
+HEADER = ("ImageId", "EncodedPixels")
+# bytes; the submissions are written row by row
+BUFFER_SIZE = 1 << 20
+
+def _format_value(value):
+    # empty masks are "-1" in the submission
+    return "-1" if value == "" else value
+
+def write_submission(save_path, image_ids, values, header=HEADER):
+    """
+    Streams (ImageId, EncodedPixels) rows to a submission .csv with the csv module (no DataFrame).
+    Empty run-length encodings are written as "-1".
+    Args:
+        save_path (str): path to the .csv
+        image_ids (iterable): of ImageIds
+        values (iterable): of run-length encodings/labels/probabilities corresponding to each ImageId
+        header (tuple): column names
+    Returns:
+        save_path (str)
+    """
+    with open(save_path, "w", newline="", buffering=BUFFER_SIZE) as fp:
+        writer = csv.writer(fp)
+        writer.writerow(header)
+        writer.writerows((image_id, _format_value(value)) for image_id, value in zip(image_ids, values))
+    print("Submission saved at {0}".format(os.path.abspath(save_path)))
+    return save_path
+
+def shard_path_for(shard_dir, worker_id):
+    return os.path.join(shard_dir, "shard_{0}.csv".format(worker_id))
+
+def list_shards(shard_dir):
+    """
+    Returns:
+        list of (worker_id, shard_path) sorted by worker id
+    """
+    shards = []
+    for shard_path in glob.glob(os.path.join(shard_dir, "shard_*.csv")):
+        shard_id = os.path.basename(shard_path)[len("shard_"):-len(".csv")]
+        if shard_id.isdigit():
+            shards.append((int(shard_id), shard_path))
+    return sorted(shards)
+
+class SubmissionShardWriter(object):
+    """
+    Appends the rows of one inference worker to its own shard (`shard_dir/shard_{worker_id}.csv`), so that
+    workers never share a file. Every row is stored with its position in `order`, the original ImageId
+    order, which `merge_shards` uses to interleave the shards.
+        writer = SubmissionShardWriter(shard_dir, order=test_ids, worker_id=rank, n_workers=world_size)
+        for image_id, rle in worker_predictions:
+            writer.write(image_id, rle)
+        writer.close()
+        # after all workers are done
+        merge_shards(shard_dir, "submission_final.csv", n_workers=world_size)
+    Shards left in `shard_dir` by a previous run that can't belong to this one (worker ids >= `n_workers`) are
+    removed when the writer opens; the shards of workers 0 ... n_workers - 1 are overwritten by those workers.
+    Attributes:
+        shard_dir (str): directory of the shards (created if it doesn't exist)
+        order (list): of all ImageIds in submission order
+        worker_id (int): index of this worker
+        n_workers (int): number of workers writing to `shard_dir` in this run
+    """
+    def __init__(self, shard_dir, order, worker_id=0, n_workers=1):
+        if not 0 <= worker_id < n_workers:
+            raise ValueError("`worker_id` must be in [0, n_workers).")
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir, exist_ok=True)
+        for shard_id, shard_path in list_shards(shard_dir):
+            if shard_id >= n_workers:
+                print("Removing the stale shard {0}".format(shard_path))
+                os.remove(shard_path)
+        self.shard_dir = shard_dir
+        self.positions = {image_id: idx for idx, image_id in enumerate(order)}
+        self.worker_id = worker_id
+        self.shard_path = shard_path_for(shard_dir, worker_id)
+        self._fp = open(self.shard_path, "w", newline="", buffering=BUFFER_SIZE)
+        self._writer = csv.writer(self._fp)
+        self._last_position = -1
+        self._sorted = True
+
+    def write(self, image_id, value):
+        position = self.positions[image_id]
+        self._sorted = self._sorted and position > self._last_position
+        self._last_position = position
+        self._writer.writerow((position, image_id, _format_value(value)))
+
+    def write_rows(self, image_ids, values):
+        for image_id, value in zip(image_ids, values):
+            self.write(image_id, value)
+
+    def close(self):
+        """
+        Closes the shard. A shard that was written out of order is sorted here (the merge needs sorted shards).
+        """
+        self._fp.close()
+        if not self._sorted:
+            with open(self.shard_path, "r", newline="") as fp:
+                rows = sorted(csv.reader(fp), key=lambda row: int(row[0]))
+            with open(self.shard_path, "w", newline="", buffering=BUFFER_SIZE) as fp:
+                csv.writer(fp).writerows(rows)
+        return self.shard_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _read_shard(fp, shard_id):
+    # the shard id breaks ties between shards that wrote the same ImageId (the lowest worker id wins)
+    for row in csv.reader(fp):
+        yield int(row[0]), shard_id, row[1], row[2]
+
+def merge_shards(shard_dir, save_path, header=HEADER, remove_shards=False, n_workers=None):
+    """
+    k-way merge of the sorted shards of `SubmissionShardWriter` into one submission in the original
+    ImageId order. Streams the rows (only one row per shard is in memory). If an ImageId was written by
+    more than one worker, the row of the worker with the lowest id is kept.
+    Args:
+        shard_dir (str): directory of the shards
+        save_path (str): path to the merged .csv
+        header (tuple): column names
+        remove_shards (bool): whether or not to delete the shards after merging
+        n_workers (int): number of workers of the run. When given, the merge refuses to run unless the shards
+            are exactly those of workers 0 ... n_workers - 1. Defaults to None (merges every shard).
+    Returns:
+        number of rows written (int)
+    """
+    shards = list_shards(shard_dir)
+    if not shards:
+        raise ValueError("There are no shards in {0}".format(shard_dir))
+    if n_workers is not None and [shard_id for shard_id, _ in shards] != list(range(n_workers)):
+        raise ValueError("Expected the shards of workers 0-{0} in {1}, found those of workers {2}."
+                         .format(n_workers - 1, shard_dir, [shard_id for shard_id, _ in shards]))
+    shard_paths = [shard_path for _, shard_path in shards]
+    shard_fps = [open(shard_path, "r", newline="", buffering=BUFFER_SIZE) for shard_path in shard_paths]
+    n_rows, last_position = 0, -1
+    try:
+        with open(save_path, "w", newline="", buffering=BUFFER_SIZE) as fp:
+            writer = csv.writer(fp)
+            writer.writerow(header)
+            shard_rows = [_read_shard(shard_fp, shard_id) for (shard_id, _), shard_fp in zip(shards, shard_fps)]
+            for position, _, image_id, value in heapq.merge(*shard_rows):
+                if position == last_position:
+                    continue
+                writer.writerow((image_id, value))
+                last_position = position
+                n_rows += 1
+    finally:
+        for shard_fp in shard_fps:
+            shard_fp.close()
+    if remove_shards:
+        for shard_path in shard_paths:
+            os.remove(shard_path)
+    print("Merged {0} shards ({1} rows) into {2}".format(len(shard_paths), n_rows, os.path.abspath(save_path)))
+    return n_rows
@@ -0,0 +1,190 @@
+import numpy as np
+import cv2
+
+from pneumothorax_seg.models.mixed_precision import cast_inputs
+
+# smallest weight along each axis of `blending_window`
+MIN_WEIGHT_1D = 3e-3
+
+def blending_window(tile_size, mode="gaussian", sigma_scale=0.125):
+    """
+    Weights of the pixels of a tile when the overlapping tile predictions are averaged. Down-weighting the
+    tile borders (where the receptive field is cut off) removes the seams between the tiles.
+    Args:
+        tile_size (int): height and width of the tiles
+        mode (str): `gaussian` (https://arxiv.org/abs/1809.10486), `linear` (tent-shaped) or `constant`
+        sigma_scale (float): standard deviation of the gaussian as a fraction of `tile_size`
+    Returns:
+        np.ndarray (tile_size, tile_size) float32 with a maximum of 1 and no weights below MIN_WEIGHT_1D ** 2
+    """
+    coords = np.arange(tile_size, dtype=np.float32) - (tile_size - 1) / 2.
+    if mode == "gaussian":
+        window_1d = np.exp(-coords ** 2 / (2 * (sigma_scale * tile_size) ** 2))
+    elif mode == "linear":
+        window_1d = (tile_size / 2. - np.abs(coords)) / (tile_size / 2.)
+    elif mode == "constant":
+        window_1d = np.ones(tile_size, dtype=np.float32)
+    else:
+        raise ValueError("`mode` must be one of `gaussian`, `linear` or `constant`.")
+    window_1d = window_1d / window_1d.max()
+    # every pixel has to be covered with a nonzero weight. The floor is applied per axis (not to the 2D window),
+    # so that the weights of two tiles that overlap along one axis keep their ratio at every position along the
+    # other one (i.e. along the image borders). MIN_WEIGHT_1D ** 2 (the corners) still has ~1% precision in the
+    # float16 accumulators.
+    window_1d = np.maximum(window_1d, MIN_WEIGHT_1D)
+    return np.outer(window_1d, window_1d).astype(np.float32)
+
+def tile_starts(size, tile_size, stride):
+    """
+    Start coordinates of the tiles along one axis; the last tile is aligned to the end of the image.
+    """
+    if size <= tile_size:
+        return [0]
+    starts = list(range(0, size - tile_size, stride))
+    return starts + [size - tile_size]
+
+def lung_field_map(image, downsample=8, dark_fraction=0.6, min_std=0.005):
+    """
+    Cheap intensity heuristic for where the lung fields can be (no model involved): on a downsampled copy
+    of the image, the lungs are radiolucent (darker than the mediastinum, bones and abdomen) but, unlike the
+    background, collimation and padding around the patient, not flat.
+    Args:
+        image (np.ndarray): (h, w) or (h, w, n_channels); only the first channel is used. Any monotonic
+            preprocessing is fine, since the intensities are rescaled with the image's own percentiles.
+        downsample (int): downsampling factor of the map
+        dark_fraction (float): pixels below this fraction of the (1st - 99th percentile) intensity range
+            count as dark
+        min_std (float): minimum local standard deviation (of the rescaled intensities) to not count as flat
+    Returns:
+        np.ndarray (h // downsample, w // downsample) bool
+    """
+    x = image[..., 0] if image.ndim == 3 else image
+    x = np.asarray(x, dtype=np.float32)
+    small = cv2.resize(x, (max(1, x.shape[1] // downsample), max(1, x.shape[0] // downsample)),
+                       interpolation=cv2.INTER_AREA)
+    low, high = np.percentile(small, (1, 99))
+    small = (small - low) / max(high - low, 1e-6)
+    mean = cv2.blur(small, (3, 3))
+    std = np.sqrt(np.maximum(cv2.blur(small ** 2, (3, 3)) - mean ** 2, 0))
+    return (small < dark_fraction) & (std > min_std)
+
+class TiledPredictor(object):
+    """
+    Sliding-window inference at native resolution (i.e. 1024x1024) with a fully convolutional segmentation
+    model. The tiles of several images are batched together, the overlapping predictions are blended with
+    `blending_window` into a float16 accumulator per image, and tiles that are entirely outside the lung
+    fields (see `lung_field_map`) are skipped (predicted as 0).
+        tiler = TiledPredictor(UEfficientNet(input_shape=(None, None, 3), ...), tile_size=512, stride=384)
+        preds = tiler.predict(x_test)  # (n, 1024, 1024)
+    Attributes:
+        model (tf.keras.models.Model or a list of them): segmentation model with a sigmoid output; either
+            fully convolutional (input_shape=(None, None, n_channels)) or built for (tile_size, tile_size,
+            n_channels). A list of models is ensembled (predictions are averaged).
+        tile_size (int): height and width of the tiles
+        stride (int): distance between the tile starts; tile_size - stride pixels overlap
+        batch_size (int): number of tiles per model call (across images)
+        blending (str): see `blending_window`
+        tta (bool): whether or not to average with the predictions of the horizontally flipped tiles
+        min_lung_fraction (float): tiles where less than this fraction of `lung_field_map` is lung are
+            skipped. None disables the skipping.
+    """
+    def __init__(self, model, tile_size=512, stride=384, batch_size=8, blending="gaussian", tta=False,
+                 min_lung_fraction=0.01):
+        if stride > tile_size:
+            raise ValueError("`stride` must be <= `tile_size` (the tiles have to cover the image).")
+        self.model = model
+        self.tile_size = tile_size
+        self.stride = stride
+        self.batch_size = batch_size
+        self.tta = tta
+        self.min_lung_fraction = min_lung_fraction
+        self.window = blending_window(tile_size, blending)
+        self.n_tiles, self.n_skipped = 0, 0
+
+    def _tiles(self, image):
+        h, w = image.shape[:2]
+        if self.min_lung_fraction is not None:
+            lung_map = lung_field_map(image)
+            scale_y, scale_x = lung_map.shape[0] / float(h), lung_map.shape[1] / float(w)
+        for y in tile_starts(h, self.tile_size, self.stride):
+            for x in tile_starts(w, self.tile_size, self.stride):
+                self.n_tiles += 1
+                if self.min_lung_fraction is not None:
+                    region = lung_map[int(y * scale_y):int(np.ceil((y + self.tile_size) * scale_y)),
+                                      int(x * scale_x):int(np.ceil((x + self.tile_size) * scale_x))]
+                    if region.mean() < self.min_lung_fraction:
+                        self.n_skipped += 1
+                        continue
+                yield y, x
+
+    def _predict_tiles(self, tiles):
+        tiles = cast_inputs(np.stack(tiles), self.model)
+        models = self.model if isinstance(self.model, (list, tuple)) else [self.model]
+        preds = []
+        for model in models:
+            preds.append(np.asarray(model.predict_on_batch(tiles), dtype=np.float32))
+            if self.tta:
+                flipped = np.asarray(model.predict_on_batch(tiles[:, :, ::-1]), dtype=np.float32)
+                preds.append(flipped[:, :, ::-1])
+        preds = np.mean(preds, axis=0)
+        return preds.reshape(preds.shape[:3])
+
+    def predict_iter(self, images):
+        """
+        Streams the predictions: yields (index, probability map) for each image as soon as all of its tiles
+        are done, so only the images with tiles in the current batch are held in memory.
+        Args:
+            images (iterable): of (h, w, n_channels) preprocessed arrays; every side has to be >= tile_size
+        Yields:
+            (int, np.ndarray (h, w) float32)
+        """
+        accumulators, weights, remaining = {}, {}, {}
+        batch, batch_keys = [], []
+        def run_batch():
+            for (idx, y, x), pred in zip(batch_keys, self._predict_tiles(batch)):
+                accumulators[idx][y:y+self.tile_size, x:x+self.tile_size] += pred * self.window
+                weights[idx][y:y+self.tile_size, x:x+self.tile_size] += self.window
+                remaining[idx] -= 1
+            del batch[:], batch_keys[:]
+
+        def finished():
+            for idx in [idx for idx, n in remaining.items() if n == 0]:
+                weight = weights.pop(idx).astype(np.float32)
+                # skipped regions have no weight and stay 0
+                pred = np.divide(accumulators.pop(idx).astype(np.float32), weight,
+                                 out=np.zeros_like(weight), where=weight > 0)
+                del remaining[idx]
+                yield idx, pred
+
+        for idx, image in enumerate(images):
+            h, w = image.shape[:2]
+            if min(h, w) < self.tile_size:
+                raise ValueError("The images ({0}x{1}) must be at least as large as the tiles ({2})."
+                                 .format(h, w, self.tile_size))
+            accumulators[idx] = np.zeros((h, w), dtype=np.float16)
+            weights[idx] = np.zeros((h, w), dtype=np.float16)
+            remaining[idx] = 0
+            for y, x in self._tiles(image):
+                batch.append(image[y:y+self.tile_size, x:x+self.tile_size])
+                batch_keys.append((idx, y, x))
+                remaining[idx] += 1
+                if len(batch) == self.batch_size:
+                    run_batch()
+            for result in finished():
+                yield result
+        if batch:
+            run_batch()
+        for result in finished():
+            yield result
+
+    def predict(self, images):
+        """
+        Args:
+            images (np.ndarray): (n, h, w, n_channels) preprocessed images
+        Returns:
+            np.ndarray (n, h, w) float32 probability maps
+        """
+        preds = np.zeros(np.shape(images)[:3], dtype=np.float32)
+        for idx, pred in self.predict_iter(images):
+            preds[idx] = pred
+        return preds
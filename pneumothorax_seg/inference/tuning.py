@@ -0,0 +1,134 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from tqdm import tqdm
+
+from pneumothorax_seg.inference.evaluation import threshold_pixel_counts, grid_dice_from_counts, \
+                                                  load_probability_maps, load_masks
+
+def build_count_histograms(probs, masks, n_bins=100, chunk_size=64):
+    """
+    Builds per-image cumulative pixel-count histograms over `n_bins` equally spaced probability bins.
+    This is the only pass over the pixels; every (threshold x min_area) setting is evaluated from the
+    histograms afterwards.
+    Args:
+        probs (np.ndarray): probability maps with shape (N, H, W); can be memory-mapped
+        masks (np.ndarray): ground truth masks with shape (N, H, W), same resolution as `probs`
+        n_bins (int): number of probability bins. The candidate thresholds are the inner bin edges.
+        chunk_size (int): number of images to process at a time
+    Returns:
+        hist (dict): with the keys
+            `thresholds` (T,): the inner bin edges
+            `true` (N,): number of ground truth pixels per image
+            `pred` (N, T): number of pixels >= each threshold per image
+            `intersection` (N, T): number of ground truth pixels >= each threshold per image
+            `img_size` (2,): (H, W) of the probability maps
+    """
+    assert probs.shape[0] == masks.shape[0], "The number of probability maps and masks must match."
+    thresholds = np.linspace(0, 1, n_bins+1)[1:-1].astype(np.float32)
+    true, pred, intersection = [], [], []
+    for start in tqdm(range(0, probs.shape[0], chunk_size)):
+        counts = threshold_pixel_counts(np.asarray(probs[start:start+chunk_size]),
+                                        np.asarray(masks[start:start+chunk_size]), thresholds)
+        true.append(counts[0]), pred.append(counts[1]), intersection.append(counts[2])
+    hist = {"thresholds": thresholds, "true": np.concatenate(true),
+            "pred": np.concatenate(pred).astype(np.int32),
+            "intersection": np.concatenate(intersection).astype(np.int32),
+            "img_size": np.asarray(probs.shape[1:3])}
+    return hist
+
+def save_count_histograms(hist, fpath):
+    """
+    Caches the output of `build_count_histograms` as a compressed .npz file.
+    """
+    np.savez_compressed(fpath, **hist)
+    print("Saved the count histograms at {0}".format(fpath))
+
+def load_count_histograms(fpath):
+    """
+    Loads the output of `save_count_histograms`.
+    """
+    with np.load(fpath) as f:
+        return {key: f[key] for key in f.files}
+
+def evaluate_histograms(hist, min_areas, thresholds=None, output_size=1024):
+    """
+    Evaluates the mean per-image Dice for the full (threshold x min_area) grid analytically from the
+    count histograms.
+    Args:
+        hist (dict): from `build_count_histograms` or `load_count_histograms`
+        min_areas (list/np.ndarray): minimum ROI areas in pixels at `output_size` x `output_size`
+            (the resolution that `zero_out_thresholded_single` runs at during inference)
+        thresholds (list/np.ndarray): subset of `hist["thresholds"]` to evaluate. Defaults to None (all).
+        output_size (int): the inference output resolution. Areas are rescaled to the resolution of
+            the histograms.
+    Returns:
+        pd.DataFrame with the columns `threshold`, `min_area` and `dice`, sorted from best to worst
+    """
+    all_thresholds = hist["thresholds"]
+    if thresholds is None:
+        thresh_idx = np.arange(len(all_thresholds))
+    else:
+        thresh_idx = np.asarray([np.argmin(np.abs(all_thresholds - t)) for t in thresholds])
+    min_areas = np.asarray(min_areas)
+    # areas at the histogram resolution
+    area_scale = float(np.prod(hist["img_size"])) / (output_size**2)
+    scaled_areas = min_areas * area_scale
+    dice = grid_dice_from_counts(hist["true"], hist["pred"][:, thresh_idx], hist["intersection"][:, thresh_idx],
+                                 scaled_areas).mean(axis=0)
+    thresh_grid, area_grid = np.meshgrid(all_thresholds[thresh_idx], min_areas, indexing="ij")
+    results_df = pd.DataFrame({"threshold": thresh_grid.ravel(), "min_area": area_grid.ravel(),
+                               "dice": dice.ravel()})
+    return results_df.sort_values("dice", ascending=False).reset_index(drop=True)
+
+def tune_postprocessing(probs, masks, min_areas=None, n_bins=100, output_size=1024, chunk_size=64,
+                        save_path="postprocessing_params.json", hist_path=None):
+    """
+    Tunes `threshold` and `min_area` for `SegmentationOnlyInference`/`Stage2` on cached validation
+    probability maps.
+    Args:
+        probs (np.ndarray or str): probability maps with shape (N, H, W) or the path to the saved .npy
+        masks (np.ndarray or list): ground truth masks with shape (N, H, W) or a list of mask file paths
+        min_areas (list/np.ndarray): candidate areas at `output_size`. Defaults to 0 to 5120 in steps of 256.
+        n_bins (int): number of probability bins (threshold resolution is 1/n_bins)
+        output_size (int): the inference output resolution
+        chunk_size (int): number of images to process at a time
+        save_path (str): path to the .json to save the best parameters to. None to not save.
+        hist_path (str): path to cache the count histograms at (.npz). If it exists, the histograms are
+            loaded instead of recomputed. Defaults to None (no caching).
+    Returns:
+        tuple (best_params, results_df) where best_params is a dict with the keys `threshold` and `min_area`
+    """
+    if min_areas is None:
+        min_areas = np.arange(0, 5121, 256)
+    if hist_path is not None and os.path.exists(hist_path):
+        hist = load_count_histograms(hist_path)
+    else:
+        if isinstance(probs, str):
+            probs = load_probability_maps(probs)
+        if isinstance(masks, (list, tuple)):
+            masks = load_masks(masks, img_size=probs.shape[1])
+        hist = build_count_histograms(probs, masks, n_bins=n_bins, chunk_size=chunk_size)
+        if hist_path is not None:
+            save_count_histograms(hist, hist_path)
+    results_df = evaluate_histograms(hist, min_areas, output_size=output_size)
+    best = results_df.iloc[0]
+    best_params = {"threshold": round(float(best["threshold"]), 4), "min_area": int(best["min_area"])}
+    print("Best parameters: {0} (dice: {1:.4f})".format(best_params, best["dice"]))
+    if save_path is not None:
+        with open(save_path, "w") as fp:
+            json.dump(best_params, fp)
+        print("Saved the post-processing parameters at {0}".format(save_path))
+    return (best_params, results_df)
+
+def load_postprocessing_params(fpath="postprocessing_params.json"):
+    """
+    Loads the parameters saved by `tune_postprocessing`, i.e.
+        SegmentationOnlyInference(model, test_fpaths, **load_postprocessing_params())
+    Returns:
+        dict with the keys `threshold` and `min_area`
+    """
+    with open(fpath, "r") as fp:
+        return json.load(fp)
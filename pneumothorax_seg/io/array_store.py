@@ -0,0 +1,103 @@
+import os
+import json
+import glob
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+def image_id(fpath):
+    """
+    ImageId of an image/mask path (the file name without the extension). ImageIds pass through unchanged.
+    """
+    return os.path.splitext(os.path.basename(fpath))[0]
+
+def _load_pair(fpath, masks_dir, img_size):
+    x = Image.open(fpath).convert("L")
+    mask_path = os.path.join(masks_dir, os.path.basename(fpath))
+    y = Image.open(mask_path) if os.path.exists(mask_path) else Image.new("L", x.size)
+    if img_size is not None and x.size != (img_size, img_size):
+        x = x.resize((img_size, img_size), Image.BILINEAR)
+        y = y.resize((img_size, img_size), Image.NEAREST)
+    y = np.array(y)
+    y[y > 0] = 255
+    return np.array(x), y
+
+def build_array_store(images_dir, masks_dir, store_dir, img_size=None, n_workers=8):
+    """
+    Packs the .png images and masks into one read-only array store that many training processes can
+    memory-map at once (i.e. k-fold runs on one machine share the page cache instead of each decoding the
+    same .pngs). Images are stored as grayscale uint8 and masks as 0/255 uint8.
+    Layout:
+        store_dir/index.json: `image_ids` (row order), `img_size`
+        store_dir/images.npy: (n_images, img_size, img_size)
+        store_dir/masks.npy: (n_images, img_size, img_size)
+    Args:
+        images_dir (str): path to the preprocessed images (.png)
+        masks_dir (str): path to the masks (.png); images without a mask get an empty mask
+        store_dir (str): output directory. If it already has an `index.json`, nothing is rebuilt.
+        img_size (int): images are resized to (img_size, img_size). Defaults to None (the size of the
+            first image; all images must have the same size).
+        n_workers (int): number of decoding threads
+    Returns:
+        ArrayStore
+    """
+    index_path = os.path.join(store_dir, "index.json")
+    if os.path.exists(index_path):
+        print("Using the existing array store at {0}".format(store_dir))
+        return ArrayStore(store_dir)
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    fpaths = sorted(glob.glob(os.path.join(images_dir, "*.png")))
+    if not fpaths:
+        raise ValueError("There are no .png images in {0}".format(images_dir))
+    if img_size is None:
+        img_size = Image.open(fpaths[0]).size[0]
+    shape = (len(fpaths), img_size, img_size)
+    images = np.lib.format.open_memmap(os.path.join(store_dir, "images.npy"), mode="w+", dtype=np.uint8,
+                                       shape=shape)
+    masks = np.lib.format.open_memmap(os.path.join(store_dir, "masks.npy"), mode="w+", dtype=np.uint8,
+                                      shape=shape)
+    def load(row):
+        images[row], masks[row] = _load_pair(fpaths[row], masks_dir, img_size)
+    with ThreadPoolExecutor(n_workers) as executor:
+        list(executor.map(load, range(len(fpaths))))
+    images.flush(), masks.flush()
+    del images, masks
+    # the index is written last, so an interrupted build is redone
+    with open(index_path, "w") as fp:
+        json.dump({"image_ids": [image_id(fpath) for fpath in fpaths], "img_size": img_size}, fp)
+    print("Packed {0} images into {1}".format(len(fpaths), store_dir))
+    return ArrayStore(store_dir)
+
+class ArrayStore(object):
+    """
+    Read-only, memory-mapped view of a store from `build_array_store`.
+    Attributes:
+        store_dir (str): path to the store
+        image_ids (list): ImageId of every row
+        images (np.memmap): (n_images, img_size, img_size) uint8
+        masks (np.memmap): (n_images, img_size, img_size) uint8 (0/255)
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "index.json"), "r") as fp:
+            index = json.load(fp)
+        self.image_ids = index["image_ids"]
+        self.img_size = index["img_size"]
+        self.images = np.load(os.path.join(store_dir, "images.npy"), mmap_mode="r")
+        self.masks = np.load(os.path.join(store_dir, "masks.npy"), mmap_mode="r")
+        self._rows = {image_id: row for row, image_id in enumerate(self.image_ids)}
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def rows(self, ids):
+        """
+        Rows of ImageIds (or of image filepaths, i.e. the `train`/`val` lists of a fold .json).
+        """
+        missing = [i for i in ids if image_id(i) not in self._rows]
+        if missing:
+            raise KeyError("{0} ImageIds are not in the store {1}, i.e. {2}".format(len(missing), self.store_dir,
+                                                                                   missing[:3]))
+        return np.array([self._rows[image_id(i)] for i in ids], dtype=np.int64)
@@ -136,3 +136,70 @@ class ClassificationGenerator(BaseGenerator):
             x_batch.append(x), y_batch.append(y)
         X, Y = np.stack(x_batch), np.vstack(y_batch)
         return (X, Y)
+
+class ArraySegmentationGenerator(BaseGenerator):
+    """
+    Generates (image, mask) pairs from a memory-mapped `ArrayStore` (same outputs as `SegmentationGenerator`).
+    Supports `channels_last`.
+    Args:
+        store (ArrayStore or str): the store or its directory (see `io.array_store.build_array_store`)
+        batch_size (int):
+        ids (list): of ImageIds or image filepaths (i.e. the `train`/`val` lists of a fold .json; see
+            `script_utils.io_setup.load_fold`). Defaults to None (every image in the store).
+        augmentations (albumentations transform): either Composed or an individual augmentation
+        shuffle (bool):
+    """
+    def __init__(self, store, batch_size, ids=None, augmentations=None, shuffle=True):
+        from pneumothorax_seg.io.array_store import ArrayStore
+        self.store = ArrayStore(store) if isinstance(store, str) else store
+        rows = np.arange(len(self.store)) if ids is None else self.store.rows(ids)
+        self.augment = augmentations
+        super().__init__(fpaths=rows, batch_size=batch_size, shuffle=shuffle)
+        self.on_epoch_end()
+
+    def set_fold(self, ids):
+        """
+        Switches to another subset of the store (i.e. the `train` ImageIds of another fold; see
+        `script_utils.io_setup.load_fold`) without reopening the store.
+        """
+        self.fpaths = self.store.rows(ids)
+        self.on_epoch_end()
+
+    def __getitem__(self, index):
+        'Generate one batch of data'
+        indexes = self.indexes[index*self.batch_size: min((index+1)*self.batch_size, len(self.fpaths))]
+        X, Y = self.data_gen(self.fpaths[indexes])
+        if self.augment is None:
+            return X, Y/255
+        else:
+            im,mask = [], []
+            for x,y in zip(X,Y):
+                augmented = self.augment(image=x, mask=y)
+                im.append(augmented['image'])
+                mask.append(augmented['mask'])
+            return np.array(im), np.array(mask)/255
+
+    def data_gen(self, rows_temp):
+        """
+        Reads a batch of rows from the store.
+        Args:
+            rows_temp: batched rows of the store
+        Returns
+            x (uint8, 3 channels), y (uint8, 0/255)
+        """
+        X = np.repeat(self.store.images[rows_temp][..., None], 3, -1)
+        Y = self.store.masks[rows_temp][..., None]
+        return (X, Y)
+
+class ArrayClassificationGenerator(ArraySegmentationGenerator):
+    """
+    Generates (image, classification label) from a memory-mapped `ArrayStore` (same outputs as
+    `ClassificationGenerator`). Takes the same arguments as `ArraySegmentationGenerator`.
+    """
+    def __getitem__(self, idx):
+        indexes = self.indexes[idx*self.batch_size:(idx+1)*self.batch_size]
+        X, Y = self.data_gen(self.fpaths[indexes])
+        Y = Y.reshape(len(Y), -1).max(axis=1, keepdims=True) > 0
+        if self.augment is not None:
+            X = np.stack([self.augment(image=x)['image'] for x in X])
+        return (X, Y.astype(np.int64))
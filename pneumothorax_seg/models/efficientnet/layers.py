@@ -7,6 +7,23 @@ class Swish(Layer):
     def call(self, inputs):
         return tf.nn.swish(inputs)
 
+class SpatialMean(Layer):
+    """
+    Mean over the spatial dimensions (keeping them), i.e. the squeeze of the squeeze-and-excitation blocks.
+    A layer instead of a Lambda so that architectures serialize to json (see `models.model_cache`).
+    """
+    def __init__(self, spatial_dims=(1, 2), **kwargs):
+        super().__init__(**kwargs)
+        self.spatial_dims = list(spatial_dims)
+
+    def call(self, inputs):
+        return K.mean(inputs, axis=self.spatial_dims, keepdims=True)
+
+    def get_config(self):
+        config = super().get_config()
+        config['spatial_dims'] = self.spatial_dims
+        return config
+
 class DropConnect(Layer):
 
     def __init__(self, drop_connect_rate=0., **kwargs):
@@ -21,9 +38,9 @@ class DropConnect(Layer):
             # Compute drop_connect tensor
             batch_size = tf.shape(inputs)[0]
             random_tensor = keep_prob
-            random_tensor += tf.random_uniform([batch_size, 1, 1, 1], dtype=inputs.dtype)
+            random_tensor += tf.random.uniform([batch_size, 1, 1, 1], dtype=inputs.dtype)
             binary_tensor = tf.floor(random_tensor)
-            output = tf.div(inputs, keep_prob) * binary_tensor
+            output = tf.math.divide(inputs, keep_prob) * binary_tensor
             return output
 
 
@@ -38,4 +55,5 @@ class DropConnect(Layer):
 get_custom_objects().update({
     'DropConnect': DropConnect,
     'Swish': Swish,
+    'SpatialMean': SpatialMean,
 })
@@ -35,12 +35,37 @@ import tensorflow.keras.models as KM
 import tensorflow.keras.layers as KL
 from tensorflow.keras.utils import get_file
 
-from .layers import Swish, DropConnect
+from .layers import Swish, DropConnect, SpatialMean
 from .params import get_model_params, IMAGENET_WEIGHTS
 from .initializers import conv_kernel_initializer, dense_kernel_initializer
+from pneumothorax_seg.models.mixed_precision import get_compute_dtype
 
 __all__ = ['EfficientNet', 'EfficientNetB0', 'EfficientNetB1', 'EfficientNetB2', 'EfficientNetB3',
-           'EfficientNetB4', 'EfficientNetB5', 'EfficientNetB6', 'EfficientNetB7']
+           'EfficientNetB4', 'EfficientNetB5', 'EfficientNetB6', 'EfficientNetB7', 'EFFICIENTNETS',
+           'feature_tap_name', 'get_feature_taps']
+
+
+def feature_tap_name(stride):
+    """Name of the last layer at `stride` (the feature tap for skip connections)."""
+    return 'features_stride{0}'.format(stride)
+
+
+def get_feature_taps(model, strides=(2, 4, 8, 16, 32)):
+    """Looks up the feature taps of an EfficientNet encoder.
+
+    The builder names the last layer of each resolution stage (the expansion
+    activation right before each strided depthwise convolution and the final
+    activation), so decoders can pick their skip connections by stride for any
+    of B0-B7.
+
+    Args:
+      model: EfficientNet model (or a model that contains its layers)
+      strides: strides (relative to the input) of the taps to return
+
+    Returns:
+      dict of {stride: output tensor of the tap}
+    """
+    return {stride: model.get_layer(feature_tap_name(stride)).output for stride in strides}
 
 def round_filters(filters, global_params):
     """Round number of filters based on depth multiplier."""
@@ -82,7 +107,7 @@ def SEBlock(block_args, global_params):
 
     def block(inputs):
         x = inputs
-        x = KL.Lambda(lambda a: K.mean(a, axis=spatial_dims, keepdims=True))(x)
+        x = SpatialMean(spatial_dims)(x)
         x = KL.Conv2D(
             num_reduced_filters,
             kernel_size=[1, 1],
@@ -108,7 +133,7 @@ def SEBlock(block_args, global_params):
     return block
 
 
-def MBConvBlock(block_args, global_params, drop_connect_rate=None):
+def MBConvBlock(block_args, global_params, drop_connect_rate=None, tap_name=None):
     batch_norm_momentum = global_params.batch_norm_momentum
     batch_norm_epsilon = global_params.batch_norm_epsilon
     if global_params.data_format == 'channels_first':
@@ -140,9 +165,12 @@ def MBConvBlock(block_args, global_params, drop_connect_rate=None):
                 momentum=batch_norm_momentum,
                 epsilon=batch_norm_epsilon
             )(x)
-            x = Swish()(x)
+            # the last layer before the strided depthwise conv is the feature tap of the previous stage
+            x = Swish(name=tap_name)(x)
         else:
             x = inputs
+            if tap_name is not None:
+                x = KL.Activation('linear', name=tap_name)(x)
 
         x = KL.DepthwiseConv2D(
             [kernel_size, kernel_size],
@@ -201,7 +229,8 @@ def EfficientNet(input_shape, block_args_list, global_params, input_tensor=None,
     # Stem part
     # Stem part
     if input_tensor is None:
-        inputs = KL.Input(shape=input_shape)
+        # half precision inputs under a mixed precision policy (float32 otherwise)
+        inputs = KL.Input(shape=input_shape, dtype=get_compute_dtype())
     else:
         if not K.is_keras_tensor(input_tensor):
             inputs = KL.Input(tensor=input_tensor, shape=input_shape)
@@ -228,6 +257,8 @@ def EfficientNet(input_shape, block_args_list, global_params, input_tensor=None,
     n_blocks = sum([block_args.num_repeat for block_args in block_args_list])
     drop_rate = global_params.drop_connect_rate or 0
     drop_rate_dx = drop_rate / n_blocks
+    # stride of the current resolution stage relative to the input (after the stem)
+    stride = 2
 
     for block_args in block_args_list:
         assert block_args.num_repeat > 0
@@ -239,8 +270,12 @@ def EfficientNet(input_shape, block_args_list, global_params, input_tensor=None,
         )
 
         # The first block needs to take care of stride and filter size increase.
+        tap_name = None
+        if any(s > 1 for s in block_args.strides):
+            tap_name = feature_tap_name(stride)
+            stride *= 2
         x = MBConvBlock(block_args, global_params,
-                        drop_connect_rate=drop_rate_dx * block_idx)(x)
+                        drop_connect_rate=drop_rate_dx * block_idx, tap_name=tap_name)(x)
         block_idx += 1
 
         if block_args.num_repeat > 1:
@@ -265,14 +300,14 @@ def EfficientNet(input_shape, block_args_list, global_params, input_tensor=None,
         momentum=batch_norm_momentum,
         epsilon=batch_norm_epsilon
     )(x)
-    x = Swish()(x)
+    x = Swish(name=feature_tap_name(stride))(x)
 
     if include_top:
         x = KL.GlobalAveragePooling2D(data_format=global_params.data_format)(x)
         if global_params.dropout_rate > 0:
             x = KL.Dropout(global_params.dropout_rate)(x)
         x = KL.Dense(global_params.num_classes, kernel_initializer=dense_kernel_initializer)(x)
-        x = KL.Activation('softmax')(x)
+        x = KL.Activation('softmax', dtype='float32')(x)
     else:
         if pooling == 'avg':
             x = KL.GlobalAveragePooling2D(data_format=global_params.data_format)(x)
@@ -425,3 +460,14 @@ EfficientNetB4.__doc__ = _get_model_by_name.__doc__
 EfficientNetB5.__doc__ = _get_model_by_name.__doc__
 EfficientNetB6.__doc__ = _get_model_by_name.__doc__
 EfficientNetB7.__doc__ = _get_model_by_name.__doc__
+
+EFFICIENTNETS = {
+    'efficientnet-b0': EfficientNetB0,
+    'efficientnet-b1': EfficientNetB1,
+    'efficientnet-b2': EfficientNetB2,
+    'efficientnet-b3': EfficientNetB3,
+    'efficientnet-b4': EfficientNetB4,
+    'efficientnet-b5': EfficientNetB5,
+    'efficientnet-b6': EfficientNetB6,
+    'efficientnet-b7': EfficientNetB7,
+}
@@ -0,0 +1,213 @@
+import functools
+import contextlib
+import numpy as np
+import tensorflow as tf
+
+from tensorflow.keras import mixed_precision
+
+POLICIES = ("float32", "mixed_float16", "mixed_bfloat16")
+# default `compare_precisions` tolerances (in standard deviations of the logits); bfloat16 only has an 8 bit
+# mantissa (vs. 11 bits for float16)
+PRECISION_RTOL = {"mixed_float16": 0.05, "mixed_bfloat16": 0.25}
+
+def _get_global_policy():
+    if hasattr(mixed_precision, "global_policy"):
+        return mixed_precision.global_policy()
+    # tf 2.1 - 2.3
+    return mixed_precision.experimental.global_policy()
+
+def _set_global_policy(policy):
+    if hasattr(mixed_precision, "set_global_policy"):
+        mixed_precision.set_global_policy(policy)
+    else:
+        mixed_precision.experimental.set_policy(policy)
+
+def get_compute_dtype():
+    """
+    The dtype that layers built under the current global policy compute in (i.e. float16 for mixed_float16).
+    """
+    return _get_global_policy().compute_dtype
+
+@contextlib.contextmanager
+def precision_policy(policy=None):
+    """
+    Context manager that builds layers with a mixed precision policy and restores the previous global policy
+    afterwards, so that only the models built inside of it are affected:
+        with precision_policy("mixed_float16"):
+            model = UEfficientNet(input_shape=(512, 512, 3))
+    The variables (master weights) stay in float32; only the computations are done in half precision.
+    Args:
+        policy (str): one of `float32`, `mixed_float16` (GPUs) or `mixed_bfloat16` (TPUs/recent CPUs).
+            Defaults to None (no change).
+    """
+    if policy is None:
+        yield
+        return
+    if policy not in POLICIES:
+        raise ValueError("`policy` must be one of {0}".format(POLICIES))
+    old_policy = _get_global_policy()
+    _set_global_policy(policy)
+    try:
+        yield
+    finally:
+        _set_global_policy(old_policy)
+
+def with_precision_policy(model_fn):
+    """
+    Decorator that adds an opt-in `precision` keyword argument to a model building function (see
+    `precision_policy`). The model heads should already be float32 (i.e. `dtype="float32"` in the output layer),
+    which is a no-op for full precision models.
+    """
+    @functools.wraps(model_fn)
+    def wrapper(*args, precision=None, **kwargs):
+        with precision_policy(precision):
+            return model_fn(*args, **kwargs)
+    return wrapper
+
+def get_model_compute_dtype(model):
+    """
+    Returns the compute dtype of the first layer with weights in `model` (recursing into nested models).
+    """
+    for layer in model.layers:
+        if hasattr(layer, "layers"):
+            return get_model_compute_dtype(layer)
+        if layer.weights:
+            dtype = getattr(layer, "compute_dtype", None) or getattr(layer, "_compute_dtype", None)
+            return tf.as_dtype(dtype or layer.dtype).name
+    return tf.as_dtype(model.dtype).name
+
+def wrap_optimizer(optimizer, model):
+    """
+    Wraps `optimizer` with dynamic loss scaling when `model` computes in float16, so that small gradients
+    don't underflow. bfloat16 has the same exponent range as float32, so it doesn't need loss scaling.
+    Compile with the result instead of `optimizer`:
+        model.compile(wrap_optimizer(opt, model), loss=..., metrics=...)
+    Args:
+        optimizer: an instance of a tf.keras optimizer
+        model (tf.keras.models.Model):
+    Returns:
+        the loss scaled optimizer or `optimizer` if no loss scaling is needed
+    """
+    if get_model_compute_dtype(model) != "float16":
+        return optimizer
+    if hasattr(mixed_precision, "LossScaleOptimizer"):
+        if isinstance(optimizer, mixed_precision.LossScaleOptimizer):
+            return optimizer
+        return mixed_precision.LossScaleOptimizer(optimizer)
+    return mixed_precision.experimental.LossScaleOptimizer(optimizer, loss_scale="dynamic")
+
+def cast_inputs(x, model):
+    """
+    Casts the inputs for inference to the dtype of the model input: float16 for models built with
+    mixed_float16 (half the host memory and transfer size) and float32 otherwise (never float64).
+    Args:
+        x (np.ndarray): model inputs
+        model (tf.keras.models.Model or a list of them with the same input)
+    Returns:
+        x (np.ndarray)
+    """
+    if isinstance(model, (list, tuple)):
+        model = model[0]
+    input_dtype = tf.as_dtype(model.inputs[0].dtype)
+    if input_dtype == tf.float16:
+        return x.astype(np.float16, copy=False)
+    # bfloat16 inputs are cast on the device, numpy has no bfloat16
+    return x.astype(np.float32, copy=False)
+
+def _logits_model(model):
+    """
+    The same model without its final sigmoid/softmax, so that the precisions are compared before the output
+    activation squashes the differences (i.e. every output of an untrained model is ~0.5).
+    """
+    last_layer = model.layers[-1]
+    if isinstance(last_layer, tf.keras.layers.Activation):
+        return tf.keras.models.Model(model.inputs, last_layer.input)
+    if getattr(last_layer, "activation", None) in (tf.keras.activations.sigmoid, tf.keras.activations.softmax):
+        last_layer.activation = tf.keras.activations.linear
+    return model
+
+def _smooth_inputs(n_samples, input_shape, rs):
+    # low frequency images with different brightness/contrast per sample; the global features of iid noise
+    # barely differ between samples
+    h, w, n_channels = input_shape
+    x = rs.uniform(0, 1, size=(n_samples, 8, 8, n_channels)).astype(np.float32)
+    x = tf.image.resize(x, (h, w)).numpy()
+    return x * rs.uniform(0.5, 2, size=(n_samples, 1, 1, 1)) + rs.uniform(-1, 1, size=(n_samples, 1, 1, 1))
+
+def compare_precisions(model_fn, input_shape, policy="mixed_float16", n_samples=8, batch_size=4,
+                       threshold=0.5, train_steps=10, rtol="default", seed=0):
+    """
+    Numerical equivalence check between a full precision model and the same model built with a mixed
+    precision policy (with the same weights). Runs on the CPU, i.e. before a long mixed precision training run:
+        compare_precisions(partial(UEfficientNet, input_shape=(256, 256, 3)), (256, 256, 3))
+    The outputs are compared before the final sigmoid/softmax (logits), relative to the standard deviation of
+    the full precision logits.
+    Args:
+        model_fn (function): builds the model; called once per policy
+        input_shape (tuple): (h, w, n_channels) of the random inputs
+        policy (str): the mixed precision policy to compare against float32
+        n_samples (int): number of random inputs
+        batch_size (int): prediction batch size
+        threshold (float): threshold for the thresholded output agreement
+        train_steps (int): number of training steps of the full precision model on the random inputs (with
+            random binary targets) before the weights are copied, so that the weights aren't at their
+            initialization (where the outputs barely depend on the inputs)
+        rtol (float): maximum allowed `rel_diff`. Defaults to PRECISION_RTOL[policy]; None disables the check.
+        seed (int): random seed for the inputs
+    Returns:
+        dict with the keys
+            `max_abs_diff` and `mean_abs_diff`: of the logits
+            `logit_std`: standard deviation of the full precision logits
+            `rel_diff`: max_abs_diff / logit_std
+            `output_dtype`: dtype of the mixed precision outputs (should be float32)
+            `agreement`: fraction of outputs on the same side of `threshold` (after the output activation)
+    Raises:
+        ValueError: if the full precision logits don't vary (the comparison would be meaningless) or if
+            `rel_diff` > `rtol`
+    """
+    rs = np.random.RandomState(seed)
+    x = _smooth_inputs(n_samples, input_shape, rs)
+    with precision_policy("float32"):
+        model = model_fn()
+    if train_steps:
+        y = (rs.uniform(size=(n_samples,) + tuple(model.output_shape[1:])) > 0.5).astype(np.float32)
+        model.compile("adam", loss="binary_crossentropy")
+        for _ in range(train_steps):
+            batch = rs.choice(n_samples, batch_size)
+            model.train_on_batch(x[batch], y[batch])
+    with precision_policy(policy):
+        mixed_model = model_fn()
+    mixed_model.set_weights(model.get_weights())
+
+    logits = _logits_model(model).predict(x, batch_size=batch_size, verbose=0).astype(np.float64)
+    mixed_logits = _logits_model(mixed_model).predict(cast_inputs(x, mixed_model), batch_size=batch_size,
+                                                      verbose=0)
+    output_dtype = mixed_logits.dtype.name
+    mixed_logits = mixed_logits.astype(np.float64)
+    abs_diff = np.abs(logits - mixed_logits)
+    logit_std = float(logits.std())
+    if logit_std < 1e-4:
+        raise ValueError("The float32 logits barely vary (std {0:.1e}), so the comparison is meaningless; "
+                         "use more `train_steps` or pretrained weights.".format(logit_std))
+    # the logit of the threshold, so that the agreement doesn't depend on the output activation
+    logit_threshold = np.log(threshold / (1. - threshold))
+    results = {"max_abs_diff": float(abs_diff.max()),
+               "mean_abs_diff": float(abs_diff.mean()),
+               "logit_std": logit_std,
+               "rel_diff": float(abs_diff.max()) / logit_std,
+               "output_dtype": output_dtype,
+               "agreement": float(np.mean((logits >= logit_threshold) == (mixed_logits >= logit_threshold)))}
+    print("{0} vs. float32: {1}".format(policy, results))
+    rtol = PRECISION_RTOL.get(policy) if rtol == "default" else rtol
+    if rtol is not None and results["rel_diff"] > rtol:
+        raise ValueError("{0} differs from float32 by {1:.3f} logit standard deviations (rtol={2})."
+                         .format(policy, results["rel_diff"], rtol))
+    return results
+
+if __name__ == "__main__":
+    from functools import partial
+    from pneumothorax_seg.models.uefficientnet.models import UEfficientNet
+
+    model_fn = partial(UEfficientNet, input_shape=(64, 64, 3), encoder_weights=None, encoder="efficientnet-b0")
+    for policy in ("mixed_float16", "mixed_bfloat16"):
+        compare_precisions(model_fn, (64, 64, 3), policy=policy)
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import numpy as np
+import tensorflow.keras.backend as K
+
+from tensorflow.keras.models import model_from_json
+# registers the custom layers/initializers for `model_from_json`
+import pneumothorax_seg.models.efficientnet.models
+from pneumothorax_seg.models.efficientnet.layers import Swish, DropConnect, SpatialMean
+
+MAGIC = b"PTXMODEL"
+ALIGNMENT = 64
+
+def save_model_cache(model, fpath):
+    """
+    Saves the architecture and weights of a model to a single file that `load_model_cache` memory-maps.
+    Layout:
+        8 bytes: magic string
+        8 bytes: little-endian uint64 length of the json header
+        json header: {`architecture`: model.to_json(), `weights`: [{`shape`, `dtype`, `offset`}]}
+        raw weights, each one aligned to 64 bytes (offsets are relative to the end of the padded header)
+    Args:
+        model (tf.keras.models.Model):
+        fpath (str): path to the cache file
+    """
+    weights = model.get_weights()
+    specs, offset = [], 0
+    for w in weights:
+        specs.append({"shape": list(w.shape), "dtype": w.dtype.name, "offset": offset})
+        offset += -(-w.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({"architecture": model.to_json(), "weights": specs}).encode("utf-8")
+    header_size = len(MAGIC) + 8 + len(header)
+    padding = -header_size % ALIGNMENT
+    with open(fpath, "wb") as fp:
+        fp.write(MAGIC)
+        fp.write(np.uint64(len(header)).tobytes())
+        fp.write(header)
+        fp.write(b"\0" * padding)
+        for w, spec in zip(weights, specs):
+            fp.write(np.ascontiguousarray(w).tobytes())
+            fp.write(b"\0" * (-w.nbytes % ALIGNMENT))
+    print("Saved the model cache at {0} ({1:.1f} MB)".format(fpath, os.path.getsize(fpath) / 1e6))
+
+def _read_header(fpath):
+    with open(fpath, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{0} is not a model cache file.".format(fpath))
+        header_len = int(np.frombuffer(fp.read(8), dtype=np.uint64)[0])
+        header = json.loads(fp.read(header_len).decode("utf-8"))
+    header_size = len(MAGIC) + 8 + header_len
+    return header, header_size + (-header_size % ALIGNMENT)
+
+def load_cached_weights(fpath):
+    """
+    Memory-maps the weights of a model cache file (nothing is read until the arrays are used).
+    Returns:
+        list of read-only np.ndarrays that can be passed to model.set_weights
+    """
+    header, data_offset = _read_header(fpath)
+    data = np.memmap(fpath, dtype=np.uint8, mode="r", offset=data_offset)
+    weights = []
+    for spec in header["weights"]:
+        dtype = np.dtype(spec["dtype"])
+        nbytes = int(np.prod(spec["shape"])) * dtype.itemsize
+        weights.append(data[spec["offset"]:spec["offset"]+nbytes].view(dtype).reshape(spec["shape"]))
+    return weights
+
+def _zero_initializers(config):
+    """
+    Replaces every initializer in a (nested) layer config with zeros, since all of the weights are
+    overwritten right after building. Skips the (random) kernel initialization, which dominates the build time.
+    """
+    if isinstance(config, dict):
+        return {key: {"class_name": "Zeros", "config": {}} if key.endswith("_initializer")
+                else _zero_initializers(value) for key, value in config.items()}
+    if isinstance(config, list):
+        return [_zero_initializers(value) for value in config]
+    return config
+
+def load_model_cache(fpath, custom_objects=None, into=None):
+    """
+    Rebuilds a model saved with `save_model_cache` from its json architecture (no python builder, no ImageNet
+    weights and no random initialization) and sets the memory-mapped weights.
+    Most of the rebuild time is keras' layer-by-layer graph construction, so when models with the same
+    architecture are used one after another (i.e. ensemble members at inference), pass the already built model
+    as `into` to only swap the weights in (milliseconds).
+    Args:
+        fpath (str): path to the cache file
+        custom_objects (dict): extra custom layers. The EfficientNet layers are always included.
+        into (tf.keras.models.Model): an already built model with the same architecture to load the weights
+            into instead of rebuilding. Defaults to None.
+    Returns:
+        uncompiled tf.keras.models.Model (`into` if specified)
+    """
+    if into is not None:
+        into.set_weights(load_cached_weights(fpath))
+        return into
+    header, _ = _read_header(fpath)
+    objects = {"Swish": Swish, "DropConnect": DropConnect, "SpatialMean": SpatialMean}
+    objects.update(custom_objects or {})
+    architecture = json.dumps(_zero_initializers(json.loads(header["architecture"])))
+    model = model_from_json(architecture, custom_objects=objects)
+    model.set_weights(load_cached_weights(fpath))
+    return model
+
+def cached_model(model_fn, cache_path, weights_path=None, custom_objects=None):
+    """
+    Loads a model from `cache_path`, or builds it with `model_fn` (and loads `weights_path`) and caches it
+    for the next time, i.e. for each ensemble member:
+        model = cached_model(partial(UEfficientNetpp, input_shape=(256, 256, 3), encoder_weights=None),
+                             "fold1.model_cache", weights_path="fold1.h5")
+    Note that the cache isn't invalidated when `weights_path` changes; delete it to rebuild.
+    Args:
+        model_fn (function): builds the (uncompiled) architecture
+        cache_path (str): path to the cache file
+        weights_path (str): path to the weights to load after building. Defaults to None.
+        custom_objects (dict): see `load_model_cache`
+    Returns:
+        uncompiled tf.keras.models.Model
+    """
+    if os.path.exists(cache_path):
+        return load_model_cache(cache_path, custom_objects=custom_objects)
+    model = model_fn()
+    if weights_path is not None:
+        model.load_weights(weights_path)
+    save_model_cache(model, cache_path)
+    return model
+
+def benchmark_cold_start(model_fns, cache_path, n_repeats=3):
+    """
+    Times model construction (in a fresh session each time) for builders vs. the cache.
+    Args:
+        model_fns (dict): of {name: function that builds the model}, i.e.
+            {"imagenet": partial(UEfficientNetpp, input_shape=(256, 256, 3)),
+             "no encoder weights": partial(UEfficientNetpp, input_shape=(256, 256, 3), encoder_weights=None)}
+            The cache is created from the first builder if it doesn't exist.
+        cache_path (str): path to the cache file
+        n_repeats (int): number of times to build each model
+    Returns:
+        dict of {name: median seconds}, including `cache` and `cache (weights only)` (see `load_model_cache`)
+    """
+    if not os.path.exists(cache_path):
+        save_model_cache(list(model_fns.values())[0](), cache_path)
+    build_fns = dict(model_fns)
+    build_fns["cache"] = lambda: load_model_cache(cache_path)
+    results = {}
+    for name, build_fn in build_fns.items():
+        times = []
+        for _ in range(n_repeats):
+            K.clear_session()
+            start = time.perf_counter()
+            build_fn()
+            times.append(time.perf_counter() - start)
+        results[name] = float(np.median(times))
+        print("{0}: {1:.3f} s".format(name, results[name]))
+    # swapping the weights of an already built model
+    model = load_model_cache(cache_path)
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        load_model_cache(cache_path, into=model)
+        times.append(time.perf_counter() - start)
+    results["cache (weights only)"] = float(np.median(times))
+    print("cache (weights only): {0:.3f} s".format(results["cache (weights only)"]))
+    K.clear_session()
+    return results
@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+import tensorflow.keras.backend as K
+
+from tensorflow.keras.layers import Input
+from tensorflow.keras.models import Model
+
+from pneumothorax_seg.inference.export import benchmark_latency
+
+def count_flops(model, input_shape):
+    """
+    Counts the floating point operations of one forward pass (batch size 1) with the tensorflow profiler.
+    Ops without registered FLOP statistics (i.e. the bilinear resizes) count as 0, so this slightly
+    undercounts bilinear decoders.
+    Args:
+        model (tf.keras.models.Model):
+        input_shape (tuple): (h, w, n_channels)
+    Returns:
+        flops (int): multiply and add are counted separately
+    """
+    options = tf.compat.v1.profiler.ProfileOptionBuilder(
+        tf.compat.v1.profiler.ProfileOptionBuilder.float_operation()).with_empty_output().build()
+    if tf.executing_eagerly():
+        from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+        input_spec = tf.TensorSpec((1,) + tuple(input_shape), model.inputs[0].dtype)
+        concrete_fn = tf.function(lambda x: model(x, training=False)).get_concrete_function(input_spec)
+        graph_def = convert_variables_to_constants_v2(concrete_fn).graph.as_graph_def()
+        with tf.Graph().as_default() as graph:
+            tf.compat.v1.import_graph_def(graph_def, name="")
+            profile = tf.compat.v1.profiler.profile(graph, options=options)
+    else:
+        # counts every op in the session graph, so build the model in a fresh session
+        profile = tf.compat.v1.profiler.profile(K.get_session().graph, options=options)
+    return profile.total_float_ops
+
+def profile_models(model_fns, input_shape=(512, 512, 3), batch_size=1, n_runs=10):
+    """
+    Reports the parameters, FLOPs and CPU latency of several models, i.e. decoder variants:
+        profile_models({"UEfficientNetpp": partial(UEfficientNetpp, encoder_weights=None),
+                        "lite": partial(UEfficientNetppLite, encoder_weights=None)})
+    Args:
+        model_fns (dict): of {name: function that builds the model}; called with `input_shape=input_shape`
+        input_shape (tuple): (h, w, n_channels)
+        batch_size (int): batch size to time
+        n_runs (int): number of timed runs
+    Returns:
+        pd.DataFrame with the columns `model`, `params`, `gflops` and `latency_ms` (median)
+    """
+    x = np.random.RandomState(0).uniform(0, 1, size=(batch_size,) + tuple(input_shape)).astype(np.float32)
+    rows = []
+    for name, model_fn in model_fns.items():
+        K.clear_session()
+        model = model_fn(input_shape=input_shape)
+        with tf.device("/cpu:0"):
+            latency = benchmark_latency({name: model.predict_on_batch}, x, n_runs=n_runs)[name]
+        rows.append({"model": name, "params": model.count_params(),
+                     "gflops": count_flops(model, input_shape) / 1e9, "latency_ms": latency["median_ms"]})
+    K.clear_session()
+    results_df = pd.DataFrame(rows, columns=["model", "params", "gflops", "latency_ms"])
+    print(results_df.to_string(index=False))
+    return results_df
+
+def benchmark_layers(layers, input_shape, batch_size=1, n_runs=10, seed=0):
+    """
+    Microbenchmark of interchangeable layers (i.e. `InstanceNormalization` vs. `FusedInstanceNormalization`).
+    Every layer gets the same (random) weights; the first layer is the reference for the output differences.
+    Times the inference forward pass and, in eager mode, a training-mode forward + backward pass.
+    Args:
+        layers (dict): of {name: unbuilt layer instance}
+        input_shape (tuple): (h, w, n_channels) of the activations
+        batch_size (int): batch size
+        n_runs (int): number of timed runs
+        seed (int): random seed for the inputs and weights
+    Returns:
+        dict of {name: {`inference`: latency dict, `training`: latency dict, `max_abs_diff`: float}}
+    """
+    rs = np.random.RandomState(seed)
+    x = rs.normal(0, 1, size=(batch_size,) + tuple(input_shape)).astype(np.float32)
+    models, weights = {}, None
+    for name, layer in layers.items():
+        inp = Input(shape=input_shape)
+        models[name] = Model(inp, layer(inp))
+        if weights is None:
+            weights = [rs.uniform(0.5, 1.5, size=w.shape) for w in models[name].get_weights()]
+        models[name].set_weights(weights)
+
+    results, reference = {}, None
+    for name, model in models.items():
+        preds = model.predict_on_batch(x)
+        reference = preds if reference is None else reference
+        results[name] = {"max_abs_diff": float(np.abs(preds - reference).max())}
+        predict_fns = {"{0} (inference)".format(name): model.predict_on_batch}
+        if tf.executing_eagerly():
+            @tf.function
+            def train_step(inputs, model=model):
+                with tf.GradientTape() as tape:
+                    loss = tf.reduce_sum(model(inputs, training=True))
+                return tape.gradient(loss, model.trainable_weights)
+            predict_fns["{0} (training)".format(name)] = lambda inputs, fn=train_step: fn(tf.constant(inputs))
+        with tf.device("/cpu:0"):
+            latencies = benchmark_latency(predict_fns, x, n_runs=n_runs)
+        results[name]["inference"] = latencies["{0} (inference)".format(name)]
+        results[name]["training"] = latencies.get("{0} (training)".format(name))
+        print("{0}: max abs. difference to {1}: {2:.2e}".format(name, list(models)[0],
+                                                                results[name]["max_abs_diff"]))
+    return results
+
+def check_layer_equivalence(layers, input_shape, stats=((0., 1.), (10., 0.1), (100., 0.1), (1000., 1.)),
+                            batch_size=2, seed=0, atol=1e-3):
+    """
+    Compares the outputs of interchangeable layers against the first one in both training and inference mode
+    on inputs with large means (where float32 statistics like E[x^2] - E[x]^2 lose their precision).
+    Args:
+        layers (dict): of {name: unbuilt layer instance}
+        input_shape (tuple): (h, w, n_channels) of the activations
+        stats (tuple): of (mean, std) of the inputs to test
+        batch_size (int): batch size
+        seed (int): random seed for the inputs and weights
+        atol (float): maximum allowed absolute difference
+    Returns:
+        dict of {name: {"mean={mean}/std={std} ({mode})": max abs. difference}}
+    Raises:
+        AssertionError: if a difference is larger than `atol`
+    """
+    rs = np.random.RandomState(seed)
+    models, weights = {}, None
+    for name, layer in layers.items():
+        inp = Input(shape=input_shape)
+        models[name] = (Model(inp, layer(inp)), layer)
+        if weights is None:
+            weights = [rs.uniform(0.5, 1.5, size=w.shape) for w in models[name][0].get_weights()]
+        models[name][0].set_weights(weights)
+
+    results = {name: {} for name in list(models)[1:]}
+    for mean, std in stats:
+        x = tf.constant(rs.normal(mean, std, size=(batch_size,) + tuple(input_shape)).astype(np.float32))
+        for training in (True, False):
+            outputs = {name: K.eval(layer(x, training=training)) for name, (model, layer) in models.items()}
+            reference = outputs[list(models)[0]]
+            key = "mean={0}/std={1} ({2})".format(mean, std, "training" if training else "inference")
+            for name in results:
+                results[name][key] = float(np.abs(outputs[name] - reference).max())
+                print("{0} {1}: max abs. difference {2:.2e}".format(name, key, results[name][key]))
+                assert results[name][key] <= atol, "{0} differs by more than {1} for {2}".format(name, atol, key)
+    return results
+
+if __name__ == "__main__":
+    from functools import partial
+    from pneumothorax_seg.models.uefficientnet.models import UEfficientNetpp, UEfficientNetppLite, \
+                                                           DECODER_VARIANTS
+
+    model_fns = {"UEfficientNetpp": partial(UEfficientNetpp, encoder_weights=None)}
+    for variant, kwargs in DECODER_VARIANTS.items():
+        model_fns[variant] = partial(UEfficientNetppLite, encoder_weights=None, **kwargs)
+    profile_models(model_fns, input_shape=(512, 512, 3))
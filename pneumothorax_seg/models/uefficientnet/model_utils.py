@@ -1,19 +1,20 @@
-from tensorflow.keras.layers import Conv2D, BatchNormalization, LeakyReLU, Add
+from tensorflow.keras.layers import Conv2D, SeparableConv2D, BatchNormalization, LeakyReLU, Add
 import tensorflow.keras.backend as K
 
 dformat = K.image_data_format()
-def convolution_block(x, filters, size, strides=(1,1), padding='same', activation=True):
-    x = Conv2D(filters, size, strides=strides, padding=padding)(x)
+def convolution_block(x, filters, size, strides=(1,1), padding='same', activation=True, separable=False):
+    conv = SeparableConv2D if separable else Conv2D
+    x = conv(filters, size, strides=strides, padding=padding)(x)
     x = BatchNormalization(axis=1 if dformat == "channels_first" else -1)(x)
     if activation == True:
         x = LeakyReLU(alpha=0.1)(x)
     return x
 
-def residual_block(blockInput, num_filters=16):
+def residual_block(blockInput, num_filters=16, separable=False):
     x = LeakyReLU(alpha=0.1)(blockInput)
     x = BatchNormalization()(x)
     blockInput = BatchNormalization(axis=1 if dformat == "channels_first" else -1)(blockInput)
-    x = convolution_block(x, num_filters, (3,3) )
-    x = convolution_block(x, num_filters, (3,3), activation=False)
+    x = convolution_block(x, num_filters, (3,3), separable=separable)
+    x = convolution_block(x, num_filters, (3,3), activation=False, separable=separable)
     x = Add()([x, blockInput])
     return x
@@ -1,7 +1,8 @@
 from tensorflow.keras.layers import LeakyReLU, MaxPooling2D, Dropout, Conv2D, Conv2DTranspose, \
-                             concatenate
+                             SeparableConv2D, UpSampling2D, concatenate
 from tensorflow.keras.models import Model
-from pneumothorax_seg.models.efficientnet.models import EfficientNetB4
+from pneumothorax_seg.models.efficientnet.models import EFFICIENTNETS, get_feature_taps
+from pneumothorax_seg.models.mixed_precision import with_precision_policy
 from .model_utils import residual_block
 
 import tensorflow.keras.backend as K
@@ -11,25 +12,35 @@ if K.image_data_format() == "channels_first":
     from functools import partial
     concatenate = partial(concatenate, axis=1)
 
-def UEfficientNet(input_shape=(None, None, 3), dropout_rate=0.1):
+@with_precision_policy
+def UEfficientNet(input_shape=(None, None, 3), dropout_rate=0.1, encoder_weights="imagenet",
+                  encoder="efficientnet-b4"):
     """
-    EfficientNetB4 Encoder + U-Net-style Decoder.
+    EfficientNet (B4 by default) Encoder + U-Net-style Decoder.
     Only compatible with channels_last because of how the EfficientNet weights are
     all channels_last.
 
     Args:
         input_shape (tuple): input shape (x,y, 3). Defaults to (None, None, 3).
         dropout_rate (float): <-
+        encoder_weights (str): one of `imagenet` (default) or None (random initialization). Use None when the
+            fine-tuned weights are loaded right after (i.e. at inference) to skip loading the ImageNet weights.
+        encoder (str): one of `efficientnet-b0` to `efficientnet-b7`. Defaults to `efficientnet-b4`.
+            The skip connections are the encoder's feature taps at strides 2, 4, 8 and 16.
+        precision (str): one of None/`float32` (default), `mixed_float16` or `mixed_bfloat16`.
+            Mixed precision models compute in half precision with float32 weights and a float32
+            sigmoid head; compile them with `models.mixed_precision.wrap_optimizer` for loss scaling.
     Returns:
         uncompiled tf.keras.models Model
     """
-    backbone = EfficientNetB4(weights='imagenet',
-                            include_top=False,
-                            input_shape=input_shape)
+    backbone = EFFICIENTNETS[encoder](weights=encoder_weights,
+                                      include_top=False,
+                                      input_shape=input_shape)
     input = backbone.input
+    skips = get_feature_taps(backbone, strides=(2, 4, 8, 16))
     start_neurons = 16
 
-    conv4 = backbone.layers[342].output
+    conv4 = skips[16]
     conv4 = LeakyReLU(alpha=0.1)(conv4)
     pool4 = MaxPooling2D((2, 2))(conv4)
     pool4 = Dropout(dropout_rate)(pool4)
@@ -50,7 +61,7 @@ def UEfficientNet(input_shape=(None, None, 3), dropout_rate=0.1):
     uconv4 = LeakyReLU(alpha=0.1)(uconv4)
 
     deconv3 = Conv2DTranspose(start_neurons * 8, (3, 3), strides=(2, 2), padding="same")(uconv4)
-    conv3 = backbone.layers[154].output
+    conv3 = skips[8]
     uconv3 = concatenate([deconv3, conv3])
     uconv3 = Dropout(dropout_rate)(uconv3)
 
@@ -60,7 +71,7 @@ def UEfficientNet(input_shape=(None, None, 3), dropout_rate=0.1):
     uconv3 = LeakyReLU(alpha=0.1)(uconv3)
 
     deconv2 = Conv2DTranspose(start_neurons * 4, (3, 3), strides=(2, 2), padding="same")(uconv3)
-    conv2 = backbone.layers[92].output
+    conv2 = skips[4]
     uconv2 = concatenate([deconv2, conv2])
 
     uconv2 = Dropout(0.1)(uconv2)
@@ -70,7 +81,7 @@ def UEfficientNet(input_shape=(None, None, 3), dropout_rate=0.1):
     uconv2 = LeakyReLU(alpha=0.1)(uconv2)
 
     deconv1 = Conv2DTranspose(start_neurons * 2, (3, 3), strides=(2, 2), padding="same")(uconv2)
-    conv1 = backbone.layers[30].output
+    conv1 = skips[2]
     uconv1 = concatenate([deconv1, conv1])
 
     uconv1 = Dropout(0.1)(uconv1)
@@ -87,14 +98,17 @@ def UEfficientNet(input_shape=(None, None, 3), dropout_rate=0.1):
     uconv0 = LeakyReLU(alpha=0.1)(uconv0)
 
     uconv0 = Dropout(dropout_rate/2)(uconv0)
-    output_layer = Conv2D(1, (1,1), padding="same", activation="sigmoid")(uconv0)
+    # float32 head for numerically stable sigmoid outputs/losses under mixed precision
+    output_layer = Conv2D(1, (1,1), padding="same", activation="sigmoid", dtype="float32")(uconv0)
 
     model = Model(input, output_layer)
     return model
 
-def UEfficientNetpp(input_shape=(None, None, 3), dropout_rate=0.1):
+@with_precision_policy
+def UEfficientNetpp(input_shape=(None, None, 3), dropout_rate=0.1, encoder_weights="imagenet",
+                    encoder="efficientnet-b4"):
     """
-    EfficientNetB4 Encoder + U-Net++-style Decoder.
+    EfficientNet (B4 by default) Encoder + U-Net++-style Decoder.
     From: https://www.kaggle.com/meaninglesslives/unet-plus-plus-with-efficientnet-encoder
     Only compatible with channels_last because of how the EfficientNet weights are
     all channels_last.
@@ -102,16 +116,24 @@ def UEfficientNetpp(input_shape=(None, None, 3), dropout_rate=0.1):
     Args:
         input_shape (tuple): input shape (x,y, 3). Defaults to (None, None, 3).
         dropout_rate (float): <-
+        encoder_weights (str): one of `imagenet` (default) or None (random initialization). Use None when the
+            fine-tuned weights are loaded right after (i.e. at inference) to skip loading the ImageNet weights.
+        encoder (str): one of `efficientnet-b0` to `efficientnet-b7`. Defaults to `efficientnet-b4`.
+            The skip connections are the encoder's feature taps at strides 2, 4, 8 and 16.
+        precision (str): one of None/`float32` (default), `mixed_float16` or `mixed_bfloat16`.
+            Mixed precision models compute in half precision with float32 weights and a float32
+            sigmoid head; compile them with `models.mixed_precision.wrap_optimizer` for loss scaling.
     Returns:
         uncompiled tf.keras.models Model
     """
-    backbone = EfficientNetB4(weights='imagenet',
-                            include_top=False,
-                            input_shape=input_shape)
+    backbone = EFFICIENTNETS[encoder](weights=encoder_weights,
+                                      include_top=False,
+                                      input_shape=input_shape)
     input = backbone.input
+    skips = get_feature_taps(backbone, strides=(2, 4, 8, 16))
     start_neurons = 8
 
-    conv4 = backbone.layers[342].output
+    conv4 = skips[16]
     conv4 = LeakyReLU(alpha=0.1)(conv4)
     pool4 = MaxPooling2D((2, 2))(conv4)
     pool4 = Dropout(dropout_rate)(pool4)
@@ -137,7 +159,7 @@ def UEfficientNetpp(input_shape=(None, None, 3), dropout_rate=0.1):
     deconv3 = Conv2DTranspose(start_neurons * 8, (3, 3), strides=(2, 2), padding="same")(uconv4)
     deconv3_up1 = Conv2DTranspose(start_neurons * 8, (3, 3), strides=(2, 2), padding="same")(deconv3)
     deconv3_up2 = Conv2DTranspose(start_neurons * 8, (3, 3), strides=(2, 2), padding="same")(deconv3_up1)
-    conv3 = backbone.layers[154].output
+    conv3 = skips[8]
     uconv3 = concatenate([deconv3,deconv4_up1, conv3])
     uconv3 = Dropout(dropout_rate)(uconv3)
 
@@ -148,7 +170,7 @@ def UEfficientNetpp(input_shape=(None, None, 3), dropout_rate=0.1):
 
     deconv2 = Conv2DTranspose(start_neurons * 4, (3, 3), strides=(2, 2), padding="same")(uconv3)
     deconv2_up1 = Conv2DTranspose(start_neurons * 4, (3, 3), strides=(2, 2), padding="same")(deconv2)
-    conv2 = backbone.layers[92].output
+    conv2 = skips[4]
     uconv2 = concatenate([deconv2,deconv3_up1,deconv4_up2, conv2])
 
     uconv2 = Dropout(0.1)(uconv2)
@@ -158,7 +180,7 @@ def UEfficientNetpp(input_shape=(None, None, 3), dropout_rate=0.1):
     uconv2 = LeakyReLU(alpha=0.1)(uconv2)
 
     deconv1 = Conv2DTranspose(start_neurons * 2, (3, 3), strides=(2, 2), padding="same")(uconv2)
-    conv1 = backbone.layers[30].output
+    conv1 = skips[2]
     uconv1 = concatenate([deconv1,deconv2_up1,deconv3_up2,deconv4_up3, conv1])
 
     uconv1 = Dropout(0.1)(uconv1)
@@ -175,7 +197,121 @@ def UEfficientNetpp(input_shape=(None, None, 3), dropout_rate=0.1):
     uconv0 = LeakyReLU(alpha=0.1)(uconv0)
 
     uconv0 = Dropout(dropout_rate/2)(uconv0)
-    output_layer = Conv2D(1, (1,1), padding="same", activation="sigmoid")(uconv0)
+    # float32 head for numerically stable sigmoid outputs/losses under mixed precision
+    output_layer = Conv2D(1, (1,1), padding="same", activation="sigmoid", dtype="float32")(uconv0)
+
+    model = Model(input, output_layer)
+    return model
+
+# presets for `UEfficientNetppLite` (see `models.profiling.profile_models` to compare them)
+DECODER_VARIANTS = {
+    "bilinear": {"upsampling": "bilinear", "separable": False, "width_multiplier": 1.0},
+    "separable": {"upsampling": "transpose", "separable": True, "width_multiplier": 1.0},
+    "lite": {"upsampling": "bilinear", "separable": True, "width_multiplier": 1.0},
+    "lite_0.5x": {"upsampling": "bilinear", "separable": True, "width_multiplier": 0.5},
+}
+
+@with_precision_policy
+def UEfficientNetppLite(input_shape=(None, None, 3), dropout_rate=0.1, encoder_weights="imagenet",
+                        encoder="efficientnet-b4", upsampling="bilinear", separable=True, width_multiplier=1.0):
+    """
+    EfficientNet (B4 by default) Encoder + lightweight U-Net++-style Decoder.
+    Same topology as `UEfficientNetpp`, but the dense skips (deconv4_up1..up3, deconv3_up1..up2, deconv2_up1)
+    are a single 1x1 conv per source that is bilinearly upsampled to each resolution, instead of ten separate
+    Conv2DTranspose chains.
+    Only compatible with channels_last because of how the EfficientNet weights are
+    all channels_last.
+
+    Args:
+        input_shape (tuple): input shape (x,y, 3). Defaults to (None, None, 3).
+        dropout_rate (float): <-
+        encoder_weights (str): one of `imagenet` (default) or None (random initialization).
+        encoder (str): one of `efficientnet-b0` to `efficientnet-b7`. Defaults to `efficientnet-b4`.
+        upsampling (str): upsampling of the main decoder path; either `bilinear` (bilinear upsampling + 1x1 conv)
+            or `transpose` (Conv2DTranspose like `UEfficientNetpp`). Defaults to `bilinear`.
+        separable (bool): whether or not to use depthwise-separable 3x3 decoder convolutions. Defaults to True.
+        width_multiplier (float): multiplier for the number of decoder channels (8 * width_multiplier at the
+            full resolution). Defaults to 1.0 (same widths as `UEfficientNetpp`).
+        precision (str): one of None/`float32` (default), `mixed_float16` or `mixed_bfloat16`.
+    Returns:
+        uncompiled tf.keras.models Model
+    """
+    if upsampling not in ("bilinear", "transpose"):
+        raise ValueError("`upsampling` must be one of `bilinear` or `transpose`.")
+    backbone = EFFICIENTNETS[encoder](weights=encoder_weights,
+                                      include_top=False,
+                                      input_shape=input_shape)
+    input = backbone.input
+    skips = get_feature_taps(backbone, strides=(2, 4, 8, 16))
+    start_neurons = max(1, int(round(8 * width_multiplier)))
+    conv = SeparableConv2D if separable else Conv2D
+
+    def upsample(x, filters):
+        if upsampling == "transpose":
+            return Conv2DTranspose(filters, (3, 3), strides=(2, 2), padding="same")(x)
+        x = UpSampling2D((2, 2), interpolation="bilinear")(x)
+        return Conv2D(filters, (1, 1), padding="same")(x)
+
+    def dense_skips(x, filters, n):
+        # one shared projection, upsampled by 2, 4, ..., 2**n
+        x = Conv2D(filters, (1, 1), padding="same")(x)
+        return [UpSampling2D((2**k, 2**k), interpolation="bilinear")(x) for k in range(1, n+1)]
+
+    conv4 = skips[16]
+    conv4 = LeakyReLU(alpha=0.1)(conv4)
+    pool4 = MaxPooling2D((2, 2))(conv4)
+    pool4 = Dropout(dropout_rate)(pool4)
+
+    # Middle
+    convm = conv(start_neurons * 32, (3, 3), activation=None, padding="same")(pool4)
+    convm = residual_block(convm, start_neurons * 32, separable=separable)
+    convm = residual_block(convm, start_neurons * 32, separable=separable)
+    convm = LeakyReLU(alpha=0.1)(convm)
+
+    deconv4 = upsample(convm, start_neurons * 16)
+    deconv4_up1, deconv4_up2, deconv4_up3 = dense_skips(deconv4, start_neurons * 8, 3)
+    uconv4 = concatenate([deconv4, conv4])
+    uconv4 = Dropout(dropout_rate)(uconv4)
+
+    uconv4 = conv(start_neurons * 16, (3, 3), activation=None, padding="same")(uconv4)
+    uconv4 = residual_block(uconv4, start_neurons * 16, separable=separable)
+    uconv4 = LeakyReLU(alpha=0.1)(uconv4)
+
+    deconv3 = upsample(uconv4, start_neurons * 8)
+    deconv3_up1, deconv3_up2 = dense_skips(deconv3, start_neurons * 4, 2)
+    uconv3 = concatenate([deconv3, deconv4_up1, skips[8]])
+    uconv3 = Dropout(dropout_rate)(uconv3)
+
+    uconv3 = conv(start_neurons * 8, (3, 3), activation=None, padding="same")(uconv3)
+    uconv3 = residual_block(uconv3, start_neurons * 8, separable=separable)
+    uconv3 = LeakyReLU(alpha=0.1)(uconv3)
+
+    deconv2 = upsample(uconv3, start_neurons * 4)
+    deconv2_up1, = dense_skips(deconv2, start_neurons * 2, 1)
+    uconv2 = concatenate([deconv2, deconv3_up1, deconv4_up2, skips[4]])
+
+    uconv2 = Dropout(0.1)(uconv2)
+    uconv2 = conv(start_neurons * 4, (3, 3), activation=None, padding="same")(uconv2)
+    uconv2 = residual_block(uconv2, start_neurons * 4, separable=separable)
+    uconv2 = LeakyReLU(alpha=0.1)(uconv2)
+
+    deconv1 = upsample(uconv2, start_neurons * 2)
+    uconv1 = concatenate([deconv1, deconv2_up1, deconv3_up2, deconv4_up3, skips[2]])
+
+    uconv1 = Dropout(0.1)(uconv1)
+    uconv1 = conv(start_neurons * 2, (3, 3), activation=None, padding="same")(uconv1)
+    uconv1 = residual_block(uconv1, start_neurons * 2, separable=separable)
+    uconv1 = LeakyReLU(alpha=0.1)(uconv1)
+
+    uconv0 = upsample(uconv1, start_neurons * 1)
+    uconv0 = Dropout(0.1)(uconv0)
+    uconv0 = conv(start_neurons * 1, (3, 3), activation=None, padding="same")(uconv0)
+    uconv0 = residual_block(uconv0, start_neurons * 1, separable=separable)
+    uconv0 = LeakyReLU(alpha=0.1)(uconv0)
+
+    uconv0 = Dropout(dropout_rate/2)(uconv0)
+    # float32 head for numerically stable sigmoid outputs/losses under mixed precision
+    output_layer = Conv2D(1, (1,1), padding="same", activation="sigmoid", dtype="float32")(uconv0)
 
     model = Model(input, output_layer)
     return model
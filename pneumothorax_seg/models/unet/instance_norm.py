@@ -1,6 +1,8 @@
+import tensorflow as tf
 from tensorflow.keras.layers import Layer, InputSpec
 from tensorflow.keras import initializers, regularizers, constraints
 from tensorflow.keras import backend as K
+from tensorflow.keras.utils import get_custom_objects
 
 
 class InstanceNormalization(Layer):
@@ -146,11 +148,58 @@ class InstanceNormalization(Layer):
         base_config = super(InstanceNormalization, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
+class FusedInstanceNormalization(InstanceNormalization):
+    """Instance normalization layer with fused statistics and scale/shift.
+
+    Drop-in replacement for `InstanceNormalization` (same arguments, weights,
+    config and outputs), so existing weights load as is. The statistics are
+    computed with one `tf.nn.moments` op and the normalization, scale and shift
+    are applied as a single multiply-add:
+        outputs = inputs * a + b
+        a = gamma / (std + epsilon), b = beta - mean * a
+    where `a` and `b` only have the (small) shape of the statistics.
+    Training and inference use the same statistics: `tf.nn.moments` takes the
+    variance around the mean, which stays exact in float32 for inputs with a
+    large mean (unlike E[x^2] - E[x]^2).
+    """
+    def call(self, inputs, training=None):
+        ndim = len(K.int_shape(inputs))
+        reduction_axes = [i for i in range(1, ndim) if self.axis is None or i != self.axis % ndim]
+        broadcast_shape = [1] * ndim
+        if self.axis is not None:
+            broadcast_shape[self.axis] = K.int_shape(inputs)[self.axis]
+
+        def normalize(mean, variance):
+            a = 1. / (tf.sqrt(variance) + self.epsilon)
+            if self.scale:
+                a = a * K.reshape(self.gamma, broadcast_shape)
+            b = -mean * a
+            if self.center:
+                b = b + K.reshape(self.beta, broadcast_shape)
+            return inputs * a + b
+
+        return normalize(*tf.nn.moments(inputs, reduction_axes, keepdims=True))
+
+
+get_custom_objects().update({
+    'InstanceNormalization': InstanceNormalization,
+    'FusedInstanceNormalization': FusedInstanceNormalization,
+})
+
+
 if __name__ == "__main__":
     from tensorflow.keras.layers import Input
     from tensorflow.keras.models import Model
+    from pneumothorax_seg.models.profiling import benchmark_layers, check_layer_equivalence
 
     ip = Input(shape=(None, None, 4))
     x = InstanceNormalization(axis=-1, epsilon=0.1)(ip)
     model = Model(ip, x)
     model.summary()
+
+    check_layer_equivalence({"InstanceNormalization": InstanceNormalization(axis=-1),
+                             "FusedInstanceNormalization": FusedInstanceNormalization(axis=-1)},
+                            input_shape=(32, 32, 32))
+    benchmark_layers({"InstanceNormalization": InstanceNormalization(axis=-1),
+                      "FusedInstanceNormalization": FusedInstanceNormalization(axis=-1)},
+                     input_shape=(512, 512, 32), batch_size=4)
@@ -1,7 +1,7 @@
 from tensorflow.keras.layers import Add, Concatenate, MaxPooling2D, \
                                     UpSampling2D, LeakyReLU, \
                                     Conv2D, BatchNormalization
-from pneumothorax_seg.models.unet.instance_norm import InstanceNormalization
+from pneumothorax_seg.models.unet.instance_norm import FusedInstanceNormalization
 from tensorflow.keras import backend as K
 
 def localization_module_2D(input_layer, skip_layer, n_filters, upsampling_size=(2,2), n_convs=2, instance_norm=True):
@@ -45,7 +45,7 @@ def context_module_2D(input_layer, n_filters, pool_size=(2,2), n_convs=2, instan
             conv = Conv2D(n_filters, kernel_size=(3,3), padding='same')(bn)
         act = LeakyReLU(0.3)(conv)
         if instance_norm:
-            bn = InstanceNormalization(axis=1 if data_format == "channels_first" else -1)(act)
+            bn = FusedInstanceNormalization(axis=1 if data_format == "channels_first" else -1)(act)
         else:
             bn = BatchNormalization(axis=1 if data_format == "channels_first" else -1)(act)
     if pool_size is not None:
@@ -8,9 +8,9 @@ from tensorflow.keras.losses import mse
 from tensorflow.keras.layers import Conv2D, Activation, Add, UpSampling2D, Lambda, Dense, \
                                     Input, Reshape, Flatten, Dropout
 from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.models import Model
+from tensorflow.keras.models import Model, load_model
 
-from pneumothorax_seg.models.vae_cnn.group_norm import GroupNormalization
+from pneumothorax_seg.models.vae_cnn.group_norm import FusedGroupNormalization
 from pneumothorax_seg.models.losses_metrics import my_iou_metric
 
 def green_block(inp, filters, data_format="channels_last", name=None):
@@ -40,11 +40,11 @@ def green_block(inp, filters, data_format="channels_last", name=None):
 
     # axis=1 for channels_first data format
     # No. of groups = 8, as given in the paper
-    x = GroupNormalization(groups=8, axis=1 if data_format == 'channels_first' else -1, name=f'GroupNorm_1_{name}' if name else None)(inp)
+    x = FusedGroupNormalization(groups=8, axis=1 if data_format == 'channels_first' else -1, name=f'GroupNorm_1_{name}' if name else None)(inp)
     x = Activation('relu', name=f'Relu_1_{name}' if name else None)(x)
     x = Conv2D(filters=filters, kernel_size=(3, 3), strides=1, padding='same', data_format=data_format, name=f'Conv2D_1_{name}' if name else None)(x)
 
-    x = GroupNormalization(groups=8, axis=1 if data_format == 'channels_first' else -1, name=f'GroupNorm_2_{name}' if name else None)(x)
+    x = FusedGroupNormalization(groups=8, axis=1 if data_format == 'channels_first' else -1, name=f'GroupNorm_2_{name}' if name else None)(x)
     x = Activation('relu', name=f'Relu_2_{name}' if name else None)(x)
     x = Conv2D(filters=filters, kernel_size=(3, 3), strides=1, padding='same', data_format=data_format, name=f'Conv2D_2_{name}' if name else None)(x)
 
@@ -138,9 +138,10 @@ def loss(input_shape, inp, out_VAE, z_mean, z_var, e=1e-8, weight_L2=0.1, weight
     return loss_
 
 
-def build_model(input_shape=(160, 192, 4), output_channels=3, weight_L2=0.1, weight_KL=0.1, data_format="channels_last"):
+def build_model(input_shape=(160, 192, 4), output_channels=3, weight_L2=0.1, weight_KL=0.1, data_format="channels_last",
+                inference_only=False):
     """
-    build_model(input_shape=(160, 192, 4), output_channels=3, weight_L2=0.1, weight_KL=0.1)
+    build_model(input_shape=(160, 192, 4), output_channels=3, weight_L2=0.1, weight_KL=0.1, inference_only=False)
     -------------------------------------------
     Creates the model used in the BRATS2018 winning solution
     by Myronenko A. (https://arxiv.org/pdf/1810.11654.pdf)
@@ -159,6 +160,10 @@ def build_model(input_shape=(160, 192, 4), output_channels=3, weight_L2=0.1, wei
         results for your task. Defaults to 0.1.\
     `data_format`: str. optional.
         either `channels_last` or `channels_first`
+    `inference_only`: bool, optional.
+        Whether or not to only build the segmentation branch (no VAE decoder, sampling or custom loss).
+        The returned model is uncompiled and has the same weights (in the same order) as the full model,
+        so the full model's checkpoints load into it. Defaults to False.
     Returns
     -------
     `model`: A keras.models.Model instance
@@ -238,12 +243,14 @@ def build_model(input_shape=(160, 192, 4), output_channels=3, weight_L2=0.1, wei
     ### Output Block
     out_GT = Conv2D(filters=output_channels, kernel_size=(1, 1), strides=1, data_format=data_format, activation='sigmoid', name='Dec_GT_Output')(x)
     # No. of tumor classes is 3
+    if inference_only:
+        return Model(inp, out_GT)
 
     ## VAE (Variational Auto Encoder) Part
     # -------------------------------------------------------------------------
 
     ### VD Block (Reducing dimensionality of the data)
-    x = GroupNormalization(groups=8, axis=1 if data_format == 'channels_first' else -1, name='Dec_VAE_VD_GN')(x4)
+    x = FusedGroupNormalization(groups=8, axis=1 if data_format == 'channels_first' else -1, name='Dec_VAE_VD_GN')(x4)
     x = Activation('relu', name='Dec_VAE_VD_relu')(x)
     x = Conv2D(filters=16, kernel_size=(3, 3), strides=2, padding='same', data_format=data_format, name='Dec_VAE_VD_Conv2D')(x)
 
@@ -301,6 +308,58 @@ def build_model(input_shape=(160, 192, 4), output_channels=3, weight_L2=0.1, wei
 
     return model
 
+def to_inference_model(model):
+    """
+    Converts a (trained) VAE-CNN to a segmentation-only model that shares its layers/weights.
+    The VAE branch and its custom loss (`loss_`) are stripped; the returned model is uncompiled.
+    Parameters
+    ----------
+    `model`: A keras.models.Model instance
+        created by `build_model` (or loaded with `load_model(..., compile=False)`)
+    Returns
+    -------
+    `model`: A keras.models.Model instance
+        with the `Dec_GT_Output` output only
+    """
+    return Model(model.inputs[0], model.get_layer('Dec_GT_Output').output)
+
+
+def load_inference_model(fpath, input_shape=(512, 512, 1), output_channels=1, data_format="channels_last"):
+    """
+    Loads a VAE-CNN checkpoint as a segmentation-only model without the custom `loss_` closure.
+    Parameters
+    ----------
+    `fpath`: str
+        path to a .h5 checkpoint; either weights only (`save_weights`, `ModelCheckpoint(save_weights_only=True)`)
+        or a full model (`model.save`)
+    `input_shape`, `output_channels`, `data_format`:
+        the `build_model` arguments of the checkpoint. Only used for weights-only checkpoints.
+        The training model's VAE branch reconstructs 4 channels, so only checkpoints with 1 (broadcasted in the
+        L2 loss, i.e. grayscale radiographs) or 4 input channels exist. Defaults to (512, 512, 1).
+    Returns
+    -------
+    `model`: A keras.models.Model instance
+        uncompiled segmentation-only model
+    """
+    import h5py
+    with h5py.File(fpath, 'r') as f:
+        is_full_model = 'model_config' in f.attrs
+    if is_full_model:
+        # the custom loss isn't deserialized when compile=False
+        return to_inference_model(load_model(fpath, compile=False))
+    c = input_shape[-1] if data_format == "channels_last" else input_shape[0]
+    if c not in (1, 4):
+        raise ValueError("`input_shape` must have 1 or 4 channels (the ones `build_model` can train), "
+                         "got {0}.".format(input_shape))
+    model = build_model(input_shape=input_shape, output_channels=output_channels, data_format=data_format,
+                        inference_only=True)
+    model.load_weights(fpath)
+    return model
+
+
 if __name__ == "__main__":
     model = build_model(output_channels=1)
     model.summary()
+    inference_model = to_inference_model(model)
+    print("Parameters: {0} (training) vs. {1} (inference)".format(model.count_params(),
+                                                                  inference_model.count_params()))
@@ -6,17 +6,90 @@ import numpy as np
 
 from glob import glob
 from pathlib import Path
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import train_test_split, StratifiedKFold
 from os.path import join
 from PIL import Image
 from tqdm import tqdm
+from scipy import ndimage
+from concurrent.futures import ProcessPoolExecutor
 
+from pneumothorax_seg.io.array_store import image_id
 
-def create_fold_and_move(train_dir, save_dir, mask_df, fold=1, split_seed=10, adjust_n_files=True):
+def create_fold_index(mask_df, fold=1, split_seed=10, test_size=0.1, save_dir="."):
+    """
+    Non-destructive version of `create_fold_and_move`: the stratified train/val split is saved as an index
+    file of ImageIds and no files are moved, so any number of folds can coexist on disk.
+    Args:
+        mask_df (pd.DataFrame): from `create_mask_df`
+        fold (int): Fold to create. Only matters for the output .json filename.
+        split_seed (int): Seed for train_test_split.
+        test_size (float): fraction of the images in the validation set
+        save_dir (str): directory to save the fold .json to
+    Returns:
+        path to the fold .json (`fold{fold}_ids.json`); see `load_fold`
+    """
+    ids = [image_id(fn) for fn in mask_df.file_names]
+    train_ids, val_ids = train_test_split(ids, stratify=mask_df.labels, test_size=test_size,
+                                          random_state=split_seed)
+    print("No. of train files: {0}".format(len(train_ids)))
+    print("No. of val files: {0}".format(len(val_ids)))
+    fold_fpath = join(save_dir, "fold{0}_ids.json".format(fold))
+    save_to_json({"train": sorted(train_ids), "val": sorted(val_ids), "split_seed": split_seed}, fold_fpath)
+    return fold_fpath
+
+def create_kfold_indices(mask_df, n_folds=5, split_seed=10, save_dir="."):
+    """
+    Stratified k-fold splits as index files of ImageIds (`fold1_ids.json` ... `fold{n_folds}_ids.json`);
+    every image is in exactly one validation set.
+    Args:
+        mask_df (pd.DataFrame): from `create_mask_df`
+        n_folds (int): number of folds
+        split_seed (int): Seed for StratifiedKFold.
+        save_dir (str): directory to save the fold .jsons to
+    Returns:
+        list of paths to the fold .jsons; see `load_fold`
+    """
+    ids = np.array([image_id(fn) for fn in mask_df.file_names])
+    skf = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=split_seed)
+    fold_fpaths = []
+    for fold, (train_idx, val_idx) in enumerate(skf.split(ids, mask_df.labels), 1):
+        fold_fpath = join(save_dir, "fold{0}_ids.json".format(fold))
+        save_to_json({"train": sorted(ids[train_idx].tolist()), "val": sorted(ids[val_idx].tolist()),
+                      "split_seed": split_seed}, fold_fpath)
+        fold_fpaths.append(fold_fpath)
+    return fold_fpaths
+
+def load_fold(fold, images_dir=None, ext=".png"):
+    """
+    Loads a fold as ImageIds (or as filepaths in `images_dir`). Works with both the index files from
+    `create_fold_index`/`create_kfold_indices` and the filepath .jsons from `create_fold_and_move`.
+    Args:
+        fold (str or dict): path to the fold .json or the loaded fold
+        images_dir (str): directory to resolve the ImageIds in (i.e. for `SegmentationGenerator(fpaths=...)`).
+            Defaults to None (ImageIds; i.e. for `ArraySegmentationGenerator(ids=...)`, which maps them to
+            rows of the array store).
+        ext (str): image file extension
+    Returns:
+        fold_dict (dict): dictionary of `train` and `val` ImageIds/filepaths
+    """
+    if isinstance(fold, str):
+        with open(fold, "r") as fp:
+            fold = json.load(fp)
+    fold_dict = {}
+    for key in ("train", "val"):
+        ids = [image_id(fn) for fn in fold[key]]
+        fold_dict[key] = ids if images_dir is None else [join(images_dir, i + ext) for i in ids]
+    return fold_dict
+
+
+def create_fold_and_move(train_dir, save_dir, mask_df, fold=1, split_seed=10, adjust_n_files=False,
+                         symlink=False):
     """
     Workflow:
         Creates train/val split -> Moves files to separate directories ->
         Creates fold json using those moved directories
+    Only one moved/linked fold can exist at a time (linking a fold replaces the links of the previous one);
+    prefer `create_fold_index`, which doesn't touch the files.
     Args:
         train_dir (str): path to the repacked data's training directory (pre-moving files)
             i.e. "/content/train"
@@ -24,21 +97,25 @@ def create_fold_and_move(train_dir, save_dir, mask_df, fold=1, split_seed=10, ad
         mask_df (pd.DataFrame): from `create_mask_df`
         fold (int): Fold to create. Only matters for the output .json filename.
         split_seed (int): Seed for train_test_split.
-        adjust_n_files (bool): whether or not to adjust the number of files in the
-            fold dictionary to a nice number for clean batch sizes.
+        adjust_n_files (bool): whether or not to drop the last 7 train and 12 val files for clean batch
+            sizes (9600/1056 files with the full dataset). The dropped files are left out of the fold .json.
+        symlink (bool): whether to symlink the files into the train/val directories instead of moving them
     Returns:
         fold_dict (dict): dictionary of `train` and `val` filepaths
     """
     train_fn, val_fn = create_train_val_split(train_dir, mask_df, split_seed=split_seed)
-    move_files_post_split(train_fn, val_fn, save_dir)
+    move_files_post_split(train_fn, val_fn, save_dir, symlink=symlink)
     # for nicer batch sizes
     train_im_path, val_im_path = join(save_dir, "keras_im_train"), join(save_dir, "keras_im_val")
     # creating train/val fpaths lists for the new train/val directories
-    train_fpaths, val_fpaths = glob(join(train_im_path, "*")), glob(join(val_im_path, "*"))
+    # (from the split rather than a glob, since the directories may already hold files from other folds)
+    train_fpaths = [join(train_im_path, Path(fn).name) for fn in train_fn]
+    val_fpaths = [join(val_im_path, Path(fn).name) for fn in val_fn]
 
     if adjust_n_files:
         train_fpaths = train_fpaths[:-7] # 9600
         val_fpaths = val_fpaths[:-12] # 1056
+        print("adjust_n_files: left 7 train and 12 val files out of the fold .json")
     fold_dict = {"train": train_fpaths, "val": val_fpaths}
 
     print("No. of train files: {0}".format(len(train_fpaths)))
@@ -50,7 +127,7 @@ def create_fold_and_move(train_dir, save_dir, mask_df, fold=1, split_seed=10, ad
 
     return fold_dict
 
-def move_files_post_split(train_fn, val_fn, save_dir):
+def move_files_post_split(train_fn, val_fn, save_dir, symlink=False):
     """
     Specific function to move files to separate train/val directories for both
     images and masks after splitting. These directories are: keras_im_train, keras_im_val,
@@ -59,6 +136,8 @@ def move_files_post_split(train_fn, val_fn, save_dir):
         train_fn (list): list of training filepaths before moving. Refer to the `train_fn` output of `create_train_val_split`.
         val_fn (list): list of validation filepaths before moving. Refer to the `val_fn` output of `create_train_val_split`
         save_dir (str): path to the directory to move all of the training/validation directories to
+        symlink (bool): whether to symlink the files instead of moving them. The links of a previously
+            linked fold in these directories are removed first.
     Returns:
         None
     """
@@ -76,9 +155,12 @@ def move_files_post_split(train_fn, val_fn, save_dir):
     val_im_path, val_mask_path = join(save_dir, "keras_im_val"), join(save_dir, "keras_mask_val")
     dirs = [train_im_path, train_mask_path, val_im_path, val_mask_path]
     fns = [train_fn, masks_train_fn, val_fn, masks_val_fn]
-    print("Moving files to the appropriate directories: {0}".format(dirs))
+    print("{0} files to the appropriate directories: {1}".format("Linking" if symlink else "Moving", dirs))
     for directory, fn_list in zip(dirs, fns):
-        move_to_dir(directory, fn_list)
+        if symlink:
+            # links from a previous fold would put its validation images into this fold's training directory
+            clear_links(directory)
+        move_to_dir(directory, fn_list, symlink=symlink)
 
 def create_train_val_split(train_dir, mask_df, split_seed=10):
     """
@@ -92,43 +174,141 @@ def create_train_val_split(train_dir, mask_df, split_seed=10):
     """
     # setting up the file paths
     all_train_fn = glob(os.path.join(train_dir, "*"))
+    # the labels have to be in the same order as the images (both globs are unordered)
+    labels = pd.Series(mask_df.labels.values, index=[image_id(fn) for fn in mask_df.file_names])
+    labels = labels.loc[[image_id(fn) for fn in all_train_fn]].values
 
-    train_fn, val_fn = train_test_split(all_train_fn, stratify=mask_df.labels, test_size=0.1, random_state=split_seed)
+    train_fn, val_fn = train_test_split(all_train_fn, stratify=labels, test_size=0.1, random_state=split_seed)
 
     print("No. of train files: {0}".format(len(train_fn)))
     print("No. of val files: {0}".format(len(val_fn)))
 
     return (train_fn, val_fn)
 
-def create_mask_df(masks_dir):
+MASK_DF_DTYPES = {"mask_percentage": np.float32, "area": np.int32, "bbox_y0": np.int16, "bbox_x0": np.int16,
+                  "bbox_y1": np.int16, "bbox_x1": np.int16, "n_components": np.int16, "labels": np.int8}
+
+def mask_stats(fpath):
+    """
+    Statistics of one mask in a single decode: (mask_percentage, area, bbox_y0, bbox_x0, bbox_y1, bbox_x1,
+    n_components, label). The bounding box is inclusive and -1 for empty masks.
+    """
+    mask = np.asarray(Image.open(fpath)) > 0
+    if mask.ndim == 3:
+        mask = mask.any(axis=-1)
+    area = int(np.count_nonzero(mask))
+    if area == 0:
+        return (0., 0, -1, -1, -1, -1, 0, 0)
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    # only label inside the bounding box
+    crop = mask[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1]
+    n_components = ndimage.label(crop, structure=np.ones((3, 3)))[1]
+    return (area / float(mask.size), area, rows[0], cols[0], rows[-1], cols[-1], n_components, 1)
+
+def _mask_dir_key(masks_dir):
+    """
+    Cache key of a masks directory: number of files and the latest mtime of the directory and its files.
+    """
+    mtimes = [os.stat(masks_dir).st_mtime_ns]
+    n_files = 0
+    for entry in os.scandir(masks_dir):
+        mtimes.append(entry.stat().st_mtime_ns)
+        n_files += 1
+    return {"masks_dir": os.path.abspath(masks_dir), "n_files": n_files, "mtime_ns": max(mtimes)}
+
+def _load_mask_df_cache(cache_path, key):
+    key_path = cache_path + ".key.json"
+    if not (os.path.exists(cache_path) and os.path.exists(key_path)):
+        return None
+    with open(key_path, "r") as fp:
+        if json.load(fp) != key:
+            return None
+    if cache_path.endswith(".parquet"):
+        return pd.read_parquet(cache_path)
+    with np.load(cache_path, allow_pickle=False) as cache:
+        mask_df = pd.DataFrame({column: cache[column] for column in cache.files})
+    mask_df["file_names"] = mask_df["file_names"].astype(str)
+    return mask_df
+
+def _save_mask_df_cache(mask_df, cache_path, key):
+    if cache_path.endswith(".parquet"):
+        mask_df.to_parquet(cache_path, index=False)
+    else:
+        np.savez(cache_path, file_names=mask_df["file_names"].to_numpy(dtype=str),
+                 **{column: mask_df[column].values for column in MASK_DF_DTYPES})
+        # np.savez appends .npz to other extensions
+        if not cache_path.endswith(".npz"):
+            os.replace(cache_path + ".npz", cache_path)
+    with open(cache_path + ".key.json", "w") as fp:
+        json.dump(key, fp)
+
+def create_mask_df(masks_dir, n_workers=None, cache_path=None):
     """
     Creates a DataFrame with some EDA about the labels. This df is mainly used for
     the stratify argument in `train_test_split` for `create_train_val_split`.
+    The masks are decoded in parallel processes (see `mask_stats`) and the DataFrame is built in one go.
     Args:
         masks_dir (str): path to the masks (pre-split)
+        n_workers (int): number of processes. Defaults to None (os.cpu_count()). 1 decodes in this process.
+        cache_path (str): .npz (or .parquet, which needs pyarrow/fastparquet) file to cache the DataFrame in.
+            The cache is reused until a file in `masks_dir` is added, removed or modified.
+            Defaults to None (no caching).
     Returns:
-        mask_df: pandas DataFrame with info on the percentage of pneumothorax in the dataset
-    """
-    all_mask_fn = glob(os.path.join(masks_dir, "*"))
-    mask_df = pd.DataFrame()
-    mask_df["file_names"] = all_mask_fn
-    mask_df["mask_percentage"] = 0
-    mask_df.set_index("file_names", inplace=True)
-    for fn in tqdm(all_mask_fn):
-        mask_df.loc[fn, "mask_percentage"] = np.array(Image.open(fn)).sum()/(256*256*255) #255 is bcz img range is 255
-    mask_df.reset_index(inplace=True)
-    mask_df["labels"] = 0
-    mask_df.loc[mask_df.mask_percentage>0,"labels"] = 1
+        mask_df: pandas DataFrame with the columns `file_names`, `mask_percentage` (fraction of pneumothorax
+            pixels), `area` (pixels), `bbox_y0`, `bbox_x0`, `bbox_y1`, `bbox_x1` (inclusive, -1 if empty),
+            `n_components` (8-connected) and `labels` (1 if there is pneumothorax)
+    """
+    if cache_path is not None:
+        key = _mask_dir_key(masks_dir)
+        mask_df = _load_mask_df_cache(cache_path, key)
+        if mask_df is not None:
+            print("Loaded the mask statistics from {0}".format(cache_path))
+            return mask_df
+    all_mask_fn = sorted(glob(os.path.join(masks_dir, "*")))
+    if n_workers == 1:
+        stats = [mask_stats(fn) for fn in tqdm(all_mask_fn)]
+    else:
+        with ProcessPoolExecutor(n_workers) as executor:
+            stats = list(tqdm(executor.map(mask_stats, all_mask_fn, chunksize=64), total=len(all_mask_fn)))
+    stats = np.array(stats, dtype=np.float64).reshape(len(all_mask_fn), len(MASK_DF_DTYPES))
+    columns = {"file_names": all_mask_fn}
+    for idx, (column, dtype) in enumerate(MASK_DF_DTYPES.items()):
+        columns[column] = stats[:, idx].astype(dtype)
+    mask_df = pd.DataFrame(columns)
+    if cache_path is not None:
+        _save_mask_df_cache(mask_df, cache_path, key)
     return mask_df
 
-def move_to_dir(directory, base_fns):
+def clear_links(directory):
+    """
+    Removes the symlinks (not the regular files) in a directory.
+    Returns:
+        number of removed links (int)
+    """
+    if not os.path.isdir(directory):
+        return 0
+    links = [entry.path for entry in os.scandir(directory) if entry.is_symlink()]
+    for link in links:
+        os.remove(link)
+    if links:
+        print("Removed {0} stale links from {1}".format(len(links), directory))
+    return len(links)
+
+def move_to_dir(directory, base_fns, symlink=False):
     """
-    Moves files to a new directory
+    Moves (or symlinks) files to a directory
     """
-    os.mkdir(directory)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
     for full_fn in base_fns:
         fn = Path(full_fn).name
-        shutil.move(full_fn, os.path.join(directory, fn))
+        if symlink:
+            link = os.path.join(directory, fn)
+            if os.path.islink(link):
+                os.remove(link)
+            os.symlink(os.path.abspath(full_fn), link)
+        else:
+            shutil.move(full_fn, os.path.join(directory, fn))
 
 def save_to_json(file, fpath):
     """
@@ -1,7 +1,10 @@
+import numpy as np
 from tensorflow.keras.optimizers import Optimizer
 import tensorflow.keras.backend as K
 import tensorflow as tf
 
+from pneumothorax_seg.training.wrapped_optimizer import _WrappedOptimizer
+
 class AccumOptimizer(Optimizer):
     """Inheriting Optimizer class, wrapping the original optimizer
     to achieve a new corresponding optimizer of gradient accumulation.
@@ -11,7 +14,7 @@ class AccumOptimizer(Optimizer):
         steps_per_update: the steps of gradient accumulation
     # Returns
         a new keras optimizer.
-    For tensorflow 1.13 and below
+    For tensorflow 1.13 and below (see `GradientAccumulationOptimizer` for 1.14 and higher)
     """
     def __init__(self, optimizer, steps_per_update=1, **kwargs):
         assert float(tf.__version__[:4]) <= 1.13, "Please make sure that your tensorflow version is 1.13.x or lower."
@@ -59,3 +62,126 @@ class AccumOptimizer(Optimizer):
         config = self.optimizer.get_config()
         K.set_value(self.iterations, iterations)
         return config
+
+class GradientAccumulationOptimizer(_WrappedOptimizer):
+    """
+    Wraps an optimizer to sum the gradients of `steps_per_update` micro-batches into on-device slots and apply
+    their mean once, so that i.e. batch_size=4 with steps_per_update=8 trains with an effective batch size of 32.
+    The wrapped optimizer (and its step counter, `iterations`) only runs on the applying steps, so learning rate
+    schedules (i.e. `training.schedules`) and AdamW's weight decay are evaluated per effective batch.
+    BatchNormalization statistics are still updated on every micro-batch.
+    For tensorflow 1.14 and higher (OptimizerV2 API). The wrapped optimizer can be an OptimizerV2 or, on
+    tf >= 2.11, one of the new `tf.keras.optimizers` (names like "adam" resolve to the OptimizerV2 class).
+    Not meant to be used under a tf.distribute strategy.
+        opt = GradientAccumulationOptimizer(AdamW(learning_rate=CosineDecayRestarts(1e-3, 500)), steps_per_update=8)
+        model.compile(opt, loss=bce_dice_loss)
+        model.fit(train_gen, ...)  # train_gen with batch_size=4
+    Args:
+        optimizer: an instance of a tf.keras optimizer to wrap (i.e. Adam, AdamW), its name or its serialized
+            config
+        steps_per_update (int): number of micro-batches to accumulate per weight update
+    """
+    def __init__(self, optimizer, steps_per_update=1, name="GradientAccumulationOptimizer", **kwargs):
+        super(GradientAccumulationOptimizer, self).__init__(optimizer, name, **kwargs)
+        self.steps_per_update = steps_per_update
+
+    def _create_slots(self, var_list):
+        for var in var_list:
+            self.add_slot(var, "accum")
+
+    def apply_gradients(self, grads_and_vars, name=None, **kwargs):
+        grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+        var_list = [v for g, v in grads_and_vars]
+        with tf.init_scope():
+            self._create_all_weights(var_list)
+            # the wrapped optimizer's slots can't be created inside the tf.cond below
+            self._build_optimizer(var_list)
+            if not hasattr(self, "micro_steps"):
+                self.micro_steps = self.add_weight("micro_steps", shape=[], dtype=tf.int64,
+                                                   initializer="zeros", trainable=False)
+        accum_ops = [self.get_slot(v, "accum").assign_add(tf.convert_to_tensor(g)) for g, v in grads_and_vars]
+        with tf.control_dependencies(accum_ops):
+            micro_steps = self.micro_steps.assign_add(1)
+        return tf.cond(tf.equal(micro_steps % self.steps_per_update, 0),
+                       lambda: self._apply_accumulated(var_list, name=name, **kwargs),
+                       lambda: tf.identity(self.optimizer.iterations))
+
+    def _build_optimizer(self, var_list):
+        """
+        Creates the wrapped optimizer's slots (OptimizerV2) or variables (new tf >= 2.11 optimizers).
+        """
+        if hasattr(self.optimizer, "_create_all_weights"):
+            self.optimizer._create_all_weights(var_list)
+        elif hasattr(self.optimizer, "build"):
+            self.optimizer.build(var_list)
+        else:
+            raise TypeError("Can't create the variables of {0}; wrap a tf.keras optimizer.".format(
+                type(self.optimizer).__name__))
+
+    def _apply_accumulated(self, var_list, name=None, **kwargs):
+        """
+        Applies the mean of the accumulated gradients with the wrapped optimizer and resets the accumulators.
+        """
+        accums = [self.get_slot(var, "accum") for var in var_list]
+        grads_and_vars = [(accum / K.cast(self.steps_per_update, accum.dtype), var)
+                          for accum, var in zip(accums, var_list)]
+        train_op = self.optimizer.apply_gradients(grads_and_vars, name=name, **kwargs)
+        with tf.control_dependencies([train_op]):
+            resets = [accum.assign(tf.zeros_like(accum)) for accum in accums]
+        with tf.control_dependencies(resets):
+            return tf.identity(self.optimizer.iterations)
+
+    def get_config(self):
+        config = {"steps_per_update": self.steps_per_update}
+        base_config = super(GradientAccumulationOptimizer, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+def check_accumulation(optimizer_fns, steps_per_update=4, micro_batch_size=2, n_updates=3, seed=0, atol=1e-5):
+    """
+    Trains a linear model with `GradientAccumulationOptimizer(optimizer, steps_per_update)` on micro-batches and
+    with the unwrapped optimizer on the full batches; the mean of the accumulated gradients of a mean-reduced
+    loss is the full batch gradient, so both must end up with the same weights and number of updates.
+    Args:
+        optimizer_fns (dict): of {name: function that returns a new optimizer (instance, name or config)}
+        steps_per_update (int): number of micro-batches per weight update
+        micro_batch_size (int): size of the micro-batches
+        n_updates (int): number of (full batch) weight updates
+        seed (int): random seed for the data and the initial weights
+        atol (float): maximum allowed absolute weight difference
+    Returns:
+        dict of {name: max abs. weight difference}
+    Raises:
+        AssertionError: if the weights differ by more than `atol` or the number of updates doesn't match
+    """
+    rs = np.random.RandomState(seed)
+    batch_size = steps_per_update * micro_batch_size
+    x = rs.normal(size=(batch_size * n_updates, 3)).astype(np.float32)
+    y = rs.normal(size=(batch_size * n_updates, 1)).astype(np.float32)
+    weights = [rs.normal(size=(3, 1)).astype(np.float32), np.zeros((1,), np.float32)]
+    results = {}
+    for name, optimizer_fn in optimizer_fns.items():
+        trained = []
+        for optimizer, fit_batch_size in ((optimizer_fn(), batch_size),
+                                          (GradientAccumulationOptimizer(optimizer_fn(), steps_per_update),
+                                           micro_batch_size)):
+            model = tf.keras.Sequential([tf.keras.layers.Dense(1, input_shape=(3,))])
+            model.set_weights(weights)
+            model.compile(optimizer, loss="mse")
+            model.fit(x, y, batch_size=fit_batch_size, epochs=1, shuffle=False, verbose=0)
+            trained.append((model.get_weights(), int(K.get_value(model.optimizer.iterations))))
+        (reference, ref_updates), (accumulated, n_applied) = trained
+        results[name] = max(float(np.abs(w - w_ref).max()) for w, w_ref in zip(accumulated, reference))
+        print("{0}: max abs. weight difference {1:.2e}, {2} updates".format(name, results[name], n_applied))
+        assert results[name] <= atol, "{0} differs by more than {1}".format(name, atol)
+        assert n_applied == ref_updates == n_updates, "{0}: {1} updates instead of {2}".format(name, n_applied,
+                                                                                            n_updates)
+    return results
+
+if __name__ == "__main__":
+    optimizer_fns = {"name (adam)": lambda: "adam"}
+    if hasattr(tf.keras.optimizers, "legacy"):
+        optimizer_fns["OptimizerV2 Adam"] = lambda: tf.keras.optimizers.legacy.Adam(1e-2)
+        optimizer_fns["Adam (tf >= 2.11)"] = lambda: tf.keras.optimizers.Adam(1e-2)
+    else:
+        optimizer_fns["Adam"] = lambda: tf.keras.optimizers.Adam(1e-2)
+    check_accumulation(optimizer_fns)
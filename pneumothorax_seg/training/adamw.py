@@ -6,12 +6,20 @@ from __future__ import print_function
 
 import six
 import copy
+import time
+import numpy as np
+import tensorflow as tf
 from six.moves import zip
 
 from tensorflow.keras import backend as K
 from tensorflow.keras.utils import serialize_keras_object, deserialize_keras_object
 
 from tensorflow.keras.optimizers import Optimizer
+try:
+    # tf >= 2.11 moved the OptimizerV2 API (apply_gradients + slots) to `legacy`
+    from tensorflow.keras.optimizers.legacy import Optimizer as OptimizerV2
+except ImportError:
+    from tensorflow.keras.optimizers import Optimizer as OptimizerV2
 
 class AdamW(Optimizer):
     """AdamW optimizer.
@@ -112,5 +120,226 @@ class AdamW(Optimizer):
         base_config = super(AdamW, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
+class FusedAdamW(OptimizerV2):
+    """AdamW optimizer for the OptimizerV2 (`apply_gradients`) API.
+    Same arguments and update as `AdamW`, but
+        - m, v and the parameters are updated by the fused `ResourceApplyAdam` kernel (one op per parameter)
+        - the normalized weight decay is computed once per step (not once per parameter)
+        - `learning_rate` can be a `tf.keras.optimizers.schedules.LearningRateSchedule` (i.e. `training.schedules`);
+          the weight decay then follows the schedule multiplier eta_t = learning_rate(t) / learning_rate(0)
+          like in the AdamW paper.
+        - with `multi_tensor=True`, all of the gradients are concatenated and m/v are kept as two flat
+          buffers, so the Adam math runs as a handful of large ops instead of one op per parameter.
+          Not supported under a tf.distribute strategy (falls back to the per-parameter kernel).
+    # Arguments
+        learning_rate: float >= 0 or a LearningRateSchedule. Learning rate.
+        beta_1: float, 0 < beta < 1. Generally close to 1.
+        beta_2: float, 0 < beta < 1. Generally close to 1.
+        epsilon: float >= 0. Fuzz factor. If `None`, defaults to `K.epsilon()`.
+        weight_decay: float >= 0. Weight decay (L2 penalty) (default: 0.025).
+        batch_size: integer >= 1. Batch size used during training.
+        samples_per_epoch: integer >= 1. Number of samples (training points) per epoch.
+        epochs: integer >= 1. Total number of epochs for training.
+        multi_tensor: bool. Whether or not to update all of the parameters at once (see above).
+    For tensorflow 1.14 and higher.
+    """
+
+    def __init__(self, learning_rate=0.001, beta_1=0.9, beta_2=0.999,
+                 epsilon=None, weight_decay=0.025,
+                 batch_size=1, samples_per_epoch=1,
+                 epochs=1, multi_tensor=False, name="FusedAdamW", **kwargs):
+        super(FusedAdamW, self).__init__(name, **kwargs)
+        self._set_hyper('learning_rate', kwargs.get('lr', learning_rate))
+        self._set_hyper('beta_1', beta_1)
+        self._set_hyper('beta_2', beta_2)
+        self._set_hyper('weight_decay', weight_decay)
+        self.epsilon = K.epsilon() if epsilon is None else epsilon
+        self.batch_size = batch_size
+        self.samples_per_epoch = samples_per_epoch
+        self.epochs = epochs
+        self.multi_tensor = multi_tensor
+        # normalized weight decay according to the AdamW paper
+        self._weight_decay_norm = float(np.sqrt(batch_size / (samples_per_epoch * epochs)))
+
+    def _create_slots(self, var_list):
+        if self.multi_tensor:
+            return
+        for var in var_list:
+            self.add_slot(var, 'm')
+        for var in var_list:
+            self.add_slot(var, 'v')
+
+    def _prepare_local(self, var_device, var_dtype, apply_state):
+        super(FusedAdamW, self)._prepare_local(var_device, var_dtype, apply_state)
+        lr_t = apply_state[(var_device, var_dtype)]['lr_t']
+        local_step = tf.cast(self.iterations + 1, var_dtype)
+        beta_1_t = tf.identity(self._get_hyper('beta_1', var_dtype))
+        beta_2_t = tf.identity(self._get_hyper('beta_2', var_dtype))
+        weight_decay = self._get_hyper('weight_decay', var_dtype) * self._weight_decay_norm
+        learning_rate = self._get_hyper('learning_rate')
+        if isinstance(learning_rate, tf.keras.optimizers.schedules.LearningRateSchedule):
+            # schedule multiplier eta_t
+            weight_decay = weight_decay * lr_t / tf.cast(learning_rate(0), var_dtype)
+        apply_state[(var_device, var_dtype)].update(dict(
+            beta_1_t=beta_1_t,
+            beta_2_t=beta_2_t,
+            beta_1_power=tf.pow(beta_1_t, local_step),
+            beta_2_power=tf.pow(beta_2_t, local_step),
+            epsilon=tf.convert_to_tensor(self.epsilon, var_dtype),
+            weight_decay_t=weight_decay))
+
+    def _resource_apply_dense(self, grad, var, apply_state=None):
+        var_device, var_dtype = var.device, var.dtype.base_dtype
+        coefficients = ((apply_state or {}).get((var_device, var_dtype))
+                        or self._fallback_apply_state(var_device, var_dtype))
+        # decoupled weight decay p - w_d * p; the Adam step doesn't depend on p, so the order doesn't matter
+        decay = var.assign_sub(coefficients['weight_decay_t'] * var, use_locking=self._use_locking)
+        with tf.control_dependencies([decay]):
+            return tf.raw_ops.ResourceApplyAdam(
+                var=var.handle,
+                m=self.get_slot(var, 'm').handle,
+                v=self.get_slot(var, 'v').handle,
+                beta1_power=coefficients['beta_1_power'],
+                beta2_power=coefficients['beta_2_power'],
+                lr=coefficients['lr_t'],
+                beta1=coefficients['beta_1_t'],
+                beta2=coefficients['beta_2_t'],
+                epsilon=coefficients['epsilon'],
+                grad=grad,
+                use_locking=self._use_locking)
+
+    def _resource_apply_sparse(self, grad, var, indices, apply_state=None):
+        dense_grad = tf.convert_to_tensor(tf.IndexedSlices(grad, indices, tf.shape(var)))
+        return self._resource_apply_dense(dense_grad, var, apply_state=apply_state)
+
+    def apply_gradients(self, grads_and_vars, name=None, **kwargs):
+        if not self.multi_tensor or tf.distribute.has_strategy():
+            return super(FusedAdamW, self).apply_gradients(grads_and_vars, name=name, **kwargs)
+        grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+        var_list = [v for g, v in grads_and_vars]
+        with tf.name_scope(self._name):
+            with tf.init_scope():
+                self._create_all_weights(var_list)
+                self._create_flat_slots(var_list)
+            if hasattr(self, '_transform_gradients'):
+                # clipnorm/clipvalue
+                grads_and_vars = self._transform_gradients(grads_and_vars)
+            return self._multi_tensor_apply(grads_and_vars)
+
+    def _create_flat_slots(self, var_list):
+        """Creates m and v of all of the parameters as two flat buffers (the first time).
+        """
+        var_ids = [id(var) for var in var_list]
+        if hasattr(self, '_flat_var_ids'):
+            if var_ids != self._flat_var_ids:
+                raise ValueError('`multi_tensor=True` requires the same variables at every step.')
+            return
+        dtypes = set(var.dtype.base_dtype for var in var_list)
+        if len(dtypes) != 1:
+            raise ValueError('`multi_tensor=True` requires all of the variables to have the same dtype.')
+        self._flat_var_ids = var_ids
+        self._flat_sizes = [var.shape.num_elements() for var in var_list]
+        dtype = dtypes.pop()
+        self._flat_m = self.add_weight('flat_m', shape=[sum(self._flat_sizes)], dtype=dtype,
+                                       initializer='zeros', trainable=False)
+        self._flat_v = self.add_weight('flat_v', shape=[sum(self._flat_sizes)], dtype=dtype,
+                                       initializer='zeros', trainable=False)
+
+    def _multi_tensor_apply(self, grads_and_vars):
+        var_dtype = grads_and_vars[0][1].dtype.base_dtype
+        coefficients = self._fallback_apply_state('', var_dtype)
+        beta_1_t, beta_2_t = coefficients['beta_1_t'], coefficients['beta_2_t']
+        grad = tf.concat([tf.reshape(tf.convert_to_tensor(g), [-1]) for g, v in grads_and_vars], axis=0)
+        m_t = self._flat_m.assign(beta_1_t * self._flat_m + (1. - beta_1_t) * grad)
+        v_t = self._flat_v.assign(beta_2_t * self._flat_v + (1. - beta_2_t) * tf.square(grad))
+        # bias corrections according to the Adam paper
+        lr_t = coefficients['lr_t'] * (tf.sqrt(1. - coefficients['beta_2_power']) /
+                                       (1. - coefficients['beta_1_power']))
+        steps = tf.split(lr_t * m_t / (tf.sqrt(v_t) + coefficients['epsilon']), self._flat_sizes)
+        updates = []
+        for (g, var), step in zip(grads_and_vars, steps):
+            new_var = var - tf.reshape(step, tf.shape(var)) - coefficients['weight_decay_t'] * var
+            # Apply constraints.
+            if getattr(var, 'constraint', None) is not None:
+                new_var = var.constraint(new_var)
+            updates.append(var.assign(new_var, use_locking=self._use_locking))
+        with tf.control_dependencies(updates):
+            return self.iterations.assign_add(1)
+
+    def get_config(self):
+        config = {'learning_rate': self._serialize_hyperparameter('learning_rate'),
+                  'beta_1': self._serialize_hyperparameter('beta_1'),
+                  'beta_2': self._serialize_hyperparameter('beta_2'),
+                  'weight_decay': self._serialize_hyperparameter('weight_decay'),
+                  'batch_size': self.batch_size,
+                  'samples_per_epoch': self.samples_per_epoch,
+                  'epochs': self.epochs,
+                  'epsilon': self.epsilon,
+                  'multi_tensor': self.multi_tensor}
+        base_config = super(FusedAdamW, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+def benchmark_optimizers(optimizer_fns, model_fn, input_shape=(256, 256, 3), batch_size=2, n_steps=10,
+                         loss='binary_crossentropy'):
+    """Training throughput (train_on_batch) of a model with different optimizers, i.e.
+        benchmark_optimizers({"AdamW": lambda: AdamW(lr=1e-4), "FusedAdamW": lambda: FusedAdamW(1e-4)},
+                             partial(UEfficientNetpp, encoder_weights=None))
+    In eager mode, also times the optimizer step alone (`apply_gradients` on fixed gradients).
+    # Arguments
+        optimizer_fns: dict of {name: function that creates the optimizer}
+        model_fn: function that builds the model; called with `input_shape=input_shape`
+        input_shape: tuple (h, w, n_channels)
+        batch_size: integer >= 1. Batch size.
+        n_steps: integer >= 1. Number of timed steps (after one warmup step).
+        loss: the keras loss to compile with
+    # Returns
+        dict of {name: {`step_ms`: median train step, `images_per_s`: throughput,
+                        `apply_ms`: median optimizer step (None in graph mode)}}
+    """
+    rs = np.random.RandomState(0)
+    x = rs.uniform(0, 1, size=(batch_size,) + tuple(input_shape)).astype(np.float32)
+    results = {}
+    for name, optimizer_fn in optimizer_fns.items():
+        K.clear_session()
+        model = model_fn(input_shape=input_shape)
+        y = rs.uniform(0, 1, size=(batch_size,) + tuple(K.int_shape(model.outputs[0])[1:])) > 0.5
+        model.compile(optimizer_fn(), loss=loss)
+        model.train_on_batch(x, y.astype(np.float32))
+        times = []
+        for _ in range(n_steps):
+            start = time.perf_counter()
+            model.train_on_batch(x, y.astype(np.float32))
+            times.append(time.perf_counter() - start)
+        step_ms = float(np.median(times)) * 1000
+        results[name] = {'step_ms': step_ms, 'images_per_s': batch_size / step_ms * 1000, 'apply_ms': None}
+        if tf.executing_eagerly():
+            grads = [tf.random.normal(var.shape) * 1e-3 for var in model.trainable_weights]
+            @tf.function
+            def apply_fn():
+                model.optimizer.apply_gradients(zip(grads, model.trainable_weights))
+            apply_fn()
+            times = []
+            for _ in range(n_steps):
+                start = time.perf_counter()
+                apply_fn()
+                times.append(time.perf_counter() - start)
+            results[name]['apply_ms'] = float(np.median(times)) * 1000
+        print('{0}: {1:.1f} ms/step ({2:.2f} images/s), optimizer step: {3}'.format(
+              name, step_ms, results[name]['images_per_s'],
+              'n/a' if results[name]['apply_ms'] is None else '{0:.1f} ms'.format(results[name]['apply_ms'])))
+    K.clear_session()
+    return results
+
 if __name__ == "__main__":
-    opt = AdamW(lr=1e-4, weight_decay=3e-5)
+    from functools import partial
+    from pneumothorax_seg.models.uefficientnet.models import UEfficientNetpp
+
+    optimizer_fns = {'FusedAdamW': lambda: FusedAdamW(1e-4, weight_decay=3e-5),
+                     'FusedAdamW (multi_tensor)': lambda: FusedAdamW(1e-4, weight_decay=3e-5, multi_tensor=True)}
+    try:
+        AdamW(lr=1e-4, weight_decay=3e-5)
+        optimizer_fns['AdamW'] = lambda: AdamW(lr=1e-4, weight_decay=3e-5)
+    except TypeError:
+        # the get_updates optimizer API was removed in tf 2.11
+        print('Skipping AdamW (it requires the get_updates optimizer API).')
+    benchmark_optimizers(optimizer_fns, partial(UEfficientNetpp, encoder_weights=None))
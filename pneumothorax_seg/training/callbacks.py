@@ -3,34 +3,86 @@ import tensorflow.keras.backend as K
 import tensorflow as tf
 import numpy as np
 
-class SWA(callbacks.Callback):
+from pneumothorax_seg.training.swa_utils import compile_backend_fn, recompute_bn_statistics
 
-    def __init__(self, filepath, swa_epoch):
+class SWA(callbacks.Callback):
+    """
+    Stochastic weight averaging. The running average is kept in non-trainable backend variables and updated
+    in-graph with one grouped assign op, so the weights are never copied to the host during training.
+    Args:
+        filepath (str): path to save the averaged weights to at the end of training
+        swa_epoch (int): epoch (0-indexed) to start averaging at
+        swa_freq (int): average every `swa_freq` epochs from `swa_epoch`. With a cyclic lr schedule, set this
+            to the cycle length so that the snapshots are sampled at the end of each cycle. Defaults to 1.
+        batch_freq (int): if not None, average every `batch_freq` batches (from `swa_epoch`) instead of at the
+            end of the epochs. Defaults to None.
+        bn_data: (Sequence, generator of batches, or np.ndarray of inputs) data to recompute the
+            BatchNormalization statistics with once the averaged weights are set. Defaults to None, which
+            keeps the averaged statistics.
+        bn_steps (int): number of batches of `bn_data` to recompute the statistics with. Defaults to None (all).
+    """
+    def __init__(self, filepath, swa_epoch, swa_freq=1, batch_freq=None, bn_data=None, bn_steps=None):
         super(SWA, self).__init__()
         self.filepath = filepath
         self.swa_epoch = swa_epoch
+        self.swa_freq = swa_freq
+        self.batch_freq = batch_freq
+        self.bn_data = bn_data
+        self.bn_steps = bn_steps
 
     def on_train_begin(self, logs=None):
         self.nb_epoch = self.params["epochs"]
         print("Stochastic weight averaging selected for last {} epochs."
               .format(self.nb_epoch - self.swa_epoch))
+        self.current_epoch = 0
+        self.n_batches_seen = 0
+        self.n_models = 0
+        with K.name_scope("swa"):
+            self.n_averaged = K.variable(0., name="n_averaged")
+            self.swa_weights = [K.zeros(K.int_shape(w), dtype=K.dtype(w), name="swa_weight_{0}".format(idx))
+                                for idx, w in enumerate(self.model.weights)]
+        self._update_swa = compile_backend_fn(self._build_swa_update)
+        self._assign_swa = compile_backend_fn(self._build_swa_assign)
 
-    def on_epoch_end(self, epoch, logs=None):
+    def _build_swa_update(self):
+        """
+        swa = (swa * n + w) / (n + 1) for every weight in one op
+        """
+        n = self.n_averaged
+        updates = [K.update(swa_w, (swa_w * K.cast(n, K.dtype(swa_w)) + w) / K.cast(n + 1., K.dtype(swa_w)))
+                   for swa_w, w in zip(self.swa_weights, self.model.weights)]
+        with tf.control_dependencies(updates):
+            return K.update_add(n, 1.)
 
-        if epoch == self.swa_epoch:
-            self.swa_weights = self.model.get_weights()
+    def _build_swa_assign(self):
+        return tf.group(*[K.update(w, swa_w) for w, swa_w in zip(self.model.weights, self.swa_weights)])
 
-        elif epoch > self.swa_epoch:
-            for i in range(len(self.swa_weights)):
-                self.swa_weights[i] = (self.swa_weights[i] *
-                    (epoch - self.swa_epoch) + self.model.get_weights()[i])/((epoch - self.swa_epoch)  + 1)
+    def update_average(self):
+        self._update_swa()
+        self.n_models += 1
 
-        else:
-            pass
+    def on_epoch_begin(self, epoch, logs=None):
+        self.current_epoch = epoch
+
+    def on_batch_end(self, batch, logs=None):
+        self.n_batches_seen += 1
+        if self.batch_freq is not None and self.current_epoch >= self.swa_epoch \
+           and self.n_batches_seen % self.batch_freq == 0:
+            self.update_average()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.batch_freq is None and epoch >= self.swa_epoch and (epoch - self.swa_epoch) % self.swa_freq == 0:
+            self.update_average()
 
     def on_train_end(self, logs=None):
-        self.model.set_weights(self.swa_weights)
-        print("Final model parameters set to stochastic weight average.")
+        if self.n_models == 0:
+            print("No weights were averaged (swa_epoch={0}); keeping the final weights.".format(self.swa_epoch))
+            return
+        self._assign_swa()
+        print("Final model parameters set to stochastic weight average of {0} models.".format(self.n_models))
+        if self.bn_data is not None:
+            n_steps = recompute_bn_statistics(self.model, self.bn_data, steps=self.bn_steps)
+            print("Recomputed the BatchNormalization statistics with {0} batches.".format(n_steps))
         self.model.save_weights(self.filepath)
         print("Final stochastic averaged weights saved to file.")
 
@@ -49,6 +101,7 @@ class CyclicLR(callbacks.Callback):
         A cycle that scales initial amplitude by gamma**(cycle iterations) at each
         cycle iteration.
     For more detail, please see paper.
+    See `training.schedules.CyclicalLearningRate` for an in-graph version without per-batch lr syncs.
 
     # Example
         ```python
@@ -170,17 +223,51 @@ class SnapshotCallbackBuilder:
         self.M = nb_snapshots
         self.alpha_zero = init_lr
 
-    def get_callbacks(self, swa, monitor="val_my_iou_metric", mode="max", model_prefix="Model"):
-
+    def get_callbacks(self, swa, monitor="val_my_iou_metric", mode="max", model_prefix="Model",
+                      snapshot_store=None, in_graph_schedule=False):
+        """
+        Args:
+            swa (SWA): the SWA callback
+            monitor (str): metric to monitor for ModelCheckpoint
+            mode (str): either "min" or "max" to complement monitor
+            snapshot_store (training.snapshots.SnapshotStore): if not None, the weights at the end of every cosine
+                cycle are captured into this store (instead of having to reload .h5 models for ensembling).
+            in_graph_schedule (bool): whether or not the optimizer was created with `get_schedule` (step-level
+                cosine annealing). If so, the epoch-level LearningRateScheduler is replaced with a
+                LearningRateLogger.
+        """
+        if in_graph_schedule:
+            from pneumothorax_seg.training.schedules import LearningRateLogger
+            lr_callback = LearningRateLogger()
+        else:
+            lr_callback = callbacks.LearningRateScheduler(schedule=self._cosine_anneal_schedule, verbose=1)
         callback_list = [
             callbacks.ModelCheckpoint("./keras.model", monitor=monitor,
                                    mode=mode, save_best_only=True, verbose=1),
             swa,
-            callbacks.LearningRateScheduler(schedule=self._cosine_anneal_schedule, verbose=1)
+            lr_callback
         ]
+        if snapshot_store is not None:
+            from pneumothorax_seg.training.snapshots import SnapshotCapture
+            callback_list.append(SnapshotCapture(snapshot_store, self.T, self.M))
 
         return callback_list
 
+    def get_schedule(self, steps_per_epoch):
+        """
+        Step-level cosine annealing schedule that is evaluated in-graph; pass it as the optimizer's learning rate
+        and use get_callbacks(..., in_graph_schedule=True). Its cycles are (nb_epochs // nb_snapshots) epochs long,
+        like `_cosine_anneal_schedule` and `SnapshotCapture`, so it matches the epoch-level schedule at the start
+        of every epoch.
+        Args:
+            steps_per_epoch (int): number of training iterations per epoch
+        Returns:
+            training.schedules.SnapshotCosine
+        """
+        from pneumothorax_seg.training.schedules import SnapshotCosine
+        return SnapshotCosine(self.alpha_zero, self.T * steps_per_epoch, self.M,
+                              cycle_steps=(self.T // self.M) * steps_per_epoch)
+
     def _cosine_anneal_schedule(self, t):
         cos_inner = np.pi * (t % (self.T // self.M))  # t - 1 is used when t has 1-based indexing.
         cos_inner /= self.T // self.M
@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import socket
+import shutil
+import tempfile
+import itertools
+import subprocess
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras as keras
+import tensorflow.keras.callbacks as callbacks
+
+from pneumothorax_seg.training.callbacks import SWA
+from pneumothorax_seg.training.snapshots import SnapshotStore, SnapshotCapture
+from pneumothorax_seg.training.weight_averaging import ApplyMovingAverage
+
+# (callback class, attribute with the path it writes to)
+FILE_CALLBACKS = ((SWA, "filepath"), (ApplyMovingAverage, "filepath"), (callbacks.ModelCheckpoint, "filepath"),
+                  (callbacks.CSVLogger, "filename"), (callbacks.TensorBoard, "log_dir"))
+
+def get_strategy(name="auto"):
+    """
+    Creates the tf.distribute strategy to build and train the models under.
+    Args:
+        name (str): one of
+            `default`: one device (no-op strategy)
+            `mirrored`: all local GPUs (MirroredStrategy)
+            `multi_worker`: MultiWorkerMirroredStrategy over the cluster in the `TF_CONFIG` environment variable
+                (see `launch_local_workers`)
+            `auto`: `multi_worker` if `TF_CONFIG` is set, `mirrored` with more than one GPU, `default` otherwise
+    Returns:
+        tf.distribute.Strategy
+    """
+    if name == "auto":
+        if "TF_CONFIG" in os.environ:
+            name = "multi_worker"
+        elif len(tf.config.experimental.list_physical_devices("GPU")) > 1:
+            name = "mirrored"
+        else:
+            name = "default"
+    if name == "multi_worker":
+        try:
+            return tf.distribute.MultiWorkerMirroredStrategy()
+        except AttributeError:
+            # tf < 2.4
+            return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+    elif name == "mirrored":
+        return tf.distribute.MirroredStrategy()
+    elif name == "default":
+        return tf.distribute.get_strategy()
+    raise ValueError("`name` must be one of `auto`, `default`, `mirrored` or `multi_worker`.")
+
+def is_chief(strategy=None):
+    """
+    Whether or not this process is the chief: the `chief` task, or worker 0 when the cluster has no chief.
+    Always True outside of multi-worker training.
+    """
+    resolver = getattr(strategy, "cluster_resolver", None)
+    if resolver is not None and resolver.task_type is not None:
+        task_type, task_id = resolver.task_type, resolver.task_id
+        has_chief = "chief" in resolver.cluster_spec().as_dict()
+    elif "TF_CONFIG" in os.environ:
+        tf_config = json.loads(os.environ["TF_CONFIG"])
+        task_type, task_id = tf_config["task"]["type"], tf_config["task"]["index"]
+        has_chief = "chief" in tf_config["cluster"]
+    else:
+        return True
+    return task_type == "chief" or (task_type == "worker" and task_id == 0 and not has_chief)
+
+def scale_learning_rate(base_lr, global_batch_size, base_batch_size=16, rule="linear"):
+    """
+    Scales a learning rate that was tuned for `base_batch_size` to the global batch size (over all replicas).
+    Args:
+        base_lr (float): learning rate for `base_batch_size`
+        global_batch_size (int): batch size per step summed over all replicas
+        base_batch_size (int): batch size that `base_lr` was tuned for
+        rule (str): `linear` (https://arxiv.org/abs/1706.02677), `sqrt` (usually better for Adam) or `none`
+    Returns:
+        the scaled learning rate (float)
+    """
+    ratio = global_batch_size / float(base_batch_size)
+    if rule == "linear":
+        return base_lr * ratio
+    elif rule == "sqrt":
+        return base_lr * np.sqrt(ratio)
+    elif rule == "none":
+        return base_lr
+    raise ValueError("`rule` must be one of `linear`, `sqrt` or `none`.")
+
+class _RemoveDirectory(callbacks.Callback):
+    def __init__(self, directory):
+        super(_RemoveDirectory, self).__init__()
+        self.directory = directory
+
+    def on_train_end(self, logs=None):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def get_worker_callbacks(callbacks_list, strategy=None):
+    """
+    Makes the callbacks that write files (SWA, snapshots, checkpoints, logs) only write on the chief.
+    Under MultiWorkerMirroredStrategy, creating variables (SWA) and reading the weights (the BatchNormalization
+    moving statistics are all-reduced on read) are collective ops, so these callbacks can't just be left out on
+    the other workers. They run in lockstep on every worker, but the non-chief workers write to a temporary
+    directory that is removed at the end of training.
+    Args:
+        callbacks_list (list): of keras callbacks; modified in place on non-chief workers
+        strategy (tf.distribute.Strategy): see `get_strategy`
+    Returns:
+        the callbacks to pass to `fit` on this worker
+    """
+    if is_chief(strategy):
+        return list(callbacks_list)
+    temp_dir = tempfile.mkdtemp()
+    for callback in callbacks_list:
+        for callback_class, attribute in FILE_CALLBACKS:
+            path = getattr(callback, attribute, None) if isinstance(callback, callback_class) else None
+            if path is not None:
+                setattr(callback, attribute, os.path.join(temp_dir, os.path.basename(str(path).rstrip("/"))))
+        if isinstance(callback, SnapshotCapture):
+            callback.store = SnapshotStore(os.path.join(temp_dir, "snapshots"), dtype=callback.store.dtype)
+    return list(callbacks_list) + [_RemoveDirectory(temp_dir)]
+
+class ShardedSequence(keras.utils.Sequence):
+    """
+    The batches of one worker from an existing generator (i.e. `SegmentationGenerator`): batch i of the shard is
+    batch i * n_shards + shard_index of the generator. Every worker shuffles with the same seed, so the shards
+    are disjoint within an epoch. The last (incomplete) batches are dropped so that every worker takes the same
+    number of steps.
+    Args:
+        generator (BaseGenerator): generator with `fpaths`, `batch_size`, `shuffle` and `indexes`
+        n_shards (int): number of workers (input pipelines)
+        shard_index (int): index of this worker
+        seed (int): shuffling seed, shared by all workers
+    """
+    def __init__(self, generator, n_shards=1, shard_index=0, seed=0):
+        self.generator = generator
+        self.n_shards = n_shards
+        self.shard_index = shard_index
+        self.seed = seed
+        self.epoch = 0
+        self._shuffle()
+
+    def _shuffle(self):
+        n = len(self.generator.fpaths)
+        if self.generator.shuffle:
+            self.generator.indexes = np.random.RandomState(self.seed + self.epoch).permutation(n)
+        else:
+            self.generator.indexes = np.arange(n)
+
+    def __len__(self):
+        return (len(self.generator.fpaths) // self.generator.batch_size) // self.n_shards
+
+    def __getitem__(self, idx):
+        return self.generator[idx * self.n_shards + self.shard_index]
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self._shuffle()
+
+def _sequence_to_dataset(sequence):
+    """
+    Infinite tf.data.Dataset of float32 (x, y) batches from a Sequence (calls on_epoch_end between passes).
+    """
+    x, y = sequence[0]
+    def gen():
+        for _ in itertools.count():
+            for idx in range(len(sequence)):
+                x, y = sequence[idx]
+                yield np.asarray(x, dtype=np.float32), np.asarray(y, dtype=np.float32)
+            sequence.on_epoch_end()
+    output_shapes = (tf.TensorShape((None,) + np.shape(x)[1:]), tf.TensorShape((None,) + np.shape(y)[1:]))
+    dataset = tf.data.Dataset.from_generator(gen, output_types=(tf.float32, tf.float32), output_shapes=output_shapes)
+    return dataset.prefetch(2)
+
+def make_distributed_dataset(strategy, generator_fn, global_batch_size, seed=0):
+    """
+    Sharded input from the existing generators: every worker builds its own generator with the per-replica
+    batch size and only loads its shard of the batches (see `ShardedSequence`).
+        dataset, steps = make_distributed_dataset(strategy,
+                                                  partial(SegmentationGenerator, train_dir, masks_dir, shuffle=True),
+                                                  global_batch_size=32)
+        model.fit(dataset, steps_per_epoch=steps, ...)
+    Args:
+        strategy (tf.distribute.Strategy): see `get_strategy`
+        generator_fn (function): creates the generator; called with `batch_size=per replica batch size`
+        global_batch_size (int): batch size per step summed over all replicas
+        seed (int): shuffling seed, shared by all workers
+    Returns:
+        dataset (tf.distribute.DistributedDataset), steps_per_epoch (int)
+    """
+    if global_batch_size % strategy.num_replicas_in_sync != 0:
+        raise ValueError("The global batch size ({0}) must be divisible by the number of replicas ({1})."
+                         .format(global_batch_size, strategy.num_replicas_in_sync))
+    steps = {}
+    def dataset_fn(input_context):
+        batch_size = input_context.get_per_replica_batch_size(global_batch_size)
+        sequence = ShardedSequence(generator_fn(batch_size=batch_size), input_context.num_input_pipelines,
+                                   input_context.input_pipeline_id, seed=seed)
+        n_local_replicas = strategy.num_replicas_in_sync // input_context.num_input_pipelines
+        steps["steps_per_epoch"] = len(sequence) // n_local_replicas
+        dataset = _sequence_to_dataset(sequence)
+        options = tf.data.Options()
+        # already sharded by `ShardedSequence`
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        return dataset.with_options(options)
+    try:
+        dataset = strategy.distribute_datasets_from_function(dataset_fn)
+    except AttributeError:
+        # tf < 2.4
+        dataset = strategy.experimental_distribute_datasets_from_function(dataset_fn)
+    if steps["steps_per_epoch"] == 0:
+        raise ValueError("Not enough samples for one step with a global batch size of {0}."
+                         .format(global_batch_size))
+    return dataset, steps["steps_per_epoch"]
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+def launch_local_workers(script, script_args, n_workers=2, cpu_only=True):
+    """
+    Runs a training script in `n_workers` local processes that form one MultiWorkerMirroredStrategy cluster
+    (`TF_CONFIG` is set for each process), i.e. to test multi-worker training with CPU workers on one machine.
+    Worker 0 is the chief.
+    Args:
+        script (str): path to the training script (it should use `get_strategy("auto")`)
+        script_args (list): of command line arguments for the script
+        n_workers (int): number of worker processes
+        cpu_only (bool): whether or not to hide the GPUs from the workers
+    Returns:
+        list of the exit codes of the workers
+    """
+    workers = ["localhost:{0}".format(_free_port()) for _ in range(n_workers)]
+    processes = []
+    for idx in range(n_workers):
+        env = dict(os.environ)
+        env["TF_CONFIG"] = json.dumps({"cluster": {"worker": workers}, "task": {"type": "worker", "index": idx}})
+        if cpu_only:
+            env["CUDA_VISIBLE_DEVICES"] = "-1"
+        processes.append(subprocess.Popen([sys.executable, script] + list(script_args), env=env))
+    print("Launched {0} workers: {1}".format(n_workers, workers))
+    return [process.wait() for process in processes]
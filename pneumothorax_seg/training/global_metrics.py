@@ -1,5 +1,3 @@
-from sklearn.metrics import confusion_matrix
-
 import numpy as np
 import tensorflow as tf
 keras = tf.keras
@@ -7,46 +5,77 @@ keras = tf.keras
 class BinaryMetricsCallback(keras.callbacks.Callback):
     """
     Keras callback to calculate metrics of a binary classifier for each epoch.
+    The validation data is predicted once per epoch (batch by batch) and the TP/FP/FN/TN counts are
+    accumulated on the fly for every threshold, so sweeping thresholds is free.
     Attributes:
         val_data:
             The validation data.
             Either:
                 a Sequence object for the validation data
                 tuple (x_val, y_val)
-        batch_size: batch size. Defaults to None, which in turn, defaults to 32 for tf.keras
+        batch_size: batch size for the tuple case. Defaults to None, which in turn, defaults to 32.
+        thresholds (float or list/tuple): thresholds to binarize the predictions with. The metrics for the
+            first threshold are logged as `val_precision`, `val_recall` and `val_f1`; the other thresholds are
+            logged as `val_precision@{threshold}`, etc.
+        verbose (bool): whether or not to print the metrics at the end of each epoch
     """
-    def __init__(self, val_data, batch_size=None):
+    def __init__(self, val_data, batch_size=None, thresholds=0.5, verbose=True):
         super().__init__()
         self.val_data = val_data
-        self.batch_size = batch_size
+        self.batch_size = 32 if batch_size is None else batch_size
+        self.thresholds = np.atleast_1d(np.asarray(thresholds, dtype=np.float32))
+        self.verbose = verbose
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        # (n_thresholds, 4) of tn, fp, fn, tp
+        counts = np.zeros((len(self.thresholds), 4), dtype=np.int64)
+        for x_batch, y_batch in self.iterate_batches():
+            pred_batch = np.asarray(self.model.predict_on_batch(x_batch))
+            counts += self.confusion_counts(y_batch, pred_batch)
+
+        for idx, threshold in enumerate(self.thresholds):
+            tn, fp, fn, tp = counts[idx]
+            suffix = "" if idx == 0 else "@{0:g}".format(threshold)
+            metrics = self.evaluate(tp, fp, fn)
+            for name, value in zip(["val_precision", "val_recall", "val_f1"], metrics):
+                logs[name + suffix] = round(float(value), 4)
+        if self.verbose:
+            print(" - val_precision: {} - val_recall: {} - val_f1: {}".format(logs["val_precision"], logs["val_recall"],
+                                                                            logs["val_f1"]))
 
-    def on_epoch_end(self, epoch, logs={}):
-        logs = logs or {}
+    def iterate_batches(self):
+        """
+        Yields (x_batch, y_batch) from either a Sequence or a (x_val, y_val) tuple.
+        """
         if isinstance(self.val_data, (tuple, list)):
-            pred = self.model.predict(self.val_data[0], batch_size=self.batch_size)
-            # simulates a 0.5 threshold
-            round_predict_results = np.rint(pred)
-            tn, fp, fn, tp = confusion_matrix(self.val_data[1].ravel(), pred.ravel()).ravel()
-            logs["val_precision"], logs["val_recall"], logs["val_f1"] = self.evaluate(tn, fp, fn)
-        else: # generators/sequence
-            tp, fp, fn = 0, 0, 0
-            try:
-                # iterates and store the number of true positives, false positives and false negatives
-                for i in range(len(self.val_data)):
-                    x_batch, y_batch = self.val_data[i]
-                    pred_batch = self.model.predict(x_batch, batch_size=self.batch_size)
-                    _, fp_batch, fn_batch, tp_batch = confusion_matrix(y_batch.ravel(), pred.ravel()).ravel()
-                    tp+=tp_batch
-                    fp+=fp_batch
-                    fn+=tn_batch
-                logs["val_precision"], logs["val_recall"], logs["val_f1"] = self.evaluate(tn, fp, fn)
-            except:
-                print("Please make sure that val_data is either a generator or an instance of keras.utils.Sequence")
-        def round_results(metric):
-            logs[metric] = round(logs[metric], 4)
-            return
-        _ = map(round_results, list(logs.keys()))
-        print(" - val_precision: {} - val_recall: {} - val_f1: {}".format(logs["precision"], logs["recall"], logs["f1"]))
+            x_val, y_val = self.val_data[0], self.val_data[1]
+            for start in range(0, len(x_val), self.batch_size):
+                yield (x_val[start:start+self.batch_size], y_val[start:start+self.batch_size])
+        elif isinstance(self.val_data, keras.utils.Sequence):
+            for i in range(len(self.val_data)):
+                x_batch, y_batch = self.val_data[i][:2]
+                yield (x_batch, y_batch)
+        else:
+            raise TypeError("Please make sure that val_data is either a tuple of (x_val, y_val) or an instance of "
+                            "keras.utils.Sequence")
+
+    def confusion_counts(self, y_true, y_pred):
+        """
+        Confusion matrix counts for every threshold with a single np.bincount.
+        Args:
+            y_true (np.ndarray): binary labels
+            y_pred (np.ndarray): predicted probabilities with the same number of elements as y_true
+        Returns:
+            counts (np.ndarray): shape (n_thresholds, 4) of tn, fp, fn, tp
+        """
+        y_true = (np.ravel(y_true) > 0.5).astype(np.int64)
+        y_pred = np.ravel(y_pred)
+        n_thresholds = len(self.thresholds)
+        # code = 4*threshold_idx + 2*label + prediction
+        codes = 2*y_true[None] + (y_pred[None] >= self.thresholds[:, None])
+        codes += 4*np.arange(n_thresholds)[:, None]
+        return np.bincount(codes.ravel(), minlength=4*n_thresholds).reshape(n_thresholds, 4)
 
     def evaluate(self, tp, fp, fn):
         """
@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import time
+import subprocess
+
+from functools import partial
+
+TRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "scripts",
+                            "train_distributed.py")
+STATE_FNAME = "runs.json"
+ENSEMBLE_FNAME = "ensemble.json"
+
+def plan_runs(fold_jsons, seeds=(0,)):
+    """
+    The fold/seed matrix: one run per (fold .json, seed) pair.
+    Args:
+        fold_jsons (list): of fold .json paths (i.e. from `create_kfold_indices` or `download_and_open_fold`)
+        seeds (list): of ensemble seeds (initialization and shuffling)
+    Returns:
+        list of dicts with the keys `name` (i.e. `fold1_901000_seed0`), `fold_json` and `seed`
+    """
+    runs = []
+    for fold_json in fold_jsons:
+        fold_name = os.path.splitext(os.path.basename(fold_json))[0]
+        for seed in seeds:
+            runs.append({"name": "{0}_seed{1}".format(fold_name, seed),
+                         "fold_json": os.path.abspath(fold_json), "seed": int(seed)})
+    return runs
+
+def get_cpu_slots(n_parallel=None, threads_per_run=4):
+    """
+    Splits the usable CPU cores into disjoint slots, one per concurrent run.
+    Args:
+        n_parallel (int): number of concurrent runs. Defaults to None (as many as fit with `threads_per_run`).
+        threads_per_run (int): cores per run. With `n_parallel`, None splits the cores evenly.
+    Returns:
+        list of lists of core ids
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    if threads_per_run is None:
+        threads_per_run = max(1, len(cores) // (n_parallel or 1))
+    if n_parallel is None:
+        n_parallel = max(1, len(cores) // threads_per_run)
+    if n_parallel * threads_per_run > len(cores):
+        print("{0} runs with {1} threads oversubscribe the {2} cores.".format(n_parallel, threads_per_run,
+                                                                            len(cores)))
+    return [sorted(set(cores[(slot * threads_per_run + i) % len(cores)] for i in range(threads_per_run)))
+            for slot in range(n_parallel)]
+
+def _save_json(obj, fpath):
+    # write + rename, so a crash never leaves a truncated state file
+    temp_fpath = fpath + ".tmp"
+    with open(temp_fpath, "w") as fp:
+        json.dump(obj, fp, indent=2)
+    os.replace(temp_fpath, fpath)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except (OSError, TypeError):
+        return False
+    return True
+
+def load_state(work_dir, runs, weights_name="swa.h5", max_attempts=2):
+    """
+    Loads (or initializes) the run states in `work_dir` and decides what still has to run after a crash or
+    an interruption: runs that were `running` are restarted, `done` runs without their weights are rerun and
+    `failed` runs are retried up to `max_attempts` times in total.
+    Returns:
+        dict of {name: state}; the states are the run dicts with `status`, `attempts`, `returncode`,
+        `pid` and `elapsed_s`
+    """
+    state_path = os.path.join(work_dir, STATE_FNAME)
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path, "r") as fp:
+            state = json.load(fp)
+    for run in runs:
+        run_state = state.setdefault(run["name"], dict(run, status="pending", attempts=0, returncode=None,
+                                                       pid=None, elapsed_s=None))
+        weights_path = os.path.join(work_dir, run["name"], weights_name)
+        if run_state["status"] == "running":
+            if _pid_alive(run_state["pid"]):
+                raise RuntimeError("{0} is still running (pid {1}) from an earlier orchestrator."
+                                   .format(run["name"], run_state["pid"]))
+            run_state["status"] = "pending"
+        elif run_state["status"] == "done" and not os.path.exists(weights_path):
+            run_state["status"] = "pending"
+        elif run_state["status"] == "failed" and run_state["attempts"] < max_attempts:
+            run_state["status"] = "pending"
+    return state
+
+def _launch(run, run_dir, cores, script, script_args, gpu=None):
+    threads = len(cores)
+    env = dict(os.environ)
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS"):
+        env[var] = str(threads)
+    env["TF_NUM_INTEROP_THREADS"] = str(min(threads, 2))
+    if gpu is not None:
+        env["CUDA_VISIBLE_DEVICES"] = str(gpu)
+    cmd = [sys.executable, script, "--fold_json", run["fold_json"], "--seed", str(run["seed"]),
+           "--save_dir", run_dir, "--snapshot_dir", os.path.join(run_dir, "snapshots"),
+           "--threads", str(threads), "--strategy", "default"] + list(script_args)
+    log = open(os.path.join(run_dir, "train.log"), "a")
+    log.write("\n$ {0}\n".format(" ".join(cmd)))
+    log.flush()
+    preexec_fn = partial(os.sched_setaffinity, 0, cores) if hasattr(os, "sched_setaffinity") else None
+    process = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT, preexec_fn=preexec_fn)
+    log.close()
+    return process
+
+def run_kfold(runs, work_dir, script_args=(), script=TRAIN_SCRIPT, n_parallel=None, threads_per_run=4,
+              gpus=None, weights_name="swa.h5", max_attempts=2, poll_interval=5.):
+    """
+    Trains every run of a fold/seed matrix (see `plan_runs`) in its own subprocess, `n_parallel` at a time.
+    Each process is pinned to its own slice of the CPU cores with matching BLAS/OpenMP/tensorflow thread
+    caps (and to one GPU of `gpus`, if given), so concurrent runs don't oversubscribe the machine.
+    Progress is kept in `work_dir/runs.json`; calling this again with the same `work_dir` resumes after a
+    crash and only (re)trains the runs that haven't finished. When everything is done, the SWA weights are
+    gathered into `work_dir/ensemble.json` (see `write_ensemble_manifest`).
+    Layout:
+        work_dir/runs.json: state of every run
+        work_dir/{name}/: `--save_dir` of the run (swa.h5, checkpoint.h5, training_log.csv, train.log)
+        work_dir/{name}/snapshots: `SnapshotStore` of the cosine annealing snapshots
+    Args:
+        runs (list): from `plan_runs`
+        work_dir (str): output directory
+        script_args (list): shared arguments for the training script, i.e.
+            ["--array_store", "/content/store_256", "--img_size", "256", "--epochs", "70"].
+            A packed `--array_store` is shared read-only by all runs (memory-mapped, decoded once).
+        script (str): training script; must accept the arguments of `scripts/train_distributed.py` that are
+            set per run (`--fold_json`, `--seed`, `--save_dir`, `--snapshot_dir`, `--threads`, `--strategy`)
+        n_parallel (int): number of concurrent runs (see `get_cpu_slots`)
+        threads_per_run (int): CPU cores per run (see `get_cpu_slots`)
+        gpus (list): of GPU ids assigned round-robin to the slots. Defaults to None (inherit
+            CUDA_VISIBLE_DEVICES).
+        weights_name (str): file in the run directory that marks a finished run
+        max_attempts (int): number of times a run is started before it is left as `failed`
+        poll_interval (float): seconds between checks on the running processes
+    Returns:
+        dict of {name: state} (see `load_state`)
+    """
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    state_path = os.path.join(work_dir, STATE_FNAME)
+    state = load_state(work_dir, runs, weights_name=weights_name, max_attempts=max_attempts)
+    _save_json(state, state_path)
+    slots = get_cpu_slots(n_parallel, threads_per_run)
+    n_pending = sum(state[run["name"]]["status"] == "pending" for run in runs)
+    print("{0} of {1} runs to train, {2} at a time with {3} threads each.".format(n_pending, len(runs),
+                                                                                len(slots), len(slots[0])))
+    free_slots = list(range(len(slots)))
+    running = {}
+    try:
+        while True:
+            pending = [run for run in runs if state[run["name"]]["status"] == "pending"]
+            while pending and free_slots:
+                run, slot = pending.pop(0), free_slots.pop(0)
+                run_dir = os.path.join(work_dir, run["name"])
+                if not os.path.exists(run_dir):
+                    os.makedirs(run_dir)
+                gpu = None if not gpus else gpus[slot % len(gpus)]
+                process = _launch(run, run_dir, slots[slot], script, script_args, gpu=gpu)
+                running[run["name"]] = (process, slot, time.time())
+                state[run["name"]].update(status="running", pid=process.pid,
+                                          attempts=state[run["name"]]["attempts"] + 1)
+                print("Started {0} on cores {1} (pid {2}).".format(run["name"], slots[slot], process.pid))
+                _save_json(state, state_path)
+            if not running:
+                break
+            time.sleep(poll_interval)
+            for name, (process, slot, start) in list(running.items()):
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                del running[name]
+                free_slots.append(slot)
+                finished = returncode == 0 and os.path.exists(os.path.join(work_dir, name, weights_name))
+                if finished:
+                    status = "done"
+                elif state[name]["attempts"] < max_attempts:
+                    status = "pending"
+                else:
+                    status = "failed"
+                state[name].update(status=status, returncode=returncode, pid=None,
+                                   elapsed_s=round(time.time() - start, 1))
+                print("{0}: {1} (exit code {2}, {3:.0f}s)".format(name, status, returncode, time.time() - start))
+                _save_json(state, state_path)
+    except KeyboardInterrupt:
+        print("Interrupted; stopping the running runs.")
+        for name, (process, slot, start) in running.items():
+            process.terminate()
+            process.wait()
+            state[name].update(status="pending", pid=None)
+        _save_json(state, state_path)
+        raise
+    write_ensemble_manifest(work_dir, state, weights_name=weights_name)
+    failed = [name for name, run_state in state.items() if run_state["status"] == "failed"]
+    if failed:
+        print("Failed runs (see their train.log): {0}".format(failed))
+    return state
+
+def write_ensemble_manifest(work_dir, state, weights_name="swa.h5"):
+    """
+    Writes `work_dir/ensemble.json` with the weights of every finished run:
+        {"weights_name": "swa.h5", "members": [{"name", "fold_json", "seed", "weights", "snapshots"}, ...]}
+    `snapshots` is the run's `SnapshotStore` directory (or None).
+    Returns:
+        path to the manifest
+    """
+    members = []
+    for name, run_state in sorted(state.items()):
+        run_dir = os.path.abspath(os.path.join(work_dir, name))
+        if run_state["status"] != "done":
+            continue
+        snapshot_dir = os.path.join(run_dir, "snapshots")
+        members.append({"name": name, "fold_json": run_state["fold_json"], "seed": run_state["seed"],
+                        "weights": os.path.join(run_dir, weights_name),
+                        "snapshots": snapshot_dir if os.path.exists(snapshot_dir) else None})
+    manifest_path = os.path.join(work_dir, ENSEMBLE_FNAME)
+    _save_json({"weights_name": weights_name, "members": members}, manifest_path)
+    print("Wrote {0} ensemble members to {1}".format(len(members), manifest_path))
+    return manifest_path
+
+def load_ensemble(manifest_path, model_fn, members=None):
+    """
+    Builds the ensemble members from an ensemble manifest. The result can be passed as `seg_model` to
+    `inference.segmentation.run_seg_prediction`, which averages the members.
+    Args:
+        manifest_path (str): path to an `ensemble.json`
+        model_fn (function): builds the (uncompiled) architecture, i.e.
+            functools.partial(UEfficientNet, input_shape=(256, 256, 3), encoder_weights=None)
+        members (list): of member names to load. Defaults to None (all members).
+    Returns:
+        list of tf.keras.models.Model
+    """
+    with open(manifest_path, "r") as fp:
+        manifest = json.load(fp)
+    models = []
+    for member in manifest["members"]:
+        if members is not None and member["name"] not in members:
+            continue
+        model = model_fn()
+        model.load_weights(member["weights"])
+        models.append(model)
+    return models
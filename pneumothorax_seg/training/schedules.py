@@ -0,0 +1,184 @@
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras.backend as K
+import tensorflow.keras.callbacks as callbacks
+
+from tensorflow.keras.optimizers.schedules import LearningRateSchedule
+
+class CyclicalLearningRate(LearningRateSchedule):
+    """
+    In-graph version of `training.callbacks.CyclicLR` (https://arxiv.org/abs/1506.01186). The learning rate is
+    computed from the optimizer's step counter inside the training graph, so there are no per-batch
+    K.get_value/K.set_value round trips:
+        model.compile(FusedAdamW(CyclicalLearningRate(1e-4, 1e-3, step_size=2000, mode="triangular2")), ...)
+    Args:
+        base_lr (float): lower boundary of the cycle
+        max_lr (float): upper boundary of the cycle
+        step_size (int): number of training iterations per half cycle
+        mode (str): one of `triangular` (no amplitude scaling), `triangular2` (halves the amplitude every cycle)
+            or `exp_range` (scales the amplitude by gamma**iterations)
+        gamma (float): constant of the `exp_range` scaling
+        name (str): name of the schedule ops
+    """
+    def __init__(self, base_lr=0.001, max_lr=0.006, step_size=2000., mode="triangular", gamma=1., name=None):
+        super(CyclicalLearningRate, self).__init__()
+        if mode not in ("triangular", "triangular2", "exp_range"):
+            raise ValueError("`mode` must be one of `triangular`, `triangular2` or `exp_range`.")
+        self.base_lr = base_lr
+        self.max_lr = max_lr
+        self.step_size = step_size
+        self.mode = mode
+        self.gamma = gamma
+        self.name = name
+
+    def __call__(self, step):
+        with tf.name_scope(self.name or "CyclicalLearningRate"):
+            step = tf.cast(step, tf.float32)
+            cycle = tf.floor(1 + step / (2 * self.step_size))
+            x = tf.abs(step / self.step_size - 2 * cycle + 1)
+            amplitude = (self.max_lr - self.base_lr) * tf.maximum(0., 1 - x)
+            if self.mode == "triangular2":
+                amplitude = amplitude / tf.pow(2., cycle - 1)
+            elif self.mode == "exp_range":
+                amplitude = amplitude * tf.pow(float(self.gamma), step)
+            return self.base_lr + amplitude
+
+    def get_config(self):
+        return {"base_lr": self.base_lr,
+                "max_lr": self.max_lr,
+                "step_size": self.step_size,
+                "mode": self.mode,
+                "gamma": self.gamma,
+                "name": self.name}
+
+class CosineWarmRestarts(LearningRateSchedule):
+    """
+    Cosine annealing with warm restarts (SGDR, https://arxiv.org/abs/1608.03983) at step granularity.
+    Args:
+        init_lr (float): learning rate at the start of the first cycle
+        first_cycle_steps (int): length of the first cycle in training iterations
+        t_mul (float): each cycle is `t_mul` times longer than the previous one
+        m_mul (float): each cycle starts at `m_mul` times the learning rate of the previous one
+        min_lr (float): learning rate at the end of every cycle
+        name (str): name of the schedule ops
+    """
+    def __init__(self, init_lr, first_cycle_steps, t_mul=2., m_mul=1., min_lr=0., name=None):
+        super(CosineWarmRestarts, self).__init__()
+        self.init_lr = init_lr
+        self.first_cycle_steps = first_cycle_steps
+        self.t_mul = t_mul
+        self.m_mul = m_mul
+        self.min_lr = min_lr
+        self.name = name
+
+    def __call__(self, step):
+        with tf.name_scope(self.name or "CosineWarmRestarts"):
+            fraction = tf.cast(step, tf.float32) / self.first_cycle_steps
+            if self.t_mul == 1.:
+                i_restart = tf.floor(fraction)
+                fraction = fraction - i_restart
+            else:
+                i_restart = tf.floor(tf.math.log(1. - fraction * (1. - self.t_mul)) / np.log(self.t_mul))
+                completed = (1. - tf.pow(float(self.t_mul), i_restart)) / (1. - self.t_mul)
+                fraction = (fraction - completed) / tf.pow(float(self.t_mul), i_restart)
+            max_lr = self.init_lr * tf.pow(float(self.m_mul), i_restart)
+            return self.min_lr + (max_lr - self.min_lr) / 2 * (tf.cos(np.pi * fraction) + 1)
+
+    def get_config(self):
+        return {"init_lr": self.init_lr,
+                "first_cycle_steps": self.first_cycle_steps,
+                "t_mul": self.t_mul,
+                "m_mul": self.m_mul,
+                "min_lr": self.min_lr,
+                "name": self.name}
+
+class SnapshotCosine(LearningRateSchedule):
+    """
+    Step-level version of `SnapshotCallbackBuilder._cosine_anneal_schedule`: `n_snapshots` cosine cycles of
+    `cycle_steps` iterations from `init_lr` (https://arxiv.org/abs/1704.00109). The epoch-level schedule (and
+    `training.snapshots.SnapshotCapture`) use cycles of whole epochs, (epochs // n_snapshots) * steps_per_epoch
+    iterations, which is only total_steps // n_snapshots when `n_snapshots` divides the number of epochs;
+    build it with `SnapshotCallbackBuilder.get_schedule` to match them.
+    Args:
+        init_lr (float): learning rate at the start of every cycle
+        total_steps (int): total number of training iterations
+        n_snapshots (int): number of cycles (snapshots)
+        cycle_steps (int): number of iterations per cycle. Defaults to None (total_steps // n_snapshots).
+        name (str): name of the schedule ops
+    """
+    def __init__(self, init_lr, total_steps, n_snapshots=1, cycle_steps=None, name=None):
+        super(SnapshotCosine, self).__init__()
+        if not 1 <= n_snapshots <= total_steps:
+            raise ValueError("`n_snapshots` ({0}) must be between 1 and `total_steps` ({1}), so that every cycle "
+                             "has at least one step.".format(n_snapshots, total_steps))
+        cycle_steps = total_steps // n_snapshots if cycle_steps is None else cycle_steps
+        if not 1 <= cycle_steps <= total_steps:
+            raise ValueError("`cycle_steps` ({0}) must be between 1 and `total_steps` ({1}).".format(cycle_steps,
+                                                                                                   total_steps))
+        self.init_lr = init_lr
+        self.total_steps = total_steps
+        self.n_snapshots = n_snapshots
+        self.cycle_steps = cycle_steps
+        self.name = name
+
+    def __call__(self, step):
+        with tf.name_scope(self.name or "SnapshotCosine"):
+            cycle_steps = float(self.cycle_steps)
+            cos_inner = np.pi * tf.math.floormod(tf.cast(step, tf.float32), cycle_steps) / cycle_steps
+            return self.init_lr / 2 * (tf.cos(cos_inner) + 1)
+
+    def get_config(self):
+        return {"init_lr": self.init_lr,
+                "total_steps": self.total_steps,
+                "n_snapshots": self.n_snapshots,
+                "cycle_steps": self.cycle_steps,
+                "name": self.name}
+
+class LearningRateLogger(callbacks.Callback):
+    """
+    Adds the current learning rate to the logs (`lr`) once per epoch, i.e. for CSVLogger/TensorBoard.
+    Works with both constant learning rates and in-graph schedules.
+    """
+    def __init__(self):
+        super(LearningRateLogger, self).__init__()
+        self._lr_tensor = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is None:
+            return
+        optimizer = self.model.optimizer
+        lr = getattr(optimizer, "learning_rate", None)
+        lr = optimizer.lr if lr is None else lr
+        if isinstance(lr, LearningRateSchedule):
+            if tf.executing_eagerly():
+                lr = lr(optimizer.iterations)
+            else:
+                # build the schedule ops once instead of once per epoch
+                if self._lr_tensor is None:
+                    self._lr_tensor = lr(optimizer.iterations)
+                lr = self._lr_tensor
+        logs["lr"] = float(K.get_value(lr))
+
+if __name__ == "__main__":
+    from pneumothorax_seg.training.callbacks import CyclicLR, SnapshotCallbackBuilder
+
+    steps = np.arange(0, 12000, 7)
+    for mode in ("triangular", "triangular2", "exp_range"):
+        clr = CyclicLR(base_lr=1e-4, max_lr=1e-3, step_size=2000., mode=mode, gamma=0.9999)
+        expected = []
+        for step in steps:
+            clr.clr_iterations = step
+            expected.append(clr.clr())
+        schedule = CyclicalLearningRate(1e-4, 1e-3, step_size=2000., mode=mode, gamma=0.9999)
+        print("{0}: max. difference to CyclicLR: {1:.2e}".format(mode, np.abs(K.get_value(schedule(steps)) -
+                                                                            np.asarray(expected)).max()))
+
+    # the step-level schedule has to match the epoch-level one at every epoch start, also when the number of
+    # snapshots doesn't divide the number of epochs
+    nb_epochs, nb_snapshots, steps_per_epoch = 10, 3, 50
+    builder = SnapshotCallbackBuilder(nb_epochs, nb_snapshots, init_lr=1e-3)
+    epoch_lrs = np.asarray([builder._cosine_anneal_schedule(epoch) for epoch in range(nb_epochs)])
+    schedule = builder.get_schedule(steps_per_epoch)
+    step_lrs = K.get_value(schedule(np.arange(nb_epochs) * steps_per_epoch))
+    print("SnapshotCosine: max. difference to the epoch-level schedule: {0:.2e}".format(
+        np.abs(step_lrs - epoch_lrs).max()))
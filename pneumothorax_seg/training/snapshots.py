@@ -0,0 +1,158 @@
+import os
+import json
+import numpy as np
+import tensorflow.keras.callbacks as callbacks
+
+from tensorflow.keras.layers import Input, Average
+from tensorflow.keras.models import Model
+
+class SnapshotStore(object):
+    """
+    Compact on-disk store of model snapshots (i.e. the weights at the end of each cosine annealing cycle).
+    Every snapshot is one flat (float16 by default) .npy file that is memory-mapped when read, so members can
+    be averaged or loaded without deserializing full .h5 models.
+    Layout:
+        directory/manifest.json: weight shapes and {cycle: file name}
+        directory/snapshot_{cycle}.npy: all weights of one snapshot concatenated
+    Attributes:
+        directory (str): path to the store (created if it doesn't exist)
+        dtype (str): storage dtype. Defaults to float16 (half the size of float32 .h5 weights).
+    """
+    def __init__(self, directory, dtype="float16"):
+        self.directory = directory
+        self.dtype = dtype
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as fp:
+                self.manifest = json.load(fp)
+            self.dtype = self.manifest["dtype"]
+        else:
+            self.manifest = {"dtype": self.dtype, "shapes": None, "snapshots": {}}
+
+    @property
+    def cycles(self):
+        return sorted(int(cycle) for cycle in self.manifest["snapshots"].keys())
+
+    def add(self, cycle, weights):
+        """
+        Adds a snapshot.
+        Args:
+            cycle (int): key of the snapshot
+            weights (list): of np.ndarrays (i.e. model.get_weights())
+        """
+        shapes = [list(w.shape) for w in weights]
+        if self.manifest["shapes"] is None:
+            self.manifest["shapes"] = shapes
+        elif self.manifest["shapes"] != shapes:
+            raise ValueError("All snapshots in a store must come from the same architecture.")
+        fname = "snapshot_{0}.npy".format(cycle)
+        flat = np.concatenate([np.ravel(w).astype(self.dtype) for w in weights])
+        np.save(os.path.join(self.directory, fname), flat)
+        self.manifest["snapshots"][str(cycle)] = fname
+        with open(self.manifest_path, "w") as fp:
+            json.dump(self.manifest, fp)
+
+    def _unflatten(self, flat, dtype="float32"):
+        weights = []
+        offset = 0
+        for shape in self.manifest["shapes"]:
+            size = int(np.prod(shape))
+            weights.append(np.asarray(flat[offset:offset+size], dtype=dtype).reshape(shape))
+            offset += size
+        return weights
+
+    def get_flat(self, cycle):
+        """
+        Memory-mapped flat weights of a snapshot.
+        """
+        fname = self.manifest["snapshots"][str(cycle)]
+        return np.load(os.path.join(self.directory, fname), mmap_mode="r")
+
+    def get(self, cycle):
+        """
+        Returns:
+            list of float32 np.ndarrays that can be passed to model.set_weights
+        """
+        return self._unflatten(self.get_flat(cycle))
+
+    def average(self, cycles=None):
+        """
+        Averages snapshots (streaming over the memory-mapped files).
+        Args:
+            cycles (list): of cycles to average. Defaults to None (all snapshots).
+        Returns:
+            list of float32 np.ndarrays that can be passed to model.set_weights
+        """
+        cycles = self.cycles if cycles is None else cycles
+        if not cycles:
+            raise ValueError("There are no snapshots to average.")
+        total = np.zeros(self.get_flat(cycles[0]).shape, dtype=np.float32)
+        for cycle in cycles:
+            total += self.get_flat(cycle)
+        return self._unflatten(total / len(cycles))
+
+class SnapshotCapture(callbacks.Callback):
+    """
+    Captures the weights into a `SnapshotStore` at each minimum of a cosine annealing schedule with
+    `nb_snapshots` cycles over `nb_epochs` (see `SnapshotCallbackBuilder`).
+    Args:
+        store (SnapshotStore): where to save the snapshots
+        nb_epochs (int): total number of training epochs
+        nb_snapshots (int): number of cosine annealing cycles
+    """
+    def __init__(self, store, nb_epochs, nb_snapshots):
+        super(SnapshotCapture, self).__init__()
+        if not 1 <= nb_snapshots <= nb_epochs:
+            raise ValueError("`nb_snapshots` ({0}) must be between 1 and `nb_epochs` ({1}), so that every cycle "
+                             "has at least one epoch.".format(nb_snapshots, nb_epochs))
+        self.store = store
+        self.cycle_length = nb_epochs // nb_snapshots
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.cycle_length == 0:
+            cycle = (epoch + 1) // self.cycle_length
+            self.store.add(cycle, self.model.get_weights())
+            print("Captured snapshot {0} at epoch {1}.".format(cycle, epoch + 1))
+
+def build_averaged_model(model_fn, store, cycles=None):
+    """
+    Builds a model with the averaged weights of snapshots.
+    Args:
+        model_fn (function): builds the (uncompiled) architecture, i.e.
+            functools.partial(UEfficientNetpp, input_shape=(256, 256, 3))
+        store (SnapshotStore): store with the snapshots
+        cycles (list): of cycles to average. Defaults to None (all snapshots).
+    Returns:
+        tf.keras.models.Model
+    """
+    model = model_fn()
+    model.set_weights(store.average(cycles))
+    return model
+
+def build_ensemble_model(model_fn, store, cycles=None, average_outputs=True):
+    """
+    Builds a single model that runs every snapshot on a shared input, with the weights loaded directly
+    from the store. The result can be passed as a single model to `inference.segmentation.run_seg_prediction`.
+    Args:
+        model_fn (function): builds the (uncompiled) architecture. Must have a fixed input shape.
+        store (SnapshotStore): store with the snapshots
+        cycles (list): of cycles to use as ensemble members. Defaults to None (all snapshots).
+        average_outputs (bool): whether to average the member outputs into one output or to return one
+            output per member.
+    Returns:
+        tf.keras.models.Model
+    """
+    cycles = store.cycles if cycles is None else cycles
+    members = []
+    for cycle in cycles:
+        member = model_fn()
+        member.set_weights(store.get(cycle))
+        member._name = "snapshot_{0}".format(cycle)
+        members.append(member)
+    inp = Input(shape=members[0].input_shape[1:])
+    outputs = [member(inp) for member in members]
+    if average_outputs and len(outputs) > 1:
+        outputs = Average()(outputs)
+    return Model(inp, outputs)
@@ -0,0 +1,138 @@
+import tensorflow.keras.backend as K
+import tensorflow as tf
+import numpy as np
+
+from tensorflow.keras.layers import BatchNormalization, Dropout
+
+def compile_backend_fn(fn):
+    """
+    Turns a function that builds (assign) ops into a callable that runs all of them with one graph call.
+    Works for both graph mode (tf 1.x; the ops are built once and run through the session) and
+    eager mode (tf 2.x; wrapped in a tf.function).
+    Args:
+        fn (function): takes no arguments and returns the op(s) to run
+    Returns:
+        callable with no arguments
+    """
+    if tf.executing_eagerly():
+        @tf.function
+        def run():
+            fn()
+        return run
+    op = fn()
+    return lambda: K.get_session().run(op)
+
+def get_bn_layers(model):
+    """
+    Recursively finds all of the BatchNormalization layers in a model (including nested models).
+    """
+    bn_layers = []
+    for layer in model.layers:
+        if isinstance(layer, BatchNormalization):
+            bn_layers.append(layer)
+        elif hasattr(layer, "layers"):
+            bn_layers.extend(get_bn_layers(layer))
+    return bn_layers
+
+def iterate_inputs(data, steps=None, batch_size=32):
+    """
+    Yields input batches from a keras.utils.Sequence, a generator of batches or a np.ndarray.
+    Only the inputs (x) are yielded when the batches are (x, y) tuples.
+    Args:
+        data: Sequence, generator or np.ndarray
+        steps (int): maximum number of batches to yield. Defaults to None (everything).
+        batch_size (int): batch size for np.ndarray inputs
+    """
+    if isinstance(data, np.ndarray):
+        batches = (data[start:start+batch_size] for start in range(0, len(data), batch_size))
+    elif isinstance(data, tf.keras.utils.Sequence):
+        batches = (data[i] for i in range(len(data)))
+    else:
+        batches = data
+    for step, batch in enumerate(batches):
+        if steps is not None and step >= steps:
+            break
+        yield batch[0] if isinstance(batch, (tuple, list)) else batch
+
+def recompute_bn_statistics(model, data, steps=None, batch_size=32, disable_dropout=True):
+    """
+    Recomputes the BatchNormalization moving statistics of `model` (i.e. after weight averaging) with a
+    forward-only pass over a subset of the data. No weights other than the moving statistics are changed.
+        * eager (tf 2.x): the momentum of every BatchNormalization layer is reset to n / (n + 1) before the
+          n-th batch, so the moving statistics become the exact average of the batch statistics. Dropout-like
+          layers are switched off during the pass when `disable_dropout=True`, so that only the normalization
+          layers behave as in training.
+        * graph (tf 1.x): the momentum is baked into the graph, so the statistics are reset to zero,
+          accumulated with the layers' own updates and then bias-corrected (divided by 1 - momentum**n).
+    Args:
+        model (tf.keras.models.Model): model to recalibrate
+        data: Sequence, generator of batches or np.ndarray of inputs (see `iterate_inputs`)
+        steps (int): number of batches to use. Defaults to None (all of `data`).
+        batch_size (int): batch size for np.ndarray inputs
+        disable_dropout (bool): whether or not to switch off Dropout/DropConnect layers during the pass (eager only)
+    Returns:
+        n_steps (int): the number of batches that were used
+    """
+    bn_layers = get_bn_layers(model)
+    if not bn_layers:
+        return 0
+    bn_variables = [v for layer in bn_layers for v in (layer.moving_mean, layer.moving_variance)]
+    original_values = K.batch_get_value(bn_variables)
+    momentums = [layer.momentum for layer in bn_layers]
+    if tf.executing_eagerly():
+        dropout_rates = _set_dropout_rates(model, 0.) if disable_dropout else {}
+        def forward(x, n):
+            for layer in bn_layers:
+                layer.momentum = n / (n + 1.)
+            model(x, training=True)
+    else:
+        K.batch_set_value([(v, np.zeros(K.int_shape(v))) for v in bn_variables])
+        # training-mode forward pass that only runs the moving statistic updates
+        bn_updates = [update for layer in bn_layers for update in layer.updates]
+        forward_fn = K.function(model.inputs + [K.learning_phase()], [], updates=bn_updates)
+        forward = lambda x, n: forward_fn([x, 1])
+
+    n_steps = 0
+    try:
+        for x in iterate_inputs(data, steps=steps, batch_size=batch_size):
+            forward(x, float(n_steps))
+            n_steps += 1
+    finally:
+        for layer, momentum in zip(bn_layers, momentums):
+            layer.momentum = momentum
+        if tf.executing_eagerly():
+            _set_dropout_rates(model, dropout_rates)
+    if n_steps == 0:
+        print("No batches to recompute the BatchNormalization statistics with; keeping the old statistics.")
+        K.batch_set_value(list(zip(bn_variables, original_values)))
+    elif not tf.executing_eagerly():
+        # bias correction (the statistics started at 0)
+        values = K.batch_get_value(bn_variables)
+        K.batch_set_value([(v, value / (1. - momentum ** n_steps))
+                           for v, value, momentum in zip(bn_variables, values, np.repeat(momentums, 2))])
+    return n_steps
+
+def _set_dropout_rates(model, rates):
+    """
+    Sets the rates of the Dropout and DropConnect layers in a model.
+    Args:
+        model (tf.keras.models.Model):
+        rates (float or dict): a single rate for all layers or a dict of {layer: rate}
+    Returns:
+        dict of {layer: old rate}
+    """
+    old_rates = {}
+    layers = [l for l in model.layers]
+    while layers:
+        layer = layers.pop()
+        if hasattr(layer, "layers"):
+            layers.extend(layer.layers)
+            continue
+        attr = "rate" if isinstance(layer, Dropout) else "drop_connect_rate" \
+               if hasattr(layer, "drop_connect_rate") else None
+        if attr is None:
+            continue
+        old_rates[layer] = getattr(layer, attr)
+        new_rate = rates.get(layer, old_rates[layer]) if isinstance(rates, dict) else rates
+        setattr(layer, attr, new_rate)
+    return old_rates
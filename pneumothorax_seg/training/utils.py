@@ -10,11 +10,12 @@ from pneumothorax_seg.models.efficientnet.models import EfficientNetB4
 from pneumothorax_seg.models.grayscale.densenet import DenseNet169
 from pneumothorax_seg.models.grayscale.xception import Xception
 from pneumothorax_seg.models.grayscale.inception_resnet_v2 import InceptionResNetV2
+from pneumothorax_seg.models.mixed_precision import with_precision_policy, wrap_optimizer
 
 from pneumothorax_seg.script_utils.downloaders import download_nih_weights, NIH_WEIGHTS
 
 def load_pretrained_classification_model(model_name="efficientnet", input_shape=None,
-                                         dropout=None, pretrained="imagenet"):
+                                         dropout=None, pretrained="imagenet", precision=None):
     """
     Creates a classification model from pretrained models that are located in this repository.
     Assumes that we are doing a binary classification task with sigmoid (average pooling at the end).
@@ -28,6 +29,8 @@ def load_pretrained_classification_model(model_name="efficientnet", input_shape=
         pretrained (str): one of `None` (random initialization), 'imagenet' (pre-training on ImageNet),
             or `nih` (pre-training on NIH Chest X-Ray14, not available to efficientnet). This is strictly for the weights argument in
             `base_model`.
+        precision (str): one of None/`float32` (default), `mixed_float16` or `mixed_bfloat16`.
+            See `get_classification_model`.
     Returns:
         A pretrained classification tf.keras.models.Model with the desired input and output shape and loaded weights.
     """
@@ -53,9 +56,10 @@ def load_pretrained_classification_model(model_name="efficientnet", input_shape=
     base_model = default_models_and_shapes[model_name]["base_model"]
     # defaults: layer=0, n_classes=1, activation="sigmoid", pooling="avg", weights=None
     model = get_classification_model(base_model, input_shape=input_shape, dropout=dropout,
-                                     pretrained=pretrained)
+                                     pretrained=pretrained, precision=precision)
     return model
 
+@with_precision_policy
 def get_classification_model(base_model, layer=0, input_shape=(224,224,1), classes=1,
                              activation="sigmoid", dropout=None, pooling="avg",
                              weights=None, pretrained="imagenet"):
@@ -76,6 +80,8 @@ def get_classification_model(base_model, layer=0, input_shape=(224,224,1), class
         pretrained (str): one of `None` (random initialization), 'imagenet' (pre-training on ImageNet),
             or the path to the weights file to be loaded. This is strictly for the weights argument in
             `base_model`.
+        precision (str): one of None/`float32` (default), `mixed_float16` or `mixed_bfloat16`.
+            Mixed precision models compute in half precision with float32 weights and a float32 output layer.
     Returns:
         A remade classification tf.keras.models.Model with the desired input and output shape and weights.
     """
@@ -89,7 +95,7 @@ def get_classification_model(base_model, layer=0, input_shape=(224,224,1), class
         x = Flatten()(base.output)
     if dropout is not None:
         x = Dropout(dropout)(x)
-    x = Dense(classes, activation=activation)(x)
+    x = Dense(classes, activation=activation, dtype="float32")(x)
     model = Model(inputs=base.input, outputs=x)
     if weights is not None:
         model.load_weights(weights)
@@ -108,6 +114,8 @@ def compile_classification(model, opt=None, lr=1e-5,):
     """
     if opt is None:
         opt = Adam(lr=lr)
+    # loss scaling for mixed_float16 models
+    opt = wrap_optimizer(opt, model)
     metrics = [f1, "binary_accuracy"]
     loss = ["binary_crossentropy"]
     model.compile(opt, loss=loss, metrics=metrics)
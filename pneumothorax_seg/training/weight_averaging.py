@@ -0,0 +1,125 @@
+import tensorflow.keras.callbacks as callbacks
+import tensorflow.keras.backend as K
+import tensorflow as tf
+
+from pneumothorax_seg.training.swa_utils import compile_backend_fn, recompute_bn_statistics
+from pneumothorax_seg.training.wrapped_optimizer import _WrappedOptimizer
+
+class MovingAverageOptimizer(_WrappedOptimizer):
+    """
+    Wraps an optimizer and keeps a shadow copy (slot) of every trained variable with either an exponential
+    moving average (EMA) or a step-level stochastic weight average (SWA) of the weights. The shadows are
+    updated in the same graph as the weight update, right after it, every `update_freq` steps.
+    This gives ensemble-like weights from a single training run (instead of ensembling separate SWA runs).
+    The BatchNormalization moving statistics are not trained variables, so recompute them after assigning
+    the averages with `training.swa_utils.recompute_bn_statistics` (see `ApplyMovingAverage`).
+    For tensorflow 1.14 and higher (OptimizerV2 API). Not meant to be used under a tf.distribute strategy.
+    Args:
+        optimizer: an instance of a tf.keras optimizer to wrap (i.e. Adam, AdamW)
+        mode (str): either `ema` or `swa`
+        decay (float): EMA decay. Ignored when mode="swa". The effective decay is
+            min(decay, (1 + n) / (10 + n)) where n is the number of averages taken so far, so that the early
+            (random) weights are forgotten quickly.
+        update_freq (int): update the averages every `update_freq` optimizer steps
+        start_step (int): optimizer step to start averaging at
+    """
+    def __init__(self, optimizer, mode="ema", decay=0.999, update_freq=1, start_step=0,
+                 name="MovingAverageOptimizer", **kwargs):
+        if mode not in ("ema", "swa"):
+            raise ValueError("`mode` must be one of `ema` or `swa`.")
+        super(MovingAverageOptimizer, self).__init__(optimizer, name, **kwargs)
+        self.mode = mode
+        self.decay = decay
+        self.update_freq = update_freq
+        self.start_step = start_step
+
+    def _create_slots(self, var_list):
+        for var in var_list:
+            self.add_slot(var, "average")
+
+    def apply_gradients(self, grads_and_vars, name=None, **kwargs):
+        grads_and_vars = list(grads_and_vars)
+        var_list = [v for g, v in grads_and_vars if g is not None]
+        with tf.init_scope():
+            self._create_all_weights(var_list)
+            if not hasattr(self, "n_averaged"):
+                self.n_averaged = self.add_weight("n_averaged", shape=[], dtype=tf.float32,
+                                                  initializer="zeros", trainable=False)
+        train_op = self.optimizer.apply_gradients(grads_and_vars, name=name, **kwargs)
+        with tf.control_dependencies([train_op]):
+            step = K.cast(self.optimizer.iterations, "int64") - self.start_step
+            do_update = tf.logical_and(step >= 0, tf.equal(step % self.update_freq, 0))
+            return tf.cond(do_update, lambda: self._update_averages(var_list),
+                           lambda: tf.identity(self.n_averaged))
+
+    def _update_averages(self, var_list):
+        """
+        average = decay_t * average + (1 - decay_t) * var for every variable. The first average is a copy.
+        """
+        n = tf.identity(self.n_averaged)
+        if self.mode == "swa":
+            decay_t = n / (n + 1.)
+        else:
+            decay_t = tf.minimum(self.decay, (1. + n) / (10. + n))
+            decay_t = tf.where(tf.equal(n, 0.), 0., decay_t)
+        updates = []
+        for var in var_list:
+            average = self.get_slot(var, "average")
+            decay_var = K.cast(decay_t, average.dtype)
+            updates.append(average.assign(decay_var * average + (1. - decay_var) * K.cast(var, average.dtype)))
+        with tf.control_dependencies(updates):
+            return tf.identity(self.n_averaged.assign_add(1.))
+
+    def assign_average_weights(self, var_list):
+        """
+        Overwrites the variables in `var_list` (i.e. model.trainable_weights) with their averages in one op.
+        Variables without an average are left untouched.
+        """
+        pairs = []
+        for var in var_list:
+            try:
+                pairs.append((var, self.get_slot(var, "average")))
+            except KeyError:
+                continue
+        if not pairs:
+            print("No averaged weights to assign.")
+            return
+        assign_fn = compile_backend_fn(lambda: tf.group(*[var.assign(average) for var, average in pairs]))
+        assign_fn()
+
+    def get_config(self):
+        config = {"mode": self.mode,
+                  "decay": self.decay,
+                  "update_freq": self.update_freq,
+                  "start_step": self.start_step}
+        base_config = super(MovingAverageOptimizer, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+class ApplyMovingAverage(callbacks.Callback):
+    """
+    At the end of training, sets the model weights to the averages kept by a `MovingAverageOptimizer`,
+    recalibrates the BatchNormalization statistics and saves the weights.
+    Args:
+        filepath (str): path to save the averaged weights to. Defaults to None (no saving).
+        bn_data: (Sequence, generator of batches, or np.ndarray of inputs) data for the BatchNormalization
+            recalibration. Defaults to None (no recalibration).
+        bn_steps (int): number of batches of `bn_data` to use. Defaults to None (all).
+    """
+    def __init__(self, filepath=None, bn_data=None, bn_steps=None):
+        super(ApplyMovingAverage, self).__init__()
+        self.filepath = filepath
+        self.bn_data = bn_data
+        self.bn_steps = bn_steps
+
+    def on_train_end(self, logs=None):
+        optimizer = self.model.optimizer
+        if not isinstance(optimizer, MovingAverageOptimizer):
+            raise TypeError("The model must be compiled with a `MovingAverageOptimizer`.")
+        optimizer.assign_average_weights(self.model.trainable_weights)
+        print("Final model parameters set to the {0} weights.".format(optimizer.mode))
+        if self.bn_data is not None:
+            n_steps = recompute_bn_statistics(self.model, self.bn_data, steps=self.bn_steps)
+            print("Recomputed the BatchNormalization statistics with {0} batches.".format(n_steps))
+        if self.filepath is not None:
+            self.model.save_weights(self.filepath)
+            print("Averaged weights saved to {0}.".format(self.filepath))
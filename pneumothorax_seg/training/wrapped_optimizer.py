@@ -0,0 +1,84 @@
+import tensorflow as tf
+
+from tensorflow.keras.optimizers import serialize, deserialize
+try:
+    # tf >= 2.11 moved the OptimizerV2 API (apply_gradients + slots) to `legacy`
+    from tensorflow.keras.optimizers.legacy import Optimizer
+except ImportError:
+    from tensorflow.keras.optimizers import Optimizer
+
+def get_legacy_optimizer(identifier):
+    """
+    `tf.keras.optimizers.get` that resolves names and serialized configs (i.e. "adam") to the OptimizerV2 class
+    on tf >= 2.11, where they default to the new optimizers (no slots, no `_create_all_weights`).
+    Args:
+        identifier: optimizer name, serialized config or instance (returned as is)
+    Returns:
+        tf.keras optimizer instance
+    """
+    try:
+        return tf.keras.optimizers.get(identifier, use_legacy_optimizer=True)
+    except TypeError:
+        # tf < 2.11: no `use_legacy_optimizer`, every optimizer is an OptimizerV2
+        return tf.keras.optimizers.get(identifier)
+
+class _WrappedOptimizer(Optimizer):
+    """
+    Base class for the OptimizerV2 wrappers that delegate the weight updates to another optimizer through
+    `apply_gradients` (i.e. `weight_averaging.MovingAverageOptimizer`,
+    `accum_optimizer.GradientAccumulationOptimizer`). Subclasses override `apply_gradients` and add their own
+    arguments to `get_config`.
+    Args:
+        optimizer: an instance of a tf.keras optimizer to wrap (i.e. Adam, AdamW), its name or its serialized
+            config (resolved to the OptimizerV2 class, see `get_legacy_optimizer`)
+        name (str): name of the wrapper
+    """
+    def __init__(self, optimizer, name, **kwargs):
+        super(_WrappedOptimizer, self).__init__(name, **kwargs)
+        if isinstance(optimizer, (str, dict)):
+            optimizer = get_legacy_optimizer(optimizer)
+        self.optimizer = optimizer
+        self._track_trackable(optimizer, name="base_optimizer")
+
+    # the learning rate and step counter belong to the wrapped optimizer so that lr callbacks and
+    # schedules keep working
+    @property
+    def learning_rate(self):
+        return self.optimizer.learning_rate
+
+    @learning_rate.setter
+    def learning_rate(self, value):
+        self.optimizer.learning_rate = value
+
+    @property
+    def lr(self):
+        return self.optimizer.learning_rate
+
+    @property
+    def iterations(self):
+        return self.optimizer.iterations
+
+    @iterations.setter
+    def iterations(self, variable):
+        self.optimizer.iterations = variable
+
+    def _resource_apply_dense(self, grad, var, apply_state=None):
+        raise NotImplementedError("Updates are delegated to the wrapped optimizer through `apply_gradients`.")
+
+    def _resource_apply_sparse(self, grad, var, indices, apply_state=None):
+        raise NotImplementedError("Updates are delegated to the wrapped optimizer through `apply_gradients`.")
+
+    def get_config(self):
+        config = {"optimizer": serialize(self.optimizer)}
+        base_config = super(_WrappedOptimizer, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+    @classmethod
+    def from_config(cls, config, custom_objects=None):
+        config = dict(config)
+        try:
+            config["optimizer"] = deserialize(config["optimizer"], custom_objects=custom_objects,
+                                              use_legacy_optimizer=True)
+        except TypeError:
+            config["optimizer"] = deserialize(config["optimizer"], custom_objects=custom_objects)
+        return cls(**config)
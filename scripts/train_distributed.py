@@ -0,0 +1,192 @@
+"""
+Data-parallel training of the segmentation/classification models under a tf.distribute strategy.
+Single process (all local GPUs or the CPU):
+    python scripts/train_distributed.py --train_dir /content/keras_im_train --train_masks_dir /content/keras_mask_train
+        --val_dir /content/keras_im_val --val_masks_dir /content/keras_mask_val --batch_size 32
+Multi-worker on one machine with CPU workers (each worker loads its own shard of the batches):
+    python scripts/train_distributed.py ... --n_local_workers 4
+With a fold index file (see `pneumothorax_seg.script_utils.io_setup.create_fold_index`), the validation images
+stay in the training directories:
+    python scripts/train_distributed.py --train_dir /content/train --train_masks_dir /content/masks
+        --fold_json fold1_ids.json
+From a packed array store (see `pneumothorax_seg.io.array_store`) and a fold .json:
+    python scripts/train_distributed.py --array_store /content/store_256 --fold_json fold1_ids.json
+For a real cluster, set `TF_CONFIG` on every machine and run the script without `--n_local_workers`.
+"""
+import os
+import argparse
+from functools import partial
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Multi-worker data-parallel training.")
+    parser.add_argument("--model", default="uefficientnet", choices=["uefficientnet", "uefficientnetpp",
+                                                                      "classification"])
+    parser.add_argument("--encoder", default="efficientnet-b4", help="UEfficientNet encoder")
+    parser.add_argument("--encoder_weights", default="imagenet", help="`imagenet` or `none`")
+    parser.add_argument("--train_dir", default=None, help="training images directory")
+    parser.add_argument("--train_masks_dir", default=None, help="training masks directory")
+    parser.add_argument("--val_dir", default=None, help="validation images directory")
+    parser.add_argument("--val_masks_dir", default=None, help="validation masks directory")
+    parser.add_argument("--fold_json", default=None,
+                        help="fold .json with `train`/`val` ImageIds or filepaths (i.e. from `create_fold_index`)")
+    parser.add_argument("--array_store", default=None,
+                        help="read the images/masks from this array store instead of the .png directories "
+                             "(the train/val split comes from `--fold_json`)")
+    parser.add_argument("--img_size", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=16, help="global batch size (over all replicas)")
+    parser.add_argument("--lr", type=float, default=1e-3, help="learning rate for `--base_batch_size`")
+    parser.add_argument("--base_batch_size", type=int, default=16)
+    parser.add_argument("--lr_scaling", default="linear", choices=["linear", "sqrt", "none"])
+    parser.add_argument("--weight_decay", type=float, default=0.)
+    parser.add_argument("--epochs", type=int, default=70)
+    parser.add_argument("--n_snapshots", type=int, default=1, help="number of cosine annealing cycles")
+    parser.add_argument("--swa_epoch", type=int, default=None, help="defaults to epochs - 3")
+    parser.add_argument("--augment", action="store_true", help="albumentations horizontal flips")
+    parser.add_argument("--save_dir", default=".")
+    parser.add_argument("--snapshot_dir", default=None, help="SnapshotStore directory for the cycle snapshots")
+    parser.add_argument("--strategy", default="auto", choices=["auto", "default", "mirrored", "multi_worker"])
+    parser.add_argument("--n_local_workers", type=int, default=0,
+                        help="launch this many local CPU worker processes (MultiWorkerMirroredStrategy)")
+    parser.add_argument("--seed", type=int, default=0, help="initialization and shuffling seed")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="tensorflow intra-op threads (0 lets tensorflow decide)")
+    return parser
+
+def get_generator_fns(args):
+    """
+    Returns the (train, val) generator functions; both are called with `batch_size`.
+    """
+    from pneumothorax_seg.io.generators import SegmentationGenerator, ClassificationGenerator
+
+    from pneumothorax_seg.script_utils.io_setup import load_fold
+
+    generator = ClassificationGenerator if args.model == "classification" else SegmentationGenerator
+    fold = {"train": None, "val": None}
+    if args.fold_json is not None:
+        fold = load_fold(args.fold_json)
+    augmentations = None
+    if args.augment:
+        from albumentations import Compose, HorizontalFlip, ToFloat
+        augmentations = Compose([HorizontalFlip(p=0.5), ToFloat(max_value=1)], p=1)
+    if args.array_store is not None:
+        from pneumothorax_seg.io.array_store import ArrayStore
+        from pneumothorax_seg.io.generators import ArraySegmentationGenerator, ArrayClassificationGenerator
+
+        generator = ArrayClassificationGenerator if args.model == "classification" else ArraySegmentationGenerator
+        store = ArrayStore(args.array_store)
+        train_fn = partial(generator, store, ids=fold["train"], augmentations=augmentations, shuffle=True)
+        val_fn = None
+        if fold["val"] is not None:
+            val_fn = partial(generator, store, ids=fold["val"], shuffle=False)
+        return train_fn, val_fn
+    if args.train_dir is None:
+        raise ValueError("Either `--train_dir` or `--array_store` is required.")
+    # index-file folds keep the validation images in the training directories
+    val_dir = args.train_dir if args.val_dir is None else args.val_dir
+    val_masks_dir = args.train_masks_dir if args.val_masks_dir is None else args.val_masks_dir
+    if args.fold_json is not None:
+        fold = {"train": load_fold(fold, images_dir=args.train_dir)["train"],
+                "val": load_fold(fold, images_dir=val_dir)["val"]}
+    train_fn = partial(generator, args.train_dir, args.train_masks_dir, fpaths=fold["train"],
+                       augmentations=augmentations, shuffle=True)
+    val_fn = None
+    if args.val_dir is not None or fold["val"] is not None:
+        val_fn = partial(generator, val_dir, val_masks_dir, fpaths=fold["val"], shuffle=False)
+    return train_fn, val_fn
+
+def build_model(args):
+    """
+    Builds the model from `args.model`; call under the strategy scope.
+    """
+    input_shape = (args.img_size, args.img_size, 3)
+    encoder_weights = None if args.encoder_weights == "none" else args.encoder_weights
+    if args.model == "classification":
+        from pneumothorax_seg.training.utils import load_pretrained_classification_model
+        return load_pretrained_classification_model("efficientnet", input_shape=input_shape,
+                                                    pretrained=encoder_weights)
+    from pneumothorax_seg.models.uefficientnet.models import UEfficientNet, UEfficientNetpp
+    model_fn = UEfficientNetpp if args.model == "uefficientnetpp" else UEfficientNet
+    return model_fn(input_shape=input_shape, dropout_rate=0.25, encoder_weights=encoder_weights,
+                    encoder=args.encoder)
+
+def main(args):
+    import numpy as np
+    import tensorflow as tf
+    from pneumothorax_seg.training import distributed
+    if args.threads > 0:
+        tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+        tf.config.threading.set_inter_op_parallelism_threads(min(args.threads, 2))
+    # the strategy has to be created before any other tensorflow op
+    strategy = distributed.get_strategy(args.strategy)
+    np.random.seed(args.seed)
+    tf.random.set_seed(args.seed)
+
+    import tensorflow.keras.callbacks as callbacks
+    from pneumothorax_seg.models.losses_metrics import bce_dice_loss, my_iou_metric, f1
+    from pneumothorax_seg.training.adamw import FusedAdamW
+    from pneumothorax_seg.training.callbacks import SWA, SnapshotCallbackBuilder
+    from pneumothorax_seg.training.schedules import LearningRateLogger
+
+    chief = distributed.is_chief(strategy)
+    lr = distributed.scale_learning_rate(args.lr, args.batch_size, args.base_batch_size, rule=args.lr_scaling)
+    print("{0} replicas, global batch size {1}, lr {2:.2e}".format(strategy.num_replicas_in_sync,
+                                                                  args.batch_size, lr))
+    train_fn, val_fn = get_generator_fns(args)
+    train_data, steps_per_epoch = distributed.make_distributed_dataset(strategy, train_fn, args.batch_size,
+                                                                       seed=args.seed)
+    val_data, val_steps = None, None
+    if val_fn is not None:
+        val_data, val_steps = distributed.make_distributed_dataset(strategy, val_fn, args.batch_size)
+
+    # one definition of the cosine cycles (of whole epochs) for the schedule and SnapshotCapture
+    snapshot_builder = SnapshotCallbackBuilder(args.epochs, args.n_snapshots, init_lr=lr)
+    with strategy.scope():
+        model = build_model(args)
+        n_samples = steps_per_epoch * args.batch_size
+        opt = FusedAdamW(snapshot_builder.get_schedule(steps_per_epoch), weight_decay=args.weight_decay,
+                         batch_size=args.batch_size, samples_per_epoch=n_samples, epochs=args.epochs)
+        if args.model == "classification":
+            model.compile(opt, loss="binary_crossentropy", metrics=[f1, "binary_accuracy"])
+            monitor, mode = "val_loss", "min"
+        else:
+            model.compile(opt, loss=bce_dice_loss, metrics=[my_iou_metric])
+            monitor, mode = "val_my_iou_metric", "max"
+
+    if chief and not os.path.exists(args.save_dir):
+        os.makedirs(args.save_dir)
+    swa_epoch = args.epochs - 3 if args.swa_epoch is None else args.swa_epoch
+    callbacks_list = [LearningRateLogger(),
+                      callbacks.CSVLogger(os.path.join(args.save_dir, "training_log.csv")),
+                      SWA(os.path.join(args.save_dir, "swa.h5"), max(swa_epoch, 0))]
+    if val_data is not None:
+        callbacks_list.append(callbacks.ModelCheckpoint(os.path.join(args.save_dir, "checkpoint.h5"),
+                                                        monitor=monitor, mode=mode, save_best_only=True,
+                                                        save_weights_only=True, verbose=1))
+    if args.snapshot_dir is not None:
+        from pneumothorax_seg.training.snapshots import SnapshotStore, SnapshotCapture
+        callbacks_list.append(SnapshotCapture(SnapshotStore(args.snapshot_dir), snapshot_builder.T,
+                                              snapshot_builder.M))
+    callbacks_list = distributed.get_worker_callbacks(callbacks_list, strategy)
+
+    model.fit(train_data, steps_per_epoch=steps_per_epoch, validation_data=val_data,
+              validation_steps=val_steps, epochs=args.epochs, verbose=2 if chief else 0,
+              callbacks=callbacks_list)
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    if args.n_local_workers > 0:
+        import sys
+        from pneumothorax_seg.training.distributed import launch_local_workers
+
+        # the workers get the same arguments without `--n_local_workers`
+        argv, worker_args = iter(sys.argv[1:]), []
+        for arg in argv:
+            if arg == "--n_local_workers":
+                next(argv)
+            elif not arg.startswith("--n_local_workers="):
+                worker_args.append(arg)
+        worker_args += ["--strategy", "multi_worker"]
+        exit_codes = launch_local_workers(os.path.abspath(__file__), worker_args, n_workers=args.n_local_workers)
+        print("Worker exit codes: {0}".format(exit_codes))
+        sys.exit(max(exit_codes))
+    main(args)
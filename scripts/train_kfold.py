@@ -0,0 +1,39 @@
+"""
+Trains a fold/seed matrix in parallel, one isolated process per run (see `pneumothorax_seg.training.kfold`).
+The images are packed once into a shared read-only array store; unknown arguments are passed on to
+`scripts/train_distributed.py`:
+    python scripts/train_kfold.py --fold_jsons fold1_ids.json fold2_ids.json fold3_ids.json
+        --seeds 0 1 2 --images_dir /content/train --masks_dir /content/masks
+        --store_dir /content/store_256 --work_dir /content/kfold --threads_per_run 8
+        --img_size 256 --batch_size 16 --epochs 70 --n_snapshots 2
+Rerunning the same command resumes after a crash; the SWA weights end up in `work_dir/ensemble.json`.
+"""
+import argparse
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Parallel k-fold/seed training.")
+    parser.add_argument("--fold_jsons", nargs="+", required=True, help="fold .json files with `train`/`val` lists")
+    parser.add_argument("--seeds", nargs="+", type=int, default=[0])
+    parser.add_argument("--work_dir", required=True)
+    parser.add_argument("--images_dir", default=None, help="images to pack into `--store_dir`")
+    parser.add_argument("--masks_dir", default=None, help="masks to pack into `--store_dir`")
+    parser.add_argument("--store_dir", required=True, help="shared array store (built if it doesn't exist)")
+    parser.add_argument("--img_size", type=int, default=256)
+    parser.add_argument("--n_parallel", type=int, default=None, help="defaults to cores // threads_per_run")
+    parser.add_argument("--threads_per_run", type=int, default=4)
+    parser.add_argument("--gpus", nargs="+", default=None, help="GPU ids assigned round-robin to the runs")
+    parser.add_argument("--max_attempts", type=int, default=2)
+    return parser
+
+if __name__ == "__main__":
+    args, script_args = get_parser().parse_known_args()
+    from pneumothorax_seg.io.array_store import build_array_store
+    from pneumothorax_seg.training.kfold import plan_runs, run_kfold
+
+    if args.images_dir is not None:
+        build_array_store(args.images_dir, args.masks_dir, args.store_dir, img_size=args.img_size,
+                          n_workers=args.threads_per_run * 2)
+    script_args += ["--array_store", args.store_dir, "--img_size", str(args.img_size)]
+    runs = plan_runs(args.fold_jsons, args.seeds)
+    run_kfold(runs, args.work_dir, script_args=script_args, n_parallel=args.n_parallel,
+              threads_per_run=args.threads_per_run, gpus=args.gpus, max_attempts=args.max_attempts)
@@ -7,7 +7,7 @@ setup(name="pneumothorax_seg",
       author="Joseph Chen",
       author_email="jchen42703@gmail.com",
       license="Apache License Version 2.0, January 2004",
-      packages=find_packages(),
+      packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
       install_requires=[
             "numpy>=1.10.2",
             "scipy",